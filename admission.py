@@ -0,0 +1,126 @@
+"""Admission control for the AI chat, so a spike slows answers down a little
+instead of piling up a backlog nobody waits for.
+
+The inference engine reports how long each job took from being queued to being
+answered, how many jobs are waiting and how long the oldest of them has waited.
+From these the controller computes the pressure: the worst of the p90 latency
+of the last ADMISSION_WINDOW seconds and the oldest wait, both relative to
+ADMISSION_SLO, and of the queue length relative to ADMISSION_QUEUE. Each of the
+ADMISSION_STEPS thresholds the pressure reaches turns on one more measure:
+
+1. ``degrade``: answer with ADMISSION_FALLBACK_MODEL, a smaller or faster model
+2. ``cap``: also limit answers to ADMISSION_NUM_PREDICT tokens
+3. ``shed``: refuse new messages, the chat answers them with its busy message
+
+Levels are entered as soon as the pressure reaches them and left one at a time,
+after the pressure has stayed below ADMISSION_RECOVER times the level's
+threshold for ADMISSION_HOLD seconds, so the bot doesn't flap between levels
+at the edge of a threshold.
+"""
+import collections
+import logging
+import os
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+ADMISSION = os.getenv('ADMISSION', '1') == '1'
+# Seconds from a message being queued to its answer that users should rarely wait longer than
+ADMISSION_SLO = float(os.getenv('ADMISSION_SLO', '30'))
+# Waiting jobs that count as much pressure as latency at the SLO
+ADMISSION_QUEUE = int(os.getenv('ADMISSION_QUEUE', '50'))
+ADMISSION_WINDOW = float(os.getenv('ADMISSION_WINDOW', '30'))
+# Pressure at which degrade, cap and shed start
+ADMISSION_STEPS = tuple(float(step) for step in os.getenv('ADMISSION_STEPS', '1.0,1.5,2.5').split(','))
+ADMISSION_RECOVER = float(os.getenv('ADMISSION_RECOVER', '0.8'))
+ADMISSION_HOLD = float(os.getenv('ADMISSION_HOLD', '15'))
+ADMISSION_FALLBACK_MODEL = os.getenv('ADMISSION_FALLBACK_MODEL', '')
+ADMISSION_NUM_PREDICT = int(os.getenv('ADMISSION_NUM_PREDICT', '256'))
+# Seconds between two computations of the pressure
+ADMISSION_INTERVAL = 1.0
+
+LEVELS = ('normal', 'degrade', 'cap', 'shed')
+
+shed = metrics.counter('admission_shed_total', "Chat messages refused because the bot was overloaded")
+shaped = metrics.counter('admission_shaped_total', "Generations run with a smaller model or token cap", ['level'])
+
+
+class AdmissionController:
+    def __init__(self, slo=ADMISSION_SLO, queue_target=ADMISSION_QUEUE, window=ADMISSION_WINDOW,
+                 steps=ADMISSION_STEPS, recover=ADMISSION_RECOVER, hold=ADMISSION_HOLD,
+                 fallback_model=ADMISSION_FALLBACK_MODEL, num_predict=ADMISSION_NUM_PREDICT):
+        if len(steps) != len(LEVELS) - 1:
+            raise ValueError(f"ADMISSION_STEPS needs {len(LEVELS) - 1} thresholds, got {len(steps)}")
+        self.slo = slo
+        self.queue_target = queue_target
+        self.window = window
+        self.steps = steps
+        self.recover = recover
+        self.hold = hold
+        self.fallback_model = fallback_model
+        self.num_predict = num_predict
+        self.level = 0
+        self.pressure = 0.0
+        # (monotonic time, seconds) of recently answered jobs
+        self._latencies = collections.deque()
+        # Since when the pressure has been low enough to leave the current level
+        self._calm_since = None
+        metrics.gauge('admission_level', "0 normal, 1 smaller model, 2 capped answers, 3 shedding",
+                      function=lambda: self.level)
+        metrics.gauge('admission_pressure', "Load relative to the latency SLO", function=lambda: self.pressure)
+
+    def observe(self, seconds):
+        """Record the time a job took from being queued to being done."""
+        self._latencies.append((time.monotonic(), seconds))
+
+    def admit(self):
+        """Whether to take a new job."""
+        if self.level >= LEVELS.index('shed'):
+            shed.inc()
+            return False
+        return True
+
+    def shape(self, model, kwargs):
+        """The model and chat arguments for a generation at the current level."""
+        if self.level >= LEVELS.index('degrade') and self.fallback_model:
+            model = self.fallback_model
+        if self.level >= LEVELS.index('cap'):
+            options = dict(kwargs.get('options') or {})
+            limit = options.get('num_predict')
+            # -1 and -2 mean no limit
+            if limit is None or limit < 0 or limit > self.num_predict:
+                options['num_predict'] = self.num_predict
+            kwargs = {**kwargs, 'options': options}
+        if self.level:
+            shaped.inc(level=LEVELS[self.level])
+        return model, kwargs
+
+    def update(self, queued, oldest_wait, now=None):
+        """Compute the pressure from the engine's queue length and the oldest job's wait, and
+        change level if it calls for it. Called every ADMISSION_INTERVAL seconds by the engine."""
+        now = time.monotonic() if now is None else now
+        while self._latencies and self._latencies[0][0] < now - self.window:
+            self._latencies.popleft()
+        latencies = sorted(seconds for _, seconds in self._latencies)
+        p90 = latencies[int(0.9 * (len(latencies) - 1))] if latencies else 0.0
+        self.pressure = max(p90 / self.slo, oldest_wait / self.slo, queued / self.queue_target)
+
+        target = sum(1 for step in self.steps if self.pressure >= step)
+        if target > self.level:
+            self._set_level(target, p90, queued, oldest_wait)
+        elif self.level and self.pressure < self.steps[self.level - 1] * self.recover:
+            if self._calm_since is None:
+                self._calm_since = now
+            elif now - self._calm_since >= self.hold:
+                self._set_level(self.level - 1, p90, queued, oldest_wait)
+        else:
+            self._calm_since = None
+
+    def _set_level(self, level, p90, queued, oldest_wait):
+        log = logger.warning if level > self.level else logger.info
+        log("Admission %s -> %s: pressure %.2f, p90 latency %.1fs, %d queued, oldest waiting %.1fs",
+            LEVELS[self.level], LEVELS[level], self.pressure, p90, queued, oldest_wait)
+        self.level = level
+        self._calm_since = None
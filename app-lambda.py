@@ -1,8 +1,9 @@
 import json
 import os
-import boto3
-import requests
-from urllib.parse import urlencode
+import time
+
+# Nothing else is imported at module load: /login only builds a redirect and must stay
+# cheap on a cold container, the callback imports what it needs on first use
 
 # Load environment variables
 TWITTER_CLIENT_ID = os.getenv('TWITTER_CLIENT_ID')
@@ -10,10 +11,20 @@ TWITTER_CLIENT_SECRET = os.getenv('TWITTER_CLIENT_SECRET')
 TWITTER_CALLBACK_URL = os.getenv('TWITTER_CALLBACK_URL')
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 DYNAMO_TABLE = os.getenv('DYNAMO_TABLE', 'TwitterTelegramBindings')
+TWITTER_API_URL = os.getenv('TWITTER_API_URL', 'https://api.twitter.com')
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org')
+
+_store = None
+
+
+# Initialize DynamoDB on first use, warm invocations reuse it
+def get_store():
+    global _store
+    if _store is None:
+        from binding_store import DynamoBindingStore
+        _store = DynamoBindingStore(DYNAMO_TABLE)
+    return _store
 
-# Initialize DynamoDB
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(DYNAMO_TABLE)
 
 # ✅ Step 1: Redirect to Twitter OAuth 2.0
 def lambda_login(event, context):
@@ -52,9 +63,15 @@ def lambda_callback(event, context):
             "body": json.dumps({"error": "Invalid request"})
         }
 
+    # Module imports are cached, so only the first callback of a container pays for these
+    import logging
+    import http_client
+    import logging_setup
+    logging_setup.configure()
+
     try:
         # ✅ Step 3: Exchange Authorization Code for Access Token
-        token_url = "https://api.twitter.com/2/oauth2/token"
+        token_url = f"{TWITTER_API_URL}/2/oauth2/token"
         data = {
             "grant_type": "authorization_code",
             "code": code,
@@ -63,7 +80,7 @@ def lambda_callback(event, context):
         }
 
         auth = (TWITTER_CLIENT_ID, TWITTER_CLIENT_SECRET)
-        response = requests.post(token_url, data=data, auth=auth)
+        response = http_client.post(token_url, data=data, auth=auth)
 
         if response.status_code != 200:
             return {
@@ -71,11 +88,14 @@ def lambda_callback(event, context):
                 "body": json.dumps({"error": "Failed to get access token"})
             }
 
-        access_token = response.json().get("access_token")
+        token_response = response.json()
+        access_token = token_response.get("access_token")
+        refresh_token = token_response.get("refresh_token")
+        expires_at = int(time.time()) + int(token_response.get("expires_in", 7200))
 
         # ✅ Step 4: Get Twitter User Profile
-        user_response = requests.get(
-            "https://api.twitter.com/2/users/me",
+        user_response = http_client.get(
+            f"{TWITTER_API_URL}/2/users/me",
             headers={"Authorization": f"Bearer {access_token}"}
         )
 
@@ -89,14 +109,26 @@ def lambda_callback(event, context):
         twitter_handle = twitter_data['data']['username']
 
         # ✅ Step 5: Store in DynamoDB
-        table.put_item(Item={
+        get_store().upsert({
             "chat_id": chat_id,
             "twitter_handle": twitter_handle,
-            "access_token": access_token
+            "twitter_id": twitter_data['data']['id'],
+            "access_token": access_token,
+            "refresh_token": refresh_token,
+            "expires_at": expires_at
         })
 
         # ✅ Step 6: Send Success Message to Telegram
-        send_message_to_telegram(chat_id, f"✅ Successfully linked your Twitter account (@{twitter_handle}).")
+        # One attempt before returning, Lambda freezes once we do. The binding is saved either way,
+        # so a failed message is only logged and the user still gets the success response.
+        try:
+            sent = http_client.post(
+                f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
+                json={"chat_id": chat_id, "text": f"✅ Successfully linked your Twitter account (@{twitter_handle})."},
+            )
+            sent.raise_for_status()
+        except Exception:
+            logging.getLogger(__name__).exception("Could not confirm the Twitter link to chat %s", chat_id)
 
         return {
             "statusCode": 200,
@@ -109,12 +141,6 @@ def lambda_callback(event, context):
             "body": json.dumps({"error": str(e)})
         }
 
-# ✅ Send Telegram Message After Binding
-def send_message_to_telegram(chat_id, text):
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    payload = {"chat_id": chat_id, "text": text}
-    requests.post(url, json=payload)
-
 # ✅ Step 7: Lambda Handler (AWS API Gateway Routes)
 def lambda_handler(event, context):
     if event['path'] == "/login":
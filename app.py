@@ -1,38 +1,40 @@
 from flask import Flask, request, redirect, session, jsonify
-from flask_sqlalchemy import SQLAlchemy
-import requests
+import logging
 import os
+import time
+
+import background
+import http_client
+import logging_setup
+import metrics
+from binding_store import create_store
+from pages import SUCCESS_PAGE
+from telegram_sender import send_message_to_telegram
+
+# Whichever server imports the app, records are written by a background thread
+logging_setup.configure()
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+# Request latency by route, served on /metrics
+metrics.instrument_flask(app, 'twitter_oauth')
 
 # Load environment variables
 app.secret_key = os.getenv('DB_SECRET_KEY')
 
-# Set the database URI
-basedir = os.path.abspath(os.path.dirname(__file__))
-app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(basedir, 'users.db')}"
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-# Initialize the database
-db = SQLAlchemy(app)
+# Telegram ↔ Twitter bindings, users.db next to this file unless configured otherwise
+store = create_store()
 
 # Twitter API Keys (OAuth 2.0)
 TWITTER_CLIENT_ID = os.getenv('TWITTER_CLIENT_ID')
 TWITTER_CLIENT_SECRET = os.getenv('TWITTER_CLIENT_SECRET')
 TWITTER_CALLBACK_URL = os.getenv('TWITTER_CALLBACK_URL')
+TWITTER_API_URL = os.getenv('TWITTER_API_URL', 'https://api.twitter.com')
 
 # Telegram Bot Token
 TELEGRAM_BOT_TOKEN = os.getenv('API_KEY')
 
 
-# ✅ Database Model
-class User(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    chat_id = db.Column(db.String(20), unique=True, nullable=False)
-    twitter_handle = db.Column(db.String(100), nullable=False)
-    access_token = db.Column(db.String(200), nullable=False)
-
-
 # ✅ Step 1: Redirect User to Twitter OAuth 2.0 Login
 @app.route('/login', methods=['GET'])
 def login():
@@ -56,7 +58,7 @@ def callback():
         return "❌ Error: Invalid request.", 400
 
     # ✅ Step 3: Exchange Authorization Code for Access Token
-    token_url = "https://api.twitter.com/2/oauth2/token"
+    token_url = f"{TWITTER_API_URL}/2/oauth2/token"
     data = {
         "grant_type": "authorization_code",
         "code": code,
@@ -67,127 +69,67 @@ def callback():
     # Use HTTP Basic Authentication
     auth = (TWITTER_CLIENT_ID, TWITTER_CLIENT_SECRET)
 
-    # Debug: Print the request payload
-    print("Token Exchange Request Payload:", data)
-    print("Using Client ID:", TWITTER_CLIENT_ID)
+    # The code and verifier are redacted before the record is written
+    logger.debug("Exchanging the code of chat %s for a token", chat_id, extra={'payload': data})
 
-    response = requests.post(token_url, data=data, auth=auth)
-    
-    # Debug: Print the response
-    print("Token Exchange Response Status Code:", response.status_code)
-    print("Token Exchange Response Body:", response.text)
+    with metrics.timed('twitter.token', metrics.oauth_request_seconds, provider='twitter', step='token'):
+        response = http_client.post(token_url, data=data, auth=auth)
 
     if response.status_code != 200:
+        logger.warning("Twitter token exchange for chat %s failed with HTTP %d", chat_id, response.status_code,
+                       extra={'payload': response.text})
         return "❌ Error: Failed to get access token.", 400
 
     # ✅ Step 4: Get Access Token
     token_response = response.json()
     access_token = token_response['access_token']
+    refresh_token = token_response.get('refresh_token')
+    expires_at = int(time.time()) + int(token_response.get('expires_in', 7200))
 
-    # ✅ Step 5: Get Twitter User Profile (Twitter Handle)
-    user_response = requests.get(
-        "https://api.twitter.com/2/users/me",
-        headers={"Authorization": f"Bearer {access_token}"}
-    )
-
-    if user_response.status_code != 200:
-        return "❌ Error: Failed to get Twitter profile.", 400
-
-    twitter_data = user_response.json()
-    twitter_handle = twitter_data['data']['username']
-
-    # ✅ Step 6: Store in Database (Auto-Bind Telegram ↔ Twitter)
-    existing_user = User.query.filter_by(chat_id=chat_id).first()
-    if existing_user:
-        existing_user.twitter_handle = twitter_handle
-        existing_user.access_token = access_token
-    else:
-        new_user = User(
-            chat_id=chat_id,
-            twitter_handle=twitter_handle,
-            access_token=access_token
-        )
-        db.session.add(new_user)
-
-    db.session.commit()
-
-    # ✅ Step 7: Send Success Message to Telegram
-    send_message_to_telegram(chat_id, f"✅ Successfully linked your Twitter account (@{twitter_handle}).")
-
-    # ✅ Step 8: Return Success Page
-    return f"""
-        <!DOCTYPE html>
-        <html lang="en">
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>Success! ✅</title>
-            <style>
-                body {{
-                    font-family: Arial, sans-serif;
-                    background-color: #f4f8fb;
-                    text-align: center;
-                    padding: 50px;
-                }}
-                .container {{
-                    max-width: 500px;
-                    margin: auto;
-                    padding: 20px;
-                    background: white;
-                    box-shadow: 0 0 10px rgba(0, 0, 0, 0.1);
-                    border-radius: 10px;
-                }}
-                h2 {{
-                    color: #1DA1F2;
-                }}
-                p {{
-                    font-size: 18px;
-                    color: #333;
-                }}
-                .icons {{
-                    font-size: 50px;
-                    margin: 20px 0;
-                }}
-                .icons i {{
-                    margin: 0 10px;
-                    color: #1DA1F2;
-                }}
-                .back-btn {{
-                    display: inline-block;
-                    margin-top: 20px;
-                    padding: 10px 20px;
-                    color: white;
-                    background-color: #1DA1F2;
-                    text-decoration: none;
-                    border-radius: 5px;
-                    font-weight: bold;
-                }}
-                .back-btn:hover {{
-                    background-color: #0c85d0;
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <h2>✅ Success!</h2>
-                <div class="icons">🐦 🔗 💬</div>
-                <p>Your Twitter account <b>@{twitter_handle}</b> has been linked to your Telegram.</p>
-                <p>You will now receive tweets directly in Telegram!</p>
-                <a class="back-btn" href="https://t.me/DeepXVBot">Go to Telegram</a>
-            </div>
-        </body>
-        </html>
-        """
-
-
-# ✅ Send Telegram Message After Binding
-def send_message_to_telegram(chat_id, text):
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    payload = {
+    # ✅ Step 5: Store in Database (Auto-Bind Telegram ↔ Twitter), the handle follows with the profile
+    binding = {
         "chat_id": chat_id,
-        "text": text
+        "twitter_handle": "",
+        "twitter_id": None,
+        "access_token": access_token,
+        "refresh_token": refresh_token,
+        "expires_at": expires_at
     }
-    requests.post(url, json=payload)
+    store.upsert(binding)
+
+    # ✅ Step 6: Fetch the Profile and Confirm in Telegram once the user has their page
+    background.submit(complete_binding, binding)
+
+    # ✅ Step 7: Return Success Page
+    return SUCCESS_PAGE
+
+
+def complete_binding(binding):
+    """Fill in the Twitter handle and id of a new binding, then confirm it in Telegram.
+
+    Runs on the background pool and is retried if it raises, so every step can be repeated.
+    The confirmation is only queued, the sender retries it on its own.
+    """
+    chat_id = binding['chat_id']
+    if not binding['twitter_handle']:
+        with metrics.timed('twitter.profile', metrics.oauth_request_seconds, provider='twitter', step='profile'):
+            user_response = http_client.get(
+                f"{TWITTER_API_URL}/2/users/me",
+                headers={"Authorization": f"Bearer {binding['access_token']}"}
+            )
+        user_response.raise_for_status()
+        twitter_data = user_response.json()['data']
+
+        current = store.get(chat_id)
+        if current is None or current['access_token'] != binding['access_token']:
+            # Linked again in the meantime, that login completes its own binding
+            return
+        binding.update(twitter_handle=twitter_data['username'], twitter_id=twitter_data['id'])
+        store.upsert({**current, "twitter_handle": binding['twitter_handle'], "twitter_id": binding['twitter_id']})
+
+    send_message_to_telegram(
+        TELEGRAM_BOT_TOKEN, chat_id, f"✅ Successfully linked your Twitter account (@{binding['twitter_handle']})."
+    )
 
 
 # ✅ Test Route
@@ -196,10 +138,5 @@ def home():
     return "✅ Telegram ↔ Twitter Bot (OAuth 2.0) is running!"
 
 
-# ✅ Automatically Create Database (Fix)
-with app.app_context():
-    db.create_all()
-
-
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,211 @@
+"""The OAuth web routes as one async ASGI app, for serving with several workers.
+
+Serves the Twitter ``/login`` and ``/callback`` of app.py and the Google
+``/oauth/callback`` of tg_google_oauth.py, with every outbound call made
+through the async HTTP client, so a worker waits on Twitter and Google for many
+logins at once instead of tying up a thread per login. The store calls run on
+worker threads. Like the Flask versions, the callbacks answer as soon as the
+binding is stored and send the Telegram confirmation afterwards, here as
+``background.spawn`` tasks on the worker's own event loop and ``TelegramSender``.
+
+    python asgi_app.py                           # ASGI_WORKERS processes on ASGI_PORT
+    uvicorn asgi_app:app --workers 4 --port 5000
+
+Workers share nothing in memory. The Google bot then has to run on its own,
+with OAUTH_SERVER=none, and both sides need OAUTH_STATE_DB so a callback finds
+the state the bot issued; the app refuses to start without it. Metrics are per
+worker; each scrape of /metrics reads the worker that happened to answer.
+"""
+import asyncio
+import contextlib
+import logging
+import os
+import time
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import HTMLResponse, PlainTextResponse, RedirectResponse, Response
+from starlette.routing import Route
+
+import background
+import http_client
+import logging_setup
+import metrics
+from binding_store import create_store
+from oauth_state import OAUTH_STATE_DB, create_state_store
+from pages import SUCCESS_PAGE
+from telegram_sender import TelegramSender, log_failure
+
+logger = logging.getLogger(__name__)
+
+ASGI_HOST = os.getenv('ASGI_HOST', '0.0.0.0')
+ASGI_PORT = int(os.getenv('ASGI_PORT', '5000'))
+ASGI_WORKERS = int(os.getenv('ASGI_WORKERS', str(os.cpu_count() or 1)))
+
+TELEGRAM_BOT_TOKEN = os.getenv('API_KEY')
+TWITTER_CLIENT_ID = os.getenv('TWITTER_CLIENT_ID')
+TWITTER_CLIENT_SECRET = os.getenv('TWITTER_CLIENT_SECRET')
+TWITTER_CALLBACK_URL = os.getenv('TWITTER_CALLBACK_URL')
+TWITTER_API_URL = os.getenv('TWITTER_API_URL', 'https://api.twitter.com')
+GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID')
+GOOGLE_CLIENT_SECRET = os.getenv('GOOGLE_CLIENT_SECRET')
+GOOGLE_REDIRECT_URI = os.getenv('GOOGLE_REDIRECT_URI', 'http://127.0.0.1:5000/oauth/callback')
+GOOGLE_TOKEN_URL = os.getenv('GOOGLE_TOKEN_URL', 'https://oauth2.googleapis.com/token')
+GOOGLE_USERINFO_URL = os.getenv('GOOGLE_USERINFO_URL', 'https://www.googleapis.com/oauth2/v1/userinfo')
+
+store = create_store()
+user_sessions = create_state_store()
+# Started with the app, one per worker process
+sender = None
+
+
+async def login(request: Request) -> Response:
+    chat_id = request.query_params.get('chat_id')
+    if not chat_id:
+        return PlainTextResponse("❌ Error: No chat_id provided.", status_code=400)
+    url = (
+        f"https://twitter.com/i/oauth2/authorize?response_type=code&client_id={TWITTER_CLIENT_ID}"
+        f"&redirect_uri={TWITTER_CALLBACK_URL}&scope=tweet.read%20users.read%20offline.access"
+        f"&state={chat_id}&code_challenge=challenge&code_challenge_method=plain"
+    )
+    return RedirectResponse(url, status_code=302)
+
+
+async def twitter_callback(request: Request) -> Response:
+    chat_id = request.query_params.get('state')
+    code = request.query_params.get('code')
+    if not code or not chat_id:
+        return PlainTextResponse("❌ Error: Invalid request.", status_code=400)
+
+    data = {
+        "grant_type": "authorization_code",
+        "code": code,
+        "redirect_uri": TWITTER_CALLBACK_URL,
+        "code_verifier": "challenge",
+    }
+    with metrics.timed('twitter.token', metrics.oauth_request_seconds, provider='twitter', step='token'):
+        response = await http_client.async_post(f"{TWITTER_API_URL}/2/oauth2/token", data=data,
+                                                auth=(TWITTER_CLIENT_ID, TWITTER_CLIENT_SECRET))
+    if response.status_code != 200:
+        logger.warning("Twitter token exchange failed: HTTP %d", response.status_code)
+        return PlainTextResponse("❌ Error: Failed to get access token.", status_code=400)
+
+    token_response = response.json()
+    binding = {
+        "chat_id": chat_id,
+        "twitter_handle": "",
+        "twitter_id": None,
+        "access_token": token_response['access_token'],
+        "refresh_token": token_response.get('refresh_token'),
+        "expires_at": int(time.time()) + int(token_response.get('expires_in', 7200)),
+    }
+    await asyncio.to_thread(store.upsert, binding)
+    background.spawn(complete_binding, binding)
+    return HTMLResponse(SUCCESS_PAGE)
+
+
+async def complete_binding(binding):
+    """Fill in the Twitter handle and id of a new binding, then confirm it in Telegram."""
+    chat_id = binding['chat_id']
+    if not binding['twitter_handle']:
+        with metrics.timed('twitter.profile', metrics.oauth_request_seconds, provider='twitter', step='profile'):
+            response = await http_client.async_get(f"{TWITTER_API_URL}/2/users/me",
+                                                   headers={"Authorization": f"Bearer {binding['access_token']}"})
+        response.raise_for_status()
+        twitter_data = response.json()['data']
+
+        current = await asyncio.to_thread(store.get, chat_id)
+        if current is None or current['access_token'] != binding['access_token']:
+            # Linked again in the meantime, that login completes its own binding
+            return
+        binding.update(twitter_handle=twitter_data['username'], twitter_id=twitter_data['id'])
+        await asyncio.to_thread(store.upsert, {**current, "twitter_handle": binding['twitter_handle'],
+                                               "twitter_id": binding['twitter_id']})
+
+    # Not awaited, the sender retries the message itself and retrying this task could send it twice
+    sender.send_message(chat_id, f"✅ Successfully linked your Twitter account (@{binding['twitter_handle']})."
+                        ).add_done_callback(log_failure)
+
+
+async def google_callback(request: Request) -> Response:
+    code = request.query_params.get('code')
+    state = request.query_params.get('state')
+
+    # Each state can be used once
+    login = await asyncio.to_thread(user_sessions.pop, state)
+    if login is None:
+        return PlainTextResponse("Invalid state parameter", status_code=400)
+
+    token_data = {
+        "code": code,
+        "client_id": GOOGLE_CLIENT_ID,
+        "client_secret": GOOGLE_CLIENT_SECRET,
+        "redirect_uri": GOOGLE_REDIRECT_URI,
+        "grant_type": "authorization_code",
+    }
+    with metrics.timed('google.token', metrics.oauth_request_seconds, provider='google', step='token'):
+        response = await http_client.async_post(GOOGLE_TOKEN_URL, data=token_data)
+    token_json = response.json()
+    if "access_token" not in token_json:
+        return PlainTextResponse("Failed to get access token", status_code=400)
+
+    background.spawn(confirm_google_login, login["telegram_id"], token_json['access_token'])
+    return PlainTextResponse("Authentication successful! You can close this window and return to Telegram.")
+
+
+async def confirm_google_login(telegram_id, access_token):
+    """Tell the user in Telegram who they logged in as."""
+    with metrics.timed('google.profile', metrics.oauth_request_seconds, provider='google', step='profile'):
+        response = await http_client.async_get(GOOGLE_USERINFO_URL,
+                                               headers={"Authorization": f"Bearer {access_token}"})
+    response.raise_for_status()
+    user_info = response.json()
+    sender.send_message(
+        telegram_id,
+        f"Successfully logged in as {user_info.get('name', 'User')} ({user_info.get('email', 'No email')})",
+    ).add_done_callback(log_failure)
+
+
+async def home(request: Request) -> Response:
+    return PlainTextResponse("✅ Telegram ↔ Twitter Bot (OAuth 2.0) is running!")
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global sender
+    # Every uvicorn worker is a process of its own
+    logging_setup.configure()
+    if not OAUTH_STATE_DB:
+        # The states are issued by the Google bot, which never runs in this process
+        raise RuntimeError("OAUTH_STATE_DB is not set: Google callbacks could not find the login states the bot "
+                           "issued and would all fail with 'Invalid state parameter'. Point it and the bot's "
+                           "OAUTH_STATE_DB at the same SQLite file.")
+    sender = TelegramSender(TELEGRAM_BOT_TOKEN)
+    await sender.start()
+    try:
+        yield
+    finally:
+        # Let the confirmations of the last logins go out
+        await background.drain(30)
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(sender.join(), 30)
+        await sender.stop()
+
+
+app = Starlette(routes=[
+    Route('/login', login, methods=['GET']),
+    Route('/callback', twitter_callback, methods=['GET']),
+    Route('/oauth/callback', google_callback, methods=['GET']),
+    Route('/', home, methods=['GET']),
+], lifespan=lifespan)
+metrics.instrument_starlette(app, 'oauth_asgi')
+
+
+def main():
+    import uvicorn
+    logging_setup.configure()
+    uvicorn.run('asgi_app:app', host=ASGI_HOST, port=ASGI_PORT, workers=ASGI_WORKERS, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
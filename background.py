@@ -0,0 +1,160 @@
+"""Work the web apps finish after they have answered.
+
+An OAuth callback records what must survive, answers the browser, and leaves
+the rest, like the Telegram confirmation or a profile lookup, to ``submit``.
+Tasks run on a small thread pool and a task that raises is tried again after
+an exponential backoff, up to BACKGROUND_ATTEMPTS times in all, so a slow or
+failing api.telegram.org no longer shows in the callback's latency.
+
+Async apps use ``spawn`` instead, which runs a coroutine function as a task on
+the running loop with the same retries, and ``drain`` at shutdown.
+
+Not for Lambda: a container is frozen as soon as the handler returns, so
+nothing submitted here would be guaranteed to run.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import os
+import threading
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+BACKGROUND_WORKERS = int(os.getenv('BACKGROUND_WORKERS', '4'))
+BACKGROUND_ATTEMPTS = int(os.getenv('BACKGROUND_ATTEMPTS', '5'))
+# Seconds before the first retry, doubled for every further one
+BACKGROUND_BACKOFF = float(os.getenv('BACKGROUND_BACKOFF', '1.0'))
+
+task_seconds = metrics.histogram('background_task_seconds', "Duration of a background task attempt", ['task'])
+task_results = metrics.counter('background_tasks_total', "Background task attempts by outcome", ['task', 'result'])
+
+
+class BackgroundTasks:
+    def __init__(self, workers=BACKGROUND_WORKERS, attempts=BACKGROUND_ATTEMPTS, backoff=BACKGROUND_BACKOFF):
+        self.attempts = attempts
+        self.backoff = backoff
+        self._pool = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='background')
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._idle = threading.Condition(self._lock)
+
+    @property
+    def pending(self):
+        """Tasks submitted and not yet done, including the ones waiting for a retry."""
+        return self._pending
+
+    def submit(self, func, *args, **kwargs):
+        with self._lock:
+            self._pending += 1
+        self._pool.submit(self._run, func, args, kwargs, 1)
+
+    def _run(self, func, args, kwargs, attempt):
+        name = getattr(func, '__name__', 'task')
+        try:
+            with metrics.timed(f"background.{name}", task_seconds, task=name):
+                func(*args, **kwargs)
+        except Exception:
+            if attempt < self.attempts:
+                task_results.inc(task=name, result='retried')
+                delay = self.backoff * 2 ** (attempt - 1)
+                logger.warning("Background task %s failed, attempt %d of %d, retrying in %.1fs",
+                               name, attempt, self.attempts, delay, exc_info=True)
+                timer = threading.Timer(delay, self._retry, (func, args, kwargs, attempt + 1))
+                timer.daemon = True
+                timer.start()
+                return
+            task_results.inc(task=name, result='failed')
+            logger.exception("Background task %s failed after %d attempts", name, attempt)
+        else:
+            task_results.inc(task=name, result='done')
+        self._done()
+
+    def _retry(self, func, args, kwargs, attempt):
+        try:
+            self._pool.submit(self._run, func, args, kwargs, attempt)
+        except RuntimeError:
+            # Shut down while the retry was waiting
+            self._done()
+
+    def _done(self):
+        with self._lock:
+            self._pending -= 1
+            if self._pending == 0:
+                self._idle.notify_all()
+
+    def join(self, timeout=None):
+        """Wait until every submitted task has succeeded or given up. Returns False on timeout."""
+        with self._lock:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def shutdown(self, timeout=None):
+        self.join(timeout)
+        self._pool.shutdown(wait=False)
+
+
+_tasks = None
+_tasks_lock = threading.Lock()
+
+metrics.gauge('background_tasks_pending', "Background tasks not yet done, retries included",
+              function=lambda: (_tasks.pending if _tasks is not None else 0) + len(_async_tasks))
+
+
+def get_tasks():
+    """The process wide ``BackgroundTasks``, started on first use."""
+    global _tasks
+    if _tasks is None:
+        with _tasks_lock:
+            if _tasks is None:
+                _tasks = BackgroundTasks()
+    return _tasks
+
+
+def submit(func, *args, **kwargs):
+    """Run ``func(*args, **kwargs)`` on the background pool, retrying it if it raises."""
+    get_tasks().submit(func, *args, **kwargs)
+
+
+# Tasks started by ``spawn``, referenced so they aren't garbage collected while they run
+_async_tasks = set()
+
+
+async def _retrying(func, args, attempts, backoff):
+    name = getattr(func, '__name__', 'task')
+    for attempt in range(1, attempts + 1):
+        try:
+            with metrics.timed(f"background.{name}", task_seconds, task=name):
+                await func(*args)
+        except Exception:
+            if attempt == attempts:
+                task_results.inc(task=name, result='failed')
+                logger.exception("Background task %s failed after %d attempts", name, attempt)
+                return
+            task_results.inc(task=name, result='retried')
+            delay = backoff * 2 ** (attempt - 1)
+            logger.warning("Background task %s failed, attempt %d of %d, retrying in %.1fs",
+                           name, attempt, attempts, delay, exc_info=True)
+            await asyncio.sleep(delay)
+        else:
+            task_results.inc(task=name, result='done')
+            return
+
+
+def spawn(func, *args, attempts=BACKGROUND_ATTEMPTS, backoff=BACKGROUND_BACKOFF):
+    """Run ``await func(*args)`` as a task on the running loop, retrying it if it raises."""
+    task = asyncio.create_task(_retrying(func, args, attempts, backoff))
+    _async_tasks.add(task)
+    task.add_done_callback(_async_tasks.discard)
+    return task
+
+
+async def drain(timeout=None):
+    """Wait for the tasks started by ``spawn`` on this loop, cancelling what is left after ``timeout``."""
+    loop = asyncio.get_running_loop()
+    tasks = [task for task in _async_tasks if task.get_loop() is loop]
+    if not tasks:
+        return
+    _, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
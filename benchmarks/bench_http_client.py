@@ -0,0 +1,113 @@
+"""Per-callback latency of unpooled ``requests`` calls vs the pooled ``http_client``.
+
+Runs the three outbound calls of an OAuth callback (token exchange, profile
+fetch, Telegram notification) against a local stub server. The stub can delay
+every new connection to stand in for the TCP and TLS handshakes to the real
+APIs, which is the cost pooling saves.
+
+    python benchmarks/bench_http_client.py --iterations 200 --handshake-ms 30
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import http_client  # noqa: E402
+
+
+def start_stub(handshake_ms, latency_ms):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            super().setup()
+            # Headers and body are written separately, without this delayed ACKs stall keep-alive
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # Paid once per connection, like a handshake
+            time.sleep(handshake_ms / 1000)
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, body):
+            self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            time.sleep(latency_ms / 1000)
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            if self.path.endswith('/oauth2/token'):
+                self._reply({'access_token': 'token', 'token_type': 'bearer'})
+            else:
+                self._reply({'ok': True, 'result': {'message_id': 1}})
+
+        def do_GET(self):
+            self._reply({'data': {'id': '1', 'username': 'someone'}})
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def callback(base, post, get):
+    post(f"{base}/2/oauth2/token", data={'grant_type': 'authorization_code', 'code': 'c'}, auth=('id', 'secret'))
+    get(f"{base}/2/users/me", headers={'Authorization': 'Bearer token'})
+    post(f"{base}/botTOKEN/sendMessage", json={'chat_id': 1, 'text': 'linked'})
+
+
+def measure(iterations, base, post, get):
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        callback(base, post, get)
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return {
+        'mean': statistics.fmean(samples),
+        'p50': samples[len(samples) // 2],
+        'p95': samples[int(len(samples) * 0.95) - 1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--handshake-ms', type=float, default=30.0)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server, base = start_stub(args.handshake_ms, args.latency_ms)
+    try:
+        # Warm the pool so the pooled numbers show the steady state
+        callback(base, http_client.post, http_client.get)
+        results = {
+            'requests (new connection per call)': measure(args.iterations, base, requests.post, requests.get),
+            'http_client (pooled keep-alive)': measure(args.iterations, base, http_client.post, http_client.get),
+        }
+    finally:
+        server.shutdown()
+
+    print(f"{args.iterations} callbacks, {args.handshake_ms:.0f}ms per new connection, "
+          f"{args.latency_ms:.0f}ms per request")
+    for name, stats in results.items():
+        print(f"  {name:40s} mean {stats['mean']:7.2f}ms  p50 {stats['p50']:7.2f}ms  p95 {stats['p95']:7.2f}ms")
+    unpooled, pooled = results.values()
+    print(f"  saved per callback: {unpooled['mean'] - pooled['mean']:.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Cold and warm invocation cost of app-lambda.py.
+
+Every cold sample is a fresh Python process, like a new Lambda container: it
+imports the module, then serves a first /login and a first /callback, then a
+number of warm invocations of each. DynamoDB, Twitter and Telegram are local
+stubs, so the numbers are our own import, client setup and request overhead.
+
+    python benchmarks/bench_lambda_cold_start.py --cold 20 --warm 50
+"""
+import argparse
+import importlib.util
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(q * (len(samples) - 1))))]
+
+
+def login_event():
+    return {'path': '/login', 'queryStringParameters': {'chat_id': '42'}}
+
+
+# Telegram paces messages to one chat, so every callback binds a different one
+_chat_ids = itertools.count(1)
+
+
+def callback_event():
+    return {'path': '/callback', 'queryStringParameters': {'state': str(next(_chat_ids)), 'code': 'stub-code'}}
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return (time.perf_counter() - started) * 1000, result
+
+
+def child(warm):
+    """Runs inside the fresh process, prints one JSON line of timings in ms."""
+    def load():
+        spec = importlib.util.spec_from_file_location('app_lambda', os.path.join(ROOT, 'app-lambda.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    import_ms, module = timed(load)
+    first_login_ms, response = timed(module.lambda_handler, login_event(), None)
+    assert response['statusCode'] == 302, response
+    first_callback_ms, response = timed(module.lambda_handler, callback_event(), None)
+    assert response['statusCode'] == 200, response
+    warm_login = [timed(module.lambda_handler, login_event(), None)[0] for _ in range(warm)]
+    warm_callback = [timed(module.lambda_handler, callback_event(), None)[0] for _ in range(warm)]
+    print(json.dumps({
+        'import': import_ms,
+        'first_login': first_login_ms,
+        'first_callback': first_callback_ms,
+        'warm_login': warm_login,
+        'warm_callback': warm_callback,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cold', type=int, default=20, help="fresh processes to start")
+    parser.add_argument('--warm', type=int, default=50, help="warm invocations per process")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.warm)
+        return
+
+    from benchmarks.stubs import dynamodb_stub, telegram_stub, twitter_stub
+
+    with dynamodb_stub() as dynamodb, twitter_stub() as twitter, telegram_stub() as telegram:
+        env = {
+            **os.environ,
+            'AWS_ENDPOINT_URL_DYNAMODB': dynamodb.url,
+            'AWS_ACCESS_KEY_ID': 'stub',
+            'AWS_SECRET_ACCESS_KEY': 'stub',
+            'AWS_DEFAULT_REGION': 'us-east-1',
+            'TWITTER_API_URL': twitter.url,
+            'TELEGRAM_API_URL': telegram.url,
+            'TELEGRAM_BOT_TOKEN': 'stub-token',
+            'TWITTER_CLIENT_ID': 'stub-client',
+            'TWITTER_CLIENT_SECRET': 'stub-secret',
+            'TWITTER_CALLBACK_URL': 'http://127.0.0.1/callback',
+        }
+        runs = []
+        for _ in range(args.cold):
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--child', '--warm', str(args.warm)],
+                env=env, capture_output=True, text=True, check=True,
+            ).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    rows = {
+        'module import': [run['import'] for run in runs],
+        'cold /login (import + first call)': [run['import'] + run['first_login'] for run in runs],
+        'first /callback': [run['first_callback'] for run in runs],
+        'warm /login': [ms for run in runs for ms in run['warm_login']],
+        'warm /callback': [ms for run in runs for ms in run['warm_callback']],
+    }
+    print(f"{args.cold} cold starts, {args.warm} warm invocations each")
+    for name, samples in rows.items():
+        print(f"  {name:36s} p50 {percentile(samples, 0.5):8.2f}ms  p99 {percentile(samples, 0.99):8.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Chat requests through router.py's BackendPool with one failing Ollama host.
+
+Two Ollama stubs run in a child process: a healthy one and one that fails as
+--failure says, answering every request with a 500 or never answering at all.
+Requests go through a BackendPool of both, the failing host listed first, and
+are streamed to the end. A request counts as an error if it fails on both
+hosts. The failures column shows how often each host was marked failed.
+
+    python benchmarks/bench_router.py --failure error
+    python benchmarks/bench_router.py --failure hang --read-timeout 2
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.stubs import StubProcess, ollama_stub  # noqa: E402
+
+
+async def run(args, urls):
+    from router import BackendPool
+
+    pool = BackendPool([urls['failing'], urls['healthy']], cooldown=args.cooldown)
+    for backend, name in zip(pool.backends, ('failing', 'healthy')):
+        backend.host = name
+    latencies = []
+    errors = 0
+    remaining = iter(range(args.requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            started = time.perf_counter()
+            try:
+                async for _ in await pool.chat(model='stub', messages=[{'role': 'user', 'content': 'Hi'}],
+                                               stream=True):
+                    pass
+            except Exception:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'elapsed': elapsed,
+        'errors': errors,
+        'p50': latencies[len(latencies) // 2] if latencies else 0.0,
+        'p99': latencies[int(0.99 * (len(latencies) - 1))] if latencies else 0.0,
+        'answered': len(latencies),
+        'backends': pool.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--failure', choices=('error', 'hang', 'none'), default='hang')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency-ms', type=float, default=50, help="time to the first token")
+    parser.add_argument('--token-ms', type=float, default=5, help="time between tokens")
+    parser.add_argument('--tokens', type=int, default=50)
+    parser.add_argument('--cooldown', type=float, default=10, help="OLLAMA_BACKEND_COOLDOWN of the pool")
+    parser.add_argument('--connect-timeout', type=float, default=5)
+    parser.add_argument('--read-timeout', type=float, default=2)
+    args = parser.parse_args()
+
+    # Read by router.py on import
+    os.environ['OLLAMA_CONNECT_TIMEOUT'] = str(args.connect_timeout)
+    os.environ['OLLAMA_READ_TIMEOUT'] = str(args.read_timeout)
+    latency = args.latency_ms / 1000
+    healthy = (ollama_stub, (latency, args.token_ms / 1000, args.tokens))
+    failing = (ollama_stub, (latency, args.token_ms / 1000, args.tokens, 64, 0.0,
+                             None if args.failure == 'none' else args.failure))
+    with StubProcess({'healthy': healthy, 'failing': failing}) as stubs:
+        result = asyncio.run(run(args, stubs.urls))
+
+    print(f"{args.requests} requests, {args.concurrency} concurrent, failing host: {args.failure}, "
+          f"read timeout {args.read_timeout:.1f}s")
+    print(f"  {result['answered']} answered, {result['errors']} errors in {result['elapsed']:.2f}s, "
+          f"p50 {result['p50'] * 1000:.0f}ms, p99 {result['p99'] * 1000:.0f}ms")
+    for backend in result['backends']:
+        print(f"  {backend['host']:8s} failures {backend['failures']:3d}  healthy {backend['healthy']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""Chat messages through sharding.py's supervisor and worker processes.
+
+Telegram and Ollama are local stubs in a child process. The supervisor starts
+its workers, each running the Application of main.py, and routes synthetic
+text messages to them by chat, in rounds of one message to every chat; a chat
+counts as answered once the Telegram stub has received a reply to it. With --kill-after,
+worker 0 is killed after that many seconds, to watch its chats move to the
+other workers and, with a short --sticky, come back once it is restarted.
+Chats whose updates it held when it died stay unanswered and are reported as
+lost.
+
+    python benchmarks/bench_sharding.py --workers 4 --chats 2000
+    python benchmarks/bench_sharding.py --workers 4 --messages 10 --round-interval 0.5 --kill-after 2 --sticky 1
+"""
+import argparse
+import asyncio
+import collections
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.stubs import StubProcess, ollama_stub, telegram_stub  # noqa: E402
+
+
+async def run(args, telegram_url):
+    import httpx
+    from telegram import Update
+    from sharding import ShardSupervisor
+
+    supervisor = ShardSupervisor(workers=args.workers, sticky=args.sticky, restart_delay=0.5)
+    started = time.perf_counter()
+    await supervisor.start()
+    startup = time.perf_counter() - started
+
+    if args.kill_after is not None:
+        asyncio.get_running_loop().call_later(args.kill_after, supervisor.workers[0].process.kill)
+
+    started = time.perf_counter()
+    update_id = 0
+    for n in range(args.messages):
+        for chat_id in range(1, args.chats + 1):
+            update_id += 1
+            supervisor.route(Update.de_json({
+                'update_id': update_id,
+                'message': {
+                    'message_id': n + 1,
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'},
+                    'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Bench'},
+                    'text': f"Question number {n} of chat {chat_id}?",
+                },
+            }, None))
+        # Let the writers and the workers run between the rounds
+        await asyncio.sleep(args.round_interval)
+    routed = time.perf_counter() - started
+
+    # Done when every chat is answered, or nothing more arrives for a few seconds
+    done = 0
+    progress = time.monotonic()
+    async with httpx.AsyncClient() as client:
+        while done < args.chats and time.monotonic() - progress < args.idle:
+            await asyncio.sleep(0.2)
+            answered = (await client.get(f"{telegram_url}/stats")).json()['chats']
+            if answered > done:
+                done = answered
+                progress = time.monotonic()
+    elapsed = (time.perf_counter() - started) - (time.monotonic() - progress if done < args.chats else 0)
+
+    per_worker = collections.Counter(worker.index for worker, _ in supervisor._affinity.values())
+    await supervisor.stop()
+    return {
+        'startup': startup,
+        'routed': routed,
+        'elapsed': elapsed,
+        'answered': done,
+        'per_worker': [per_worker[index] for index in range(args.workers)],
+        'restarts': sum(max(worker.failures, 0) for worker in supervisor.workers),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--chats', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=2, help="messages per chat")
+    parser.add_argument('--latency-ms', type=float, default=20, help="added to every stub response")
+    parser.add_argument('--ollama-tokens', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help="OLLAMA_MAX_CONCURRENCY, generations in flight over all workers")
+    parser.add_argument('--round-interval', type=float, default=0.0,
+                        help="seconds between the rounds of one message to every chat")
+    parser.add_argument('--sticky', type=float, default=300, help="SHARD_STICKY of the supervisor")
+    parser.add_argument('--kill-after', type=float, help="seconds after which worker 0 is killed")
+    parser.add_argument('--idle', type=float, default=5, help="seconds without a new answer before giving up")
+    args = parser.parse_args()
+
+    latency = args.latency_ms / 1000
+    with StubProcess({'telegram': (telegram_stub, (latency,)),
+                      'ollama': (ollama_stub, (latency, 0.0, args.ollama_tokens))}) as stubs:
+        os.environ.update({
+            'API_KEY': 'stub-token',
+            'TELEGRAM_API_URL': stubs.urls['telegram'],
+            'OLLAMA_HOST': stubs.urls['ollama'],
+            'OLLAMA_HOSTS': stubs.urls['ollama'],
+            'OLLAMA_QUEUE_SIZE': str(args.chats * args.messages),
+            'OLLAMA_MAX_CONCURRENCY': str(args.concurrency),
+            'MEMORY_DB': '',
+            'RESPONSE_CACHE': '0',
+            # One complete reply per chat, sent when it is ready
+            'STREAM_REPLIES': '0',
+            'COALESCE_WINDOW': '0.05',
+            'METRICS_PORT': '0',
+        })
+        result = asyncio.run(run(args, stubs.urls['telegram']))
+
+    print(f"{args.workers} workers, {args.chats} chats x {args.messages} messages, "
+          f"{args.latency_ms:.0f}ms stub latency")
+    print(f"  workers ready in {result['startup']:.2f}s, updates routed in {result['routed']:.2f}s")
+    print(f"  {result['answered']}/{args.chats} chats answered in {result['elapsed']:.2f}s, "
+          f"{result['answered'] / result['elapsed']:.0f} chats/s")
+    print(f"  chats pinned per worker: {result['per_worker']}")
+    if args.kill_after is not None:
+        print(f"  worker 0 killed after {args.kill_after:.1f}s, {result['restarts']} restarts, "
+              f"{args.chats - result['answered']} chats never answered")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Cycles of tweet_pipeline.py over many bindings.
+
+Bindings are written to a fresh SQLite store, some accounts linked to several
+chats, and Twitter and Telegram are local stubs in a child process. The first
+cycle delivers TWEET_BACKFILL tweets per account, the second finds nothing new
+past the checkpoints and shows the cost of a steady-state poll. Telegram's
+limits are lifted, the stub has none, so the numbers are our own throughput.
+
+    python benchmarks/bench_tweet_pipeline.py --bindings 10000 --accounts 8000
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.stubs import StubProcess, telegram_stub, twitter_stub  # noqa: E402
+
+
+async def cycles(args):
+    from binding_store import SQLiteBindingStore
+    from telegram_sender import TelegramSender
+    from tweet_pipeline import CheckpointStore, TweetPipeline
+
+    store = SQLiteBindingStore(os.environ['BINDING_DB'])
+    # Concurrent upserts share group commits
+    with concurrent.futures.ThreadPoolExecutor(64) as pool:
+        list(pool.map(store.upsert, ({
+            'chat_id': chat_id,
+            'twitter_handle': f"user_{chat_id % args.accounts}",
+            'twitter_id': str(chat_id % args.accounts),
+            'access_token': f"token-{chat_id % args.accounts}",
+        } for chat_id in range(1, args.bindings + 1))))
+
+    sender = TelegramSender('stub-token', max_connections=args.concurrency)
+    await sender.start()
+    pipeline = TweetPipeline(store, sender, CheckpointStore(os.environ['TWEET_CHECKPOINT_DB']),
+                             concurrency=args.concurrency, backfill=args.backfill)
+    try:
+        return [await pipeline.run_once() for _ in range(2)]
+    finally:
+        await pipeline.close()
+        await sender.stop()
+        store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bindings', type=int, default=10000)
+    parser.add_argument('--accounts', type=int, default=8000, help="distinct Twitter accounts among the bindings")
+    parser.add_argument('--backfill', type=int, default=3, help="tweets delivered per new account")
+    parser.add_argument('--concurrency', type=int, default=32, help="timeline fetches in flight")
+    parser.add_argument('--rate', type=float, default=1000, help="Twitter requests per second")
+    parser.add_argument('--latency-ms', type=float, default=20, help="added to every stub response")
+    args = parser.parse_args()
+
+    latency = args.latency_ms / 1000
+    with tempfile.TemporaryDirectory() as workdir, \
+            StubProcess({'twitter': (twitter_stub, (latency,)), 'telegram': (telegram_stub, (latency,))}) as stubs:
+        os.environ.update({
+            'TWITTER_API_URL': stubs.urls['twitter'],
+            'TELEGRAM_API_URL': stubs.urls['telegram'],
+            'TELEGRAM_GLOBAL_RATE': '100000',
+            'TELEGRAM_CHAT_INTERVAL': '0',
+            'TWITTER_REQUEST_RATE': str(args.rate),
+            'BINDING_DB': os.path.join(workdir, 'users.db'),
+            'TWEET_CHECKPOINT_DB': os.path.join(workdir, 'tweets.db'),
+        })
+        results = asyncio.run(cycles(args))
+
+    print(f"{args.bindings} bindings of {args.accounts} accounts, {args.concurrency} fetches in flight, "
+          f"{args.latency_ms:.0f}ms stub latency")
+    for name, stats in zip(('first cycle', 'second cycle'), results):
+        print(f"  {name:13s} {stats['seconds']:7.2f}s  {stats['requests'] / stats['seconds']:7.0f} fetches/s  "
+              f"{stats['tweets']:6d} tweets  {stats['unique_tweets']:5d} formatted  {stats['sent']:6d} sent  "
+              f"{stats['failed'] + stats['failed_accounts']} failed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,401 @@
+"""End-to-end load test of the web apps and the chat bot against local stubs.
+
+Telegram, Twitter, Google, DynamoDB and Ollama are replaced by the stubs in
+benchmarks/stubs.py, each with a configurable latency, and every scenario is
+driven through its real entry point at a fixed concurrency:
+
+* twitter_callback  ``app.callback`` through the Flask test client
+* google_callback   ``tg_google_oauth.oauth_callback`` through the Flask test client
+* asgi_twitter_callback, asgi_google_callback
+                    the same callbacks of asgi_app.py, as concurrent requests on
+                    one event loop
+* lambda_callback   ``lambda_handler`` of app-lambda.py
+* ai_chat           ``main.ai_chat``, from the message to the delivered answer
+
+Each request uses a chat of its own. Results are throughput and latency
+percentiles per scenario; they can be saved as a baseline and later runs
+compared against it.
+
+    python benchmarks/run.py --concurrency 16 --requests 400
+    python benchmarks/run.py ai_chat --ollama-token-ms 20 --ollama-tokens 100
+    python benchmarks/run.py --save baseline
+    python benchmarks/run.py --compare baseline
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import importlib.util
+import itertools
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINES = os.path.join(ROOT, 'benchmarks', 'baselines')
+sys.path.insert(0, ROOT)
+
+from benchmarks.stubs import (  # noqa: E402
+    StubProcess, dynamodb_stub, google_stub, ollama_stub, telegram_stub, twitter_stub,
+)
+
+TOKEN = 'stub-token'
+SCENARIOS = ('twitter_callback', 'google_callback', 'asgi_twitter_callback', 'asgi_google_callback',
+             'lambda_callback', 'ai_chat')
+
+# Every request binds or talks in a chat of its own, so no per-chat limit applies
+_chat_ids = itertools.count(1000)
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(q * (len(samples) - 1))))]
+
+
+def summarize(latencies, errors, elapsed, concurrency):
+    requests = len(latencies) + errors
+    latencies = [s * 1000 for s in latencies] or [0.0]
+    return {
+        'requests': requests,
+        'errors': errors,
+        'concurrency': concurrency,
+        'throughput': requests / elapsed,
+        'p50': percentile(latencies, 0.5),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'max': max(latencies),
+    }
+
+
+def run_threads(request, args):
+    """Call ``request()`` ``args.requests`` times from ``args.concurrency`` threads.
+
+    ``request`` returns True on success. ``args.warmup`` requests are made and
+    discarded first, so lazy initialisation isn't measured.
+    """
+    if args.warmup:
+        _run_threads(request, args.warmup, args.concurrency)
+    return _run_threads(request, args.requests, args.concurrency)
+
+
+def _run_threads(request, requests, concurrency):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    remaining = itertools.count(requests, -1)
+
+    def worker():
+        nonlocal errors
+        while next(remaining) > 0:
+            started = time.perf_counter()
+            try:
+                ok = request()
+            except Exception:
+                ok = False
+            latency = time.perf_counter() - started
+            with lock:
+                if ok:
+                    latencies.append(latency)
+                else:
+                    errors += 1
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        for future in [pool.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    return summarize(latencies, errors, time.perf_counter() - started, concurrency)
+
+
+def flask_request(app, path):
+    # Test clients keep state, so one per thread
+    local = threading.local()
+
+    def request():
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        return client.get(path()).status_code == 200
+    return request
+
+
+async def run_tasks(request, args):
+    """Await ``request()`` ``args.requests`` times from ``args.concurrency`` tasks, after a warmup,
+    like ``run_threads``."""
+    async def run(requests):
+        latencies = []
+        errors = 0
+        remaining = itertools.count(requests, -1)
+
+        async def worker():
+            nonlocal errors
+            while next(remaining) > 0:
+                started = time.perf_counter()
+                try:
+                    ok = await request()
+                except Exception:
+                    ok = False
+                if ok:
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        return summarize(latencies, errors, time.perf_counter() - started, args.concurrency)
+
+    if args.warmup:
+        await run(args.warmup)
+    return await run(args.requests)
+
+
+def asgi_request(path):
+    """Run the scenario against asgi_app.py, with its lifespan, through an in-process transport."""
+    import httpx
+    import asgi_app
+
+    async def scenario(args):
+        async with asgi_app.lifespan(asgi_app.app), \
+                httpx.AsyncClient(transport=httpx.ASGITransport(asgi_app.app), base_url='http://asgi') as client:
+            async def request():
+                return (await client.get(path())).status_code == 200
+            return await run_tasks(request, args)
+    return scenario
+
+
+def twitter_callback(args):
+    import app
+    return run_threads(flask_request(app.app, lambda: f"/callback?state={next(_chat_ids)}&code=stub-code"), args)
+
+
+def google_callback(args):
+    import tg_google_oauth
+
+    def path():
+        state = tg_google_oauth.user_sessions.issue({'telegram_id': next(_chat_ids)})
+        return f"/oauth/callback?state={state}&code=stub-code"
+    return run_threads(flask_request(tg_google_oauth.app, path), args)
+
+
+def asgi_twitter_callback(args):
+    scenario = asgi_request(lambda: f"/callback?state={next(_chat_ids)}&code=stub-code")
+    return asyncio.run(scenario(args))
+
+
+def asgi_google_callback(args):
+    import asgi_app
+
+    def path():
+        state = asgi_app.user_sessions.issue({'telegram_id': next(_chat_ids)})
+        return f"/oauth/callback?state={state}&code=stub-code"
+    return asyncio.run(asgi_request(path)(args))
+
+
+def lambda_callback(args):
+    spec = importlib.util.spec_from_file_location('app_lambda', os.path.join(ROOT, 'app-lambda.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    def request():
+        event = {'path': '/callback', 'queryStringParameters': {'state': str(next(_chat_ids)), 'code': 'stub-code'}}
+        return module.lambda_handler(event, None)['statusCode'] == 200
+    return run_threads(request, args)
+
+
+def ai_chat(args):
+    return asyncio.run(_ai_chat(args))
+
+
+async def _ai_chat(args):
+    import main
+    from telegram import Bot, Update
+
+    bot = Bot(TOKEN, base_url=f"{os.environ['TELEGRAM_API_URL']}/bot")
+    await bot.initialize()
+    await main.post_init(None)
+
+    # An answer is complete once it has been delivered and recorded
+    answered = {}
+    record = main.coalescer.finish
+
+    async def finish(update, text, answer):
+        await record(update, text, answer)
+        future = answered.pop(update.effective_chat.id, None)
+        if future is not None:
+            future.set_result(None)
+    main.coalescer.finish = finish
+
+    latencies = []
+    errors = 0
+    loop = asyncio.get_running_loop()
+
+    async def worker(remaining):
+        nonlocal errors
+        while next(remaining) > 0:
+            chat_id = next(_chat_ids)
+            update = Update.de_json({
+                'update_id': chat_id,
+                'message': {
+                    'message_id': 1,
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'},
+                    'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Bench'},
+                    'text': f"Question number {chat_id % args.questions if args.questions else chat_id}?",
+                },
+            }, bot)
+            answered[chat_id] = loop.create_future()
+            started = time.perf_counter()
+            try:
+                await main.ai_chat(update, None)
+                await asyncio.wait_for(answered[chat_id], 120)
+            except Exception:
+                answered.pop(chat_id, None)
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - started)
+
+    async def run(requests):
+        remaining = itertools.count(requests, -1)
+        await asyncio.gather(*(worker(remaining) for _ in range(args.concurrency)))
+
+    try:
+        if args.warmup:
+            await run(args.warmup)
+            latencies.clear()
+            errors = 0
+        started = time.perf_counter()
+        await run(args.requests)
+        return summarize(latencies, errors, time.perf_counter() - started, args.concurrency)
+    finally:
+        main.coalescer.finish = record
+        await main.post_shutdown(None)
+        await bot.shutdown()
+
+
+def configure(urls, workdir, args):
+    """Point every module at the stubs. Must run before any of them is imported."""
+    os.environ.update({
+        'API_KEY': TOKEN,
+        'TELEGRAM_BOT_TOKEN': TOKEN,
+        'TELEGRAM_API_URL': urls['telegram'],
+        'TWITTER_API_URL': urls['twitter'],
+        'TWITTER_CLIENT_ID': 'stub-client',
+        'TWITTER_CLIENT_SECRET': 'stub-secret',
+        'TWITTER_CALLBACK_URL': 'http://127.0.0.1/callback',
+        'GOOGLE_TOKEN_URL': f"{urls['google']}/token",
+        'GOOGLE_USERINFO_URL': f"{urls['google']}/oauth2/v1/userinfo",
+        'GOOGLE_CLIENT_ID': 'stub-client',
+        'GOOGLE_CLIENT_SECRET': 'stub-secret',
+        'AWS_ENDPOINT_URL_DYNAMODB': urls['dynamodb'],
+        'AWS_ACCESS_KEY_ID': 'stub',
+        'AWS_SECRET_ACCESS_KEY': 'stub',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'BINDING_STORE': 'sqlite',
+        'BINDING_DB': os.path.join(workdir, 'users.db'),
+        # Issued and consumed in this process, but asgi_app.py only starts with the shared store
+        'OAUTH_STATE_DB': os.path.join(workdir, 'oauth_state.db'),
+        'OLLAMA_HOST': urls['ollama'],
+        'OLLAMA_HOSTS': urls['ollama'],
+        'MEMORY_DB': '',
+        'COALESCE_WINDOW': str(args.coalesce_window),
+        'RESPONSE_CACHE': '1' if args.response_cache else '0',
+        'BOT_MODE': 'polling',
+        # The apps log every request at INFO
+        'LOG_LEVEL': 'WARNING',
+    })
+
+
+def compare(results, baseline, tolerance):
+    """Print the change against ``baseline``. Returns False if anything regressed."""
+    ok = True
+    for name, result in results.items():
+        before = baseline.get('results', {}).get(name)
+        if before is None:
+            continue
+        # p99 of a few hundred samples is too noisy to fail on, it is only shown
+        for metric, worse_if_higher in (('throughput', False), ('p50', True), ('p95', True), ('p99', None)):
+            change = (result[metric] - before[metric]) / before[metric] if before[metric] else 0.0
+            if worse_if_higher is None:
+                regressed = False
+            else:
+                regressed = change > tolerance if worse_if_higher else change < -tolerance
+            ok = ok and not regressed
+            flag = '  REGRESSION' if regressed else ''
+            print(f"  {name:18s} {metric:10s} {before[metric]:10.2f} -> {result[metric]:10.2f}  {change:+7.1%}{flag}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help=f"any of {', '.join(SCENARIOS)}, default all")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=400, help="requests per scenario")
+    parser.add_argument('--warmup', type=int, default=None,
+                        help="unmeasured requests per scenario first, default the concurrency")
+    parser.add_argument('--latency-ms', type=float, default=20,
+                        help="response time of the Telegram, Twitter, Google and DynamoDB stubs")
+    parser.add_argument('--ollama-ttft-ms', type=float, default=200, help="time to the first token")
+    parser.add_argument('--ollama-token-ms', type=float, default=10, help="time between tokens")
+    parser.add_argument('--ollama-tokens', type=int, default=50, help="tokens per answer")
+    parser.add_argument('--ollama-thinking', type=float, default=0.0,
+                        help="share of the tokens that are a <think> block, like deepseek-r1")
+    parser.add_argument('--coalesce-window', type=float, default=0.0,
+                        help="debounce of the chat bot, off by default as it is deliberate delay")
+    parser.add_argument('--response-cache', action='store_true', help="enable the semantic response cache")
+    parser.add_argument('--questions', type=int, default=0,
+                        help="ai_chat asks only this many distinct questions, 0 for a new one every request")
+    parser.add_argument('--save', metavar='NAME', help="save the results as benchmarks/baselines/NAME.json")
+    parser.add_argument('--compare', metavar='NAME', help="compare with benchmarks/baselines/NAME.json")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="relative change of a metric that counts as a regression")
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name!r}")
+    args.scenarios = args.scenarios or list(SCENARIOS)
+    if args.warmup is None:
+        args.warmup = args.concurrency
+
+    latency = args.latency_ms / 1000
+    stubs = StubProcess({
+        'telegram': (telegram_stub, (latency,)),
+        'twitter': (twitter_stub, (latency,)),
+        'google': (google_stub, (latency,)),
+        'dynamodb': (dynamodb_stub, (latency,)),
+        'ollama': (ollama_stub, (args.ollama_ttft_ms / 1000, args.ollama_token_ms / 1000, args.ollama_tokens,
+                                 64, args.ollama_thinking)),
+    })
+    results = {}
+    with stubs, tempfile.TemporaryDirectory() as workdir:
+        configure(stubs.urls, workdir, args)
+        import background
+        import telegram_sender
+        scenarios = globals()
+        for name in args.scenarios:
+            results[name] = scenarios[name](args)
+            # Finish what the callbacks left for after their answer before the stubs go away
+            background.get_tasks().join(60)
+            telegram_sender.shutdown(30)
+            result = results[name]
+            print(f"{name:18s} {result['requests']:6d} req  {result['errors']:4d} err  "
+                  f"{result['throughput']:8.1f} req/s  p50 {result['p50']:8.2f}ms  "
+                  f"p95 {result['p95']:8.2f}ms  p99 {result['p99']:8.2f}ms")
+
+    config = {key: value for key, value in vars(args).items() if key not in ('save', 'compare', 'tolerance', 'scenarios')}
+    if args.save:
+        os.makedirs(BASELINES, exist_ok=True)
+        with open(os.path.join(BASELINES, f"{args.save}.json"), 'w') as f:
+            json.dump({'config': config, 'results': results}, f, indent=2)
+    if args.compare:
+        with open(os.path.join(BASELINES, f"{args.compare}.json")) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != config:
+            print(f"Note: baseline was recorded with {baseline.get('config')}")
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+"""Local stand-ins for the external services, for benchmarks.
+
+Each stub is a threaded HTTP/1.1 server on a free localhost port with a fixed
+response per route, so measurements show our own overhead and not the internet.
+"""
+import collections
+import collections.abc
+import hashlib
+import json
+import multiprocessing
+import random
+import socket
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 drops connections under load, which costs a 1s SYN retry
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # Clients killed or timed out mid-request are part of some benchmarks
+        pass
+
+
+class StubServer:
+    """Serve ``routes``, a dict of ``(method, path suffix) -> handler(request, body)``.
+
+    A handler returns ``(status, json_body)`` or ``(status, json_body,
+    headers)``. A body that is an iterator is streamed as newline delimited
+    JSON, one chunk per item, the way Ollama streams. ``latency`` seconds are
+    added before every response starts.
+    """
+
+    def __init__(self, routes, latency=0.0, content_type='application/json'):
+        self.routes = routes
+        self.latency = latency
+        self.content_type = content_type
+        self.requests = 0
+        self._server = _Server(('127.0.0.1', 0), self._handler_class())
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _route(self, method, path):
+        path = path.split('?', 1)[0]
+        for (route_method, suffix), handler in self.routes.items():
+            if route_method == method and path.endswith(suffix):
+                return handler
+        return None
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                # Headers and body are written separately, without this delayed ACKs stall keep-alive
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self, method):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                stub.requests += 1
+                handler = stub._route(method, self.path)
+                headers = {}
+                if handler is None:
+                    status, payload = 404, {'error': 'not found'}
+                else:
+                    status, payload, *rest = handler(self, body)
+                    if rest:
+                        headers = rest[0]
+                if stub.latency:
+                    time.sleep(stub.latency)
+                if isinstance(payload, collections.abc.Iterator):
+                    self._stream(status, payload)
+                    return
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', stub.content_type)
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream(self, status, items):
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                for item in items:
+                    line = json.dumps(item).encode() + b'\n'
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(line), line))
+                    self.wfile.flush()
+                self.wfile.write(b'0\r\n\r\n')
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+        return Handler
+
+
+def _serve(specs, conn):
+    stubs = {name: factory(*args) for name, (factory, args) in specs.items()}
+    for stub in stubs.values():
+        stub.start()
+    conn.send({name: stub.url for name, stub in stubs.items()})
+    # Serve until the parent closes its end
+    try:
+        conn.recv()
+    except EOFError:
+        pass
+
+
+class StubProcess:
+    """Run stubs in a child process, so they don't compete with the code under
+    test for the GIL.
+
+    ``specs`` maps a name to ``(factory, args)``, e.g. ``{'telegram':
+    (telegram_stub, (0.02,))}``; ``urls`` maps the same names to the stub URLs.
+    """
+
+    def __init__(self, specs):
+        self.specs = specs
+        self.urls = None
+        self._conn = None
+        self._process = None
+
+    def start(self):
+        # Spawned, not forked, so the child holds no copy of our end of the pipe
+        # and sees it close even when we are killed
+        context = multiprocessing.get_context('spawn')
+        self._conn, child = context.Pipe()
+        self._process = context.Process(target=_serve, args=(self.specs, child), daemon=True)
+        self._process.start()
+        child.close()
+        self.urls = self._conn.recv()
+        return self
+
+    def stop(self):
+        self._conn.close()
+        self._process.join(5)
+        if self._process.is_alive():
+            self._process.terminate()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def twitter_stub(latency=0.0, authors=50, tweets=5, follows=10):
+    """Twitter OAuth 2.0 token endpoint, users/me and home timelines.
+
+    There are ``authors`` accounts with ``tweets`` tweets each. User ``n``
+    follows ``follows`` of them starting at author ``n % authors``, so users
+    whose ids are close share most of their timelines.
+    """
+    # Newest first, with increasing ids like real snowflakes
+    all_tweets = sorted(
+        ({'id': str(n * authors + author + 1), 'author_id': f"a{author}", 'text': f"Tweet {n} of author {author}",
+          'created_at': '2024-01-01T00:00:00.000Z'}
+         for author in range(authors) for n in range(tweets)),
+        key=lambda tweet: -int(tweet['id']),
+    )
+
+    def timeline(request, body):
+        path, _, query = request.path.partition('?')
+        user_id = int(path.split('/')[-3])
+        params = {key: values[-1] for key, values in urllib.parse.parse_qs(query).items()}
+        followed = {f"a{(user_id + k) % authors}" for k in range(follows)}
+        since_id = int(params.get('since_id', 0))
+        offset = int(params.get('pagination_token', 0))
+        limit = int(params.get('max_results', 100))
+        matching = [t for t in all_tweets if t['author_id'] in followed and int(t['id']) > since_id]
+        page = matching[offset:offset + limit]
+        meta = {'result_count': len(page)}
+        if page:
+            meta.update(newest_id=page[0]['id'], oldest_id=page[-1]['id'])
+        if offset + limit < len(matching):
+            meta['next_token'] = str(offset + limit)
+        users = [{'id': author, 'username': f"author_{author[1:]}"} for author in {t['author_id'] for t in page}]
+        return 200, {'data': page, 'includes': {'users': users}, 'meta': meta} if page else {'meta': meta}
+
+    return StubServer({
+        ('GET', '/timelines/reverse_chronological'): timeline,
+        ('POST', '/2/oauth2/token'): lambda request, body: (200, {
+            'token_type': 'bearer',
+            'access_token': 'stub-access-token',
+            'refresh_token': 'stub-refresh-token',
+            'expires_in': 7200,
+            'scope': 'tweet.read users.read offline.access',
+        }),
+        ('GET', '/2/users/me'): lambda request, body: (200, {
+            'data': {'id': '12345', 'name': 'Stub User', 'username': 'stub_user'},
+        }),
+    }, latency)
+
+
+def _params(request, body):
+    """Bot API parameters, sent as JSON by our sender and as a form by python-telegram-bot."""
+    if request.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+        return {key: values[-1] for key, values in urllib.parse.parse_qs(body.decode()).items()}
+    return json.loads(body or b'{}')
+
+
+def telegram_stub(latency=0.0):
+    """Bot API getMe, sendMessage and editMessageText, any token. getUpdates
+    never has any, so a polling bot can run against it too.
+
+    ``GET /stats`` reports how many messages were sent and to how many chats.
+    """
+    sent = collections.Counter()
+
+    def message(request, body):
+        payload = _params(request, body)
+        # A client killed mid-request leaves a body without chat_id
+        if request.path.split('?', 1)[0].endswith('/sendMessage') and 'chat_id' in payload:
+            sent[str(payload['chat_id'])] += 1
+        return 200, {'ok': True, 'result': {
+            'message_id': int(payload.get('message_id', 1)),
+            'date': int(time.time()),
+            'chat': {'id': payload.get('chat_id'), 'type': 'private'},
+            'text': payload.get('text', ''),
+        }}
+    return StubServer({
+        ('POST', '/getMe'): lambda request, body: (200, {'ok': True, 'result': {
+            'id': 1, 'is_bot': True, 'first_name': 'Stub', 'username': 'stub_bot',
+        }}),
+        ('POST', '/deleteWebhook'): lambda request, body: (200, {'ok': True, 'result': True}),
+        ('POST', '/getUpdates'): lambda request, body: (time.sleep(1), (200, {'ok': True, 'result': []}))[1],
+        ('POST', '/sendMessage'): message,
+        ('POST', '/editMessageText'): message,
+        ('GET', '/stats'): lambda request, body: (200, {'sent': sum(sent.values()), 'chats': len(sent)}),
+    }, latency)
+
+
+def google_stub(latency=0.0):
+    """Google OAuth 2.0 token endpoint and userinfo."""
+    return StubServer({
+        ('POST', '/token'): lambda request, body: (200, {
+            'access_token': 'stub-access-token',
+            'expires_in': 3599,
+            'token_type': 'Bearer',
+            'scope': 'email profile',
+        }),
+        ('GET', '/oauth2/v1/userinfo'): lambda request, body: (200, {
+            'id': '12345',
+            'email': 'stub@example.com',
+            'name': 'Stub User',
+        }),
+    }, latency)
+
+
+def ollama_stub(latency=0.0, token_latency=0.0, tokens=50, dimensions=64, thinking=0.0, failure=None):
+    """Ollama /api/chat, /api/generate and /api/embed.
+
+    ``latency`` stands in for loading and prefill, the time to the first token,
+    and ``token_latency`` for the time between two of the ``tokens`` tokens of an
+    answer. Like deepseek-r1, the first ``thinking`` share of the tokens is
+    reasoning inside a ``<think>`` block. Embeddings are random unit vectors
+    seeded by the input, so equal inputs are equal and different ones are far
+    apart.
+
+    A ``failure`` of ``'error'`` answers every request with a 500, ``'hang'``
+    never answers at all, like a host that is stuck loading a model.
+    """
+    def done(model, **fields):
+        return {'model': model, 'created_at': '2024-01-01T00:00:00Z', 'done': True,
+                'done_reason': 'stop', 'eval_count': tokens, **fields}
+
+    reasoning = int(tokens * thinking)
+    words = [f"token{i} " for i in range(tokens)]
+    if reasoning:
+        words[0] = '<think>' + words[0]
+        words[reasoning - 1] += '</think>\n\n'
+
+    def chat(request, body):
+        payload = json.loads(body)
+        model = payload.get('model', '')
+
+        def stream():
+            for i, word in enumerate(words):
+                if i and token_latency:
+                    time.sleep(token_latency)
+                yield {'model': model, 'created_at': '2024-01-01T00:00:00Z', 'done': False,
+                       'message': {'role': 'assistant', 'content': word}}
+            yield done(model, message={'role': 'assistant', 'content': ''})
+
+        if payload.get('stream', True):
+            return 200, stream()
+        time.sleep(token_latency * max(tokens - 1, 0))
+        content = ''.join(words)
+        return 200, done(model, message={'role': 'assistant', 'content': content})
+
+    def generate(request, body):
+        return 200, done(json.loads(body).get('model', ''), response='')
+
+    def vector(text):
+        rng = random.Random(hashlib.sha256(text.encode()).digest())
+        values = [rng.gauss(0, 1) for _ in range(dimensions)]
+        norm = sum(v * v for v in values) ** 0.5
+        return [v / norm for v in values]
+
+    def embed(request, body):
+        payload = json.loads(body)
+        inputs = payload.get('input', '')
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        return 200, {'model': payload.get('model', ''), 'embeddings': [vector(text) for text in inputs]}
+
+    routes = {
+        ('POST', '/api/chat'): chat,
+        ('POST', '/api/generate'): generate,
+        ('POST', '/api/embed'): embed,
+    }
+    if failure == 'error':
+        routes = dict.fromkeys(routes, lambda request, body: (500, {'error': 'stub failure'}))
+    elif failure == 'hang':
+        routes = dict.fromkeys(routes, lambda request, body: (time.sleep(3600), (500, {}))[1])
+    elif failure is not None:
+        raise ValueError(f"unknown failure {failure!r}")
+    return StubServer(routes, latency)
+
+
+def dynamodb_stub(latency=0.0):
+    """Enough of the DynamoDB JSON protocol for PutItem and GetItem.
+
+    Point boto3 at it with AWS_ENDPOINT_URL_DYNAMODB.
+    """
+    items = {}
+
+    def dispatch(request, body):
+        target = request.headers.get('X-Amz-Target', '').split('.')[-1]
+        payload = json.loads(body or b'{}')
+        if target == 'PutItem':
+            items[json.dumps(payload['Item'].get('chat_id'))] = payload['Item']
+            return 200, {}
+        if target == 'GetItem':
+            item = items.get(json.dumps(payload['Key'].get('chat_id')))
+            return 200, {'Item': item} if item else {}
+        return 400, {'__type': 'UnknownOperationException'}
+
+    return StubServer({('POST', '/'): dispatch}, latency, content_type='application/x-amz-json-1.0')
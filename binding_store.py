@@ -0,0 +1,300 @@
+"""Storage for Telegram chat ↔ Twitter account bindings.
+
+A binding is a dict with ``chat_id``, ``twitter_handle``, ``twitter_id``,
+``access_token``, ``refresh_token`` and ``expires_at``, the epoch second the
+access token expires. Bindings stored before the last three were added don't
+have them.
+``BindingStore`` is the interface the web apps and background jobs use, with
+two backends:
+
+* ``SQLiteBindingStore`` for the Flask app. It runs in WAL mode so reads never
+  wait for writes, stores each binding with a single ``INSERT ... ON CONFLICT``
+  statement, and commits concurrent writes together in one transaction.
+* ``DynamoBindingStore`` for the Lambda, on the TwitterTelegramBindings table.
+
+``CachedBindingStore`` puts an LRU read-through cache in front of either one
+for lookups by chat_id and by twitter_handle.
+"""
+import abc
+import collections
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+BINDING_STORE = os.getenv('BINDING_STORE', 'sqlite')
+BINDING_DB = os.getenv('BINDING_DB') or os.path.join(os.path.abspath(os.path.dirname(__file__)), 'users.db')
+DYNAMO_TABLE = os.getenv('DYNAMO_TABLE', 'TwitterTelegramBindings')
+# Global secondary index on twitter_handle, needed for lookups by handle
+DYNAMO_HANDLE_INDEX = os.getenv('DYNAMO_HANDLE_INDEX', 'twitter_handle-index')
+BINDING_CACHE_SIZE = int(os.getenv('BINDING_CACHE_SIZE', '10000'))
+# Other processes may change a binding, so cached entries are only trusted this long
+BINDING_CACHE_TTL = float(os.getenv('BINDING_CACHE_TTL', '60'))
+
+FIELDS = ('chat_id', 'twitter_handle', 'twitter_id', 'access_token', 'refresh_token', 'expires_at')
+# Columns added after the table was first created, with their definition, for older databases
+MIGRATIONS = (
+    ('twitter_id', 'VARCHAR(20)'),
+    ('refresh_token', 'VARCHAR(200)'),
+    ('expires_at', 'INTEGER'),
+)
+
+
+class BindingStore(abc.ABC):
+    @abc.abstractmethod
+    def get(self, chat_id):
+        """The binding of ``chat_id``, or None."""
+
+    @abc.abstractmethod
+    def find_by_handle(self, twitter_handle):
+        """All bindings of ``twitter_handle``, a handle can be linked to several chats."""
+
+    @abc.abstractmethod
+    def scan(self, after=None, limit=500):
+        """Up to ``limit`` bindings in a stable order, starting after the cursor ``after``.
+
+        Returns the bindings and the cursor of the next page, None after the last one.
+        """
+
+    def pages(self, page_size=500):
+        """Every binding, a page at a time, for background jobs that visit them all."""
+        after = None
+        while True:
+            bindings, after = self.scan(after, page_size)
+            if bindings:
+                yield bindings
+            if after is None:
+                return
+
+    @abc.abstractmethod
+    def upsert(self, binding):
+        """Create or replace the binding of ``binding['chat_id']``.
+
+        Returns once the write is durable.
+        """
+
+    def close(self):
+        pass
+
+
+class _Write:
+    __slots__ = ('row', 'done', 'error')
+
+    def __init__(self, row):
+        self.row = row
+        self.done = threading.Event()
+        self.error = None
+
+
+class SQLiteBindingStore(BindingStore):
+    # Same table the Flask-SQLAlchemy ``User`` model used, so existing databases keep working
+    TABLE = '"user"'
+
+    def __init__(self, path=BINDING_DB, batch_size=100):
+        self.path = path
+        self.batch_size = batch_size
+        self._local = threading.local()
+        self._writes = queue.Queue()
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.TABLE} ("
+            "id INTEGER PRIMARY KEY, "
+            "chat_id VARCHAR(20) NOT NULL UNIQUE, "
+            "twitter_handle VARCHAR(100) NOT NULL, "
+            "access_token VARCHAR(200) NOT NULL)"
+        )
+        columns = {row['name'] for row in conn.execute(f"PRAGMA table_info({self.TABLE})")}
+        for column, definition in MIGRATIONS:
+            if column not in columns:
+                conn.execute(f"ALTER TABLE {self.TABLE} ADD COLUMN {column} {definition}")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS ix_user_twitter_handle ON {self.TABLE} (twitter_handle)")
+        conn.commit()
+        self._writer = threading.Thread(target=self._write_loop, name='binding-writer', daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        # One connection per thread; sqlite3 connections must not be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            # With WAL, NORMAL only syncs at checkpoints and is still safe against corruption
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, chat_id):
+        row = self._connect().execute(
+            f"SELECT {', '.join(FIELDS)} FROM {self.TABLE} WHERE chat_id = ?", (str(chat_id),)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def find_by_handle(self, twitter_handle):
+        rows = self._connect().execute(
+            f"SELECT {', '.join(FIELDS)} FROM {self.TABLE} WHERE twitter_handle = ?", (twitter_handle,)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def scan(self, after=None, limit=500):
+        # Keyset pagination on the rowid, every page is an index range scan however deep it is
+        rows = self._connect().execute(
+            f"SELECT id, {', '.join(FIELDS)} FROM {self.TABLE} WHERE id > ? ORDER BY id LIMIT ?",
+            (after or 0, limit),
+        ).fetchall()
+        bindings = [{field: row[field] for field in FIELDS} for row in rows]
+        return bindings, rows[-1]['id'] if len(rows) == limit else None
+
+    def upsert(self, binding):
+        write = _Write(tuple(str(binding[f]) if f == 'chat_id' else binding.get(f) for f in FIELDS))
+        self._writes.put(write)
+        write.done.wait()
+        if write.error is not None:
+            raise write.error
+
+    def close(self):
+        self._writes.put(None)
+        self._writer.join()
+
+    def _write_loop(self):
+        conn = self._connect()
+        statement = (
+            f"INSERT INTO {self.TABLE} ({', '.join(FIELDS)}) VALUES ({', '.join('?' * len(FIELDS))}) "
+            "ON CONFLICT(chat_id) DO UPDATE SET "
+            + ', '.join(f"{field} = excluded.{field}" for field in FIELDS if field != 'chat_id')
+        )
+        while True:
+            write = self._writes.get()
+            if write is None:
+                return
+            # Group commit: everything that queued up while the last commit ran goes in one transaction
+            batch = [write]
+            while len(batch) < self.batch_size:
+                try:
+                    write = self._writes.get_nowait()
+                except queue.Empty:
+                    break
+                if write is None:
+                    self._writes.put(None)
+                    break
+                batch.append(write)
+            try:
+                with conn:
+                    conn.executemany(statement, [write.row for write in batch])
+            except Exception as e:
+                logger.exception("Failed to store %d bindings", len(batch))
+                for write in batch:
+                    write.error = e
+            for write in batch:
+                write.done.set()
+
+
+class DynamoBindingStore(BindingStore):
+    def __init__(self, table_name=DYNAMO_TABLE, handle_index=DYNAMO_HANDLE_INDEX):
+        self.table_name = table_name
+        self.handle_index = handle_index
+        self._table = None
+        self._table_lock = threading.Lock()
+
+    @property
+    def table(self):
+        # boto3 is slow to import and the resource slow to build, only pay for it when used,
+        # and only once when the first requests arrive together
+        if self._table is None:
+            with self._table_lock:
+                if self._table is None:
+                    import boto3
+                    self._table = boto3.resource('dynamodb').Table(self.table_name)
+        return self._table
+
+    def get(self, chat_id):
+        return self.table.get_item(Key={'chat_id': str(chat_id)}).get('Item')
+
+    def find_by_handle(self, twitter_handle):
+        from boto3.dynamodb.conditions import Key
+        response = self.table.query(
+            IndexName=self.handle_index,
+            KeyConditionExpression=Key('twitter_handle').eq(twitter_handle),
+        )
+        return response.get('Items', [])
+
+    def scan(self, after=None, limit=500):
+        kwargs = {'Limit': limit}
+        if after is not None:
+            kwargs['ExclusiveStartKey'] = after
+        response = self.table.scan(**kwargs)
+        return response.get('Items', []), response.get('LastEvaluatedKey')
+
+    def upsert(self, binding):
+        # put_item replaces the whole item, so it is already a single-request upsert. Fields not known
+        # yet are left out, an index key like twitter_handle can't be empty
+        item = {key: value for key, value in binding.items() if value not in (None, '')}
+        self.table.put_item(Item={**item, 'chat_id': str(binding['chat_id'])})
+
+
+class CachedBindingStore(BindingStore):
+    def __init__(self, store, size=BINDING_CACHE_SIZE, ttl=BINDING_CACHE_TTL):
+        self.store = store
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (expires_at, value), least recently used first
+        self._by_chat = collections.OrderedDict()
+        self._by_handle = collections.OrderedDict()
+
+    def get(self, chat_id):
+        chat_id = str(chat_id)
+        return self._cached(self._by_chat, chat_id, lambda: self.store.get(chat_id))
+
+    def find_by_handle(self, twitter_handle):
+        return self._cached(self._by_handle, twitter_handle, lambda: self.store.find_by_handle(twitter_handle))
+
+    def scan(self, after=None, limit=500):
+        # Pages go straight to the store, a full pass would only evict the hot entries
+        return self.store.scan(after, limit)
+
+    def upsert(self, binding):
+        chat_id = str(binding['chat_id'])
+        self.store.upsert(binding)
+        with self._lock:
+            old = self._by_chat.get(chat_id)
+            if old is not None and old[1] is not None:
+                self._by_handle.pop(old[1].get('twitter_handle'), None)
+            self._by_handle.pop(binding.get('twitter_handle'), None)
+            self._put(self._by_chat, chat_id, {**binding, 'chat_id': chat_id})
+
+    def close(self):
+        self.store.close()
+
+    def _cached(self, cache, key, load):
+        now = time.monotonic()
+        with self._lock:
+            entry = cache.get(key)
+            if entry is not None and entry[0] > now:
+                cache.move_to_end(key)
+                return entry[1]
+        value = load()
+        with self._lock:
+            self._put(cache, key, value)
+        return value
+
+    def _put(self, cache, key, value):
+        cache[key] = (time.monotonic() + self.ttl, value)
+        cache.move_to_end(key)
+        while len(cache) > self.size:
+            cache.popitem(last=False)
+
+
+def create_store(backend=BINDING_STORE):
+    """The configured backend behind a read-through cache."""
+    if backend == 'dynamodb':
+        store = DynamoBindingStore()
+    elif backend == 'sqlite':
+        store = SQLiteBindingStore()
+    else:
+        raise ValueError(f"Unknown BINDING_STORE {backend!r}")
+    return CachedBindingStore(store)
@@ -0,0 +1,168 @@
+"""Merge bursts of chat messages and drop answers nobody will read.
+
+Messages of one chat that arrive within COALESCE_WINDOW seconds of each other
+are joined into one prompt, so three short messages in a row cost one
+generation instead of three. When a new message arrives while an answer for
+the same chat is still being generated, the chat's mode decides what happens:
+
+* ``cancel`` stops the running generation and answers its messages together
+  with the new ones
+* ``queue`` lets it finish and answers the new messages afterwards
+"""
+import asyncio
+import logging
+import os
+
+from inference import QueueFull
+from memory import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+COALESCE_WINDOW = float(os.getenv('COALESCE_WINDOW', '0.8'))
+SUPERSEDE_MODE = os.getenv('SUPERSEDE_MODE', 'cancel')
+MODES = ('cancel', 'queue')
+
+
+class _ChatState:
+    __slots__ = ('pending', 'timer', 'running', 'running_updates', 'lookup', 'flushing')
+
+    def __init__(self):
+        # Updates waiting for the debounce window to close
+        self.pending = []
+        self.timer = None
+        # Engine job answering running_updates; running_updates is emptied as soon
+        # as the answer has been delivered, after that the job can't be superseded
+        self.running = None
+        self.running_updates = []
+        # Set while a burst is looked up in the cache, later bursts wait for it
+        self.lookup = None
+        # Bursts past the debounce window and not answered yet
+        self.flushing = 0
+
+
+class ChatCoalescer:
+    def __init__(self, engine, handler, finish=None, window=COALESCE_WINDOW, default_mode=SUPERSEDE_MODE,
+                 cached=None):
+        """``handler(update, text)`` answers ``text`` by replying to ``update``, the
+        last message of the burst, and returns the answer. ``finish(update, text,
+        answer)`` does any bookkeeping after delivery and is never cancelled by a new
+        message. Both run in one job on ``engine``.
+
+        ``cached(update, text)``, if given, is tried first when the chat has no job
+        queued or running, without taking an engine worker: it replies with an
+        answer it already has and returns it, or returns None and the burst is
+        queued for ``handler``. A message the engine would refuse is refused
+        before the lookup."""
+        self.engine = engine
+        self.handler = handler
+        self.finish = finish
+        self.cached = cached
+        self.window = window
+        self.default_mode = default_mode
+        self._chats = {}
+        self._modes = {}
+
+    def mode(self, chat_id):
+        return self._modes.get(chat_id, self.default_mode)
+
+    def set_mode(self, chat_id, mode):
+        if mode not in MODES:
+            raise ValueError(f"unknown mode {mode!r}")
+        self._modes[chat_id] = mode
+
+    def add(self, update):
+        chat_id = update.effective_chat.id
+        state = self._chats.setdefault(chat_id, _ChatState())
+        state.pending.append(update)
+
+        if self.mode(chat_id) == 'cancel' and state.running_updates and not state.running.done():
+            logger.info("Cancelling superseded generation in chat %s", chat_id)
+            state.running.cancel()
+            # Their answer was cut off, so ask again together with the new messages
+            state.pending[:0] = state.running_updates
+            state.running = None
+            state.running_updates = []
+
+        if state.timer is not None:
+            state.timer.cancel()
+        state.timer = asyncio.create_task(self._flush_later(chat_id, state))
+
+    async def _flush_later(self, chat_id, state):
+        await asyncio.sleep(self.window)
+        state.timer = None
+        updates, state.pending = state.pending, []
+        state.flushing += 1
+        try:
+            await self._flush(chat_id, state, updates)
+        finally:
+            state.flushing -= 1
+            self._forget(chat_id, state)
+
+    async def _flush(self, chat_id, state, updates):
+        last = updates[-1]
+        text = "\n".join(update.message.text for update in updates)
+
+        # An answer from the cache must not overtake an earlier burst of the chat
+        while state.lookup is not None:
+            await state.lookup.wait()
+        try:
+            if self.cached is not None and not self.engine.busy(chat_id):
+                # Refused like a queued job would be, before the lookup costs an embedding
+                self.engine.admit()
+                if await self._from_cache(chat_id, state, last, text):
+                    return
+            # Shared fairly between users, a group chat counts against whoever wrote last
+            user = last.effective_user
+            future = self.engine.submit(chat_id, self._answer, state, updates, text,
+                                        user_id=user.id if user is not None else None,
+                                        prompt_tokens=estimate_tokens(text))
+        except QueueFull:
+            await last.message.reply_text("⏳ I'm busy right now, please try again in a moment.")
+            return
+
+        state.running = future
+        state.running_updates = updates
+        try:
+            await future
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                raise
+        except Exception:
+            logger.exception("Failed to answer chat %s", chat_id)
+        finally:
+            if state.running is future:
+                state.running = None
+                state.running_updates = []
+
+    async def _from_cache(self, chat_id, state, update, text):
+        """Answer ``text`` with ``cached`` if it has an answer. Returns whether it did.
+        Later bursts of the chat wait until it is answered and recorded, or missed."""
+        lookup = state.lookup = asyncio.Event()
+        try:
+            try:
+                result = await self.cached(update, text)
+            except Exception:
+                logger.exception("Cache lookup failed in chat %s", chat_id)
+                return False
+            if result is None:
+                return False
+            try:
+                if self.finish is not None:
+                    await self.finish(update, text, result)
+            except Exception:
+                logger.exception("Failed to answer chat %s", chat_id)
+            return True
+        finally:
+            state.lookup = None
+            lookup.set()
+
+    async def _answer(self, state, updates, text):
+        result = await self.handler(updates[-1], text)
+        if state.running_updates is updates:
+            state.running_updates = []
+        if self.finish is not None:
+            await self.finish(updates[-1], text, result)
+
+    def _forget(self, chat_id, state):
+        if not state.pending and state.timer is None and state.running is None and not state.flushing:
+            self._chats.pop(chat_id, None)
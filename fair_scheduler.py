@@ -0,0 +1,202 @@
+"""Decides which chat the inference engine answers next, fairly between users.
+
+The engine keeps the jobs of each chat in order; this scheduler orders the
+chats that have a job ready. It is start-time fair queuing over Telegram
+users: every user has a virtual finish time that advances by the tokens their
+jobs use divided by their weight, and the ready job whose user is furthest
+behind runs first. A user sending long prompts or many messages pushes only
+their own jobs back, so everyone else keeps getting answers at their share of
+the Ollama capacity however much one user sends.
+
+A job reserves its prompt plus FAIR_COMPLETION_ESTIMATE tokens when it is
+queued and is charged what Ollama actually reports once it is done. The same
+counts go into a sliding window of FAIR_BUDGET_WINDOW seconds per user. Jobs
+wait in one of three lanes, served strictly in this order, and fairly within
+each:
+
+* ``priority``: chats and users in FAIR_PRIORITY_IDS, and prompts of at most
+  FAIR_SHORT_PROMPT tokens, which are quick to answer
+* ``normal``: everything else
+* ``over_budget``: users past FAIR_TOKEN_BUDGET tokens in the window, served
+  only when nobody else is waiting; an allowlisted chat never lands here
+
+The last FAIR_DECISIONS decisions and the per-user state are in ``snapshot``,
+served as JSON on /debug/scheduler next to /metrics, to local clients or with
+the webhook secret, and with FAIR_TRACE=1 every decision is also logged as a
+JSON line on the ``scheduler`` logger.
+"""
+import asyncio
+import collections
+import heapq
+import itertools
+import json
+import logging
+import os
+import time
+
+import metrics
+
+decision_logger = logging.getLogger('scheduler')
+
+FAIR_COMPLETION_ESTIMATE = int(os.getenv('FAIR_COMPLETION_ESTIMATE', '256'))
+FAIR_SHORT_PROMPT = int(os.getenv('FAIR_SHORT_PROMPT', '64'))
+FAIR_TOKEN_BUDGET = int(os.getenv('FAIR_TOKEN_BUDGET', '50000'))
+FAIR_BUDGET_WINDOW = float(os.getenv('FAIR_BUDGET_WINDOW', '3600'))
+# Chat or user ids, comma separated
+FAIR_PRIORITY_IDS = frozenset(int(i) for i in os.getenv('FAIR_PRIORITY_IDS', '').split(',') if i.strip())
+# user_id:weight pairs, comma separated; everyone else has weight 1
+FAIR_WEIGHTS = {int(user): float(weight) for user, weight in
+                (pair.split(':') for pair in os.getenv('FAIR_WEIGHTS', '').split(',') if pair.strip())}
+FAIR_DECISIONS = int(os.getenv('FAIR_DECISIONS', '200'))
+FAIR_TRACE = os.getenv('FAIR_TRACE', '0') == '1'
+
+LANES = ('priority', 'normal', 'over_budget')
+
+decisions = metrics.counter('fair_scheduler_decisions_total', "Jobs started, by the lane they waited in", ['lane'])
+lane_wait = metrics.histogram('fair_scheduler_wait_seconds', "Time a job waited for its turn", ['lane'])
+ready = metrics.gauge('fair_scheduler_ready', "Chats with a job ready to run, by lane", ['lane'])
+# Users shown by ``snapshot``, the ones with the most tokens in the window
+SNAPSHOT_USERS = 50
+
+
+class _User:
+    __slots__ = ('finish', 'queued', 'usage', 'used')
+
+    def __init__(self):
+        # Virtual time up to which the user has been served or has reserved
+        self.finish = 0.0
+        self.queued = 0
+        # (monotonic time, tokens) inside the budget window, and their sum
+        self.usage = collections.deque()
+        self.used = 0
+
+
+class FairScheduler:
+    """Drop-in for the engine's queue of ready chats: ``push`` a chat with the
+    job it will run next, ``await pop()`` the chat to run now."""
+
+    def __init__(self, weights=FAIR_WEIGHTS, priority_ids=FAIR_PRIORITY_IDS, budget=FAIR_TOKEN_BUDGET,
+                 window=FAIR_BUDGET_WINDOW, short_prompt=FAIR_SHORT_PROMPT,
+                 completion_estimate=FAIR_COMPLETION_ESTIMATE):
+        self.weights = weights
+        self.priority_ids = priority_ids
+        self.budget = budget
+        self.window = window
+        self.short_prompt = short_prompt
+        self.completion_estimate = completion_estimate
+        # One heap per lane of (start tag, seq, chat_id, job, lane)
+        self._lanes = [[] for _ in LANES]
+        self._seq = itertools.count()
+        self._virtual = 0.0
+        self._users = {}
+        self._available = asyncio.Semaphore(0)
+        self._pops = 0
+        self.decisions = collections.deque(maxlen=FAIR_DECISIONS)
+        metrics.debug('scheduler', self.snapshot)
+
+    def push(self, chat_id, job):
+        """Make ``job``, the next job of ``chat_id``, ready to run."""
+        user_id = job.user_id if job.user_id is not None else chat_id
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._users[user_id] = _User()
+        lane = self._lane(chat_id, user_id, user, job)
+
+        # Behind what the user already reserved, or now if they have been idle
+        start = max(self._virtual, user.finish)
+        user.finish = start + (job.prompt_tokens + self.completion_estimate) / self._weight(user_id)
+        user.queued += 1
+        heapq.heappush(self._lanes[lane], (start, next(self._seq), chat_id, job, lane))
+        ready.set(len(self._lanes[lane]), lane=LANES[lane])
+        self._available.release()
+
+    async def pop(self):
+        """The chat whose ready job runs next, waiting until there is one."""
+        await self._available.acquire()
+        heap = next(heap for heap in self._lanes if heap)
+        start, _, chat_id, job, lane = heapq.heappop(heap)
+        ready.set(len(heap), lane=LANES[lane])
+        self._virtual = max(self._virtual, start)
+        user_id = job.user_id if job.user_id is not None else chat_id
+        self._users[user_id].queued -= 1
+        self._record(chat_id, user_id, job, lane, start)
+
+        self._pops += 1
+        if self._pops % 256 == 0:
+            self._prune()
+        return chat_id
+
+    def done(self, chat_id, job):
+        """Charge the user of a finished ``job`` what it used instead of what it reserved."""
+        user_id = job.user_id if job.user_id is not None else chat_id
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._users[user_id] = _User()
+        reserved = job.prompt_tokens + self.completion_estimate
+        user.finish += (job.tokens - reserved) / self._weight(user_id)
+        if job.tokens:
+            user.usage.append((time.monotonic(), job.tokens))
+            user.used += job.tokens
+
+    def _weight(self, user_id):
+        return self.weights.get(user_id, 1.0)
+
+    def _lane(self, chat_id, user_id, user, job):
+        if chat_id in self.priority_ids or user_id in self.priority_ids:
+            return LANES.index('priority')
+        if self._window_usage(user) > self.budget:
+            return LANES.index('over_budget')
+        if job.prompt_tokens <= self.short_prompt:
+            return LANES.index('priority')
+        return LANES.index('normal')
+
+    def _window_usage(self, user):
+        horizon = time.monotonic() - self.window
+        while user.usage and user.usage[0][0] < horizon:
+            user.used -= user.usage.popleft()[1]
+        return user.used
+
+    def _prune(self):
+        # Users with nothing queued, no tokens in the window and no lead are like new ones
+        for user_id, user in list(self._users.items()):
+            if not user.queued and user.finish <= self._virtual and not self._window_usage(user):
+                del self._users[user_id]
+
+    def _record(self, chat_id, user_id, job, lane, start):
+        waited = time.monotonic() - job.queued_at
+        decision = {
+            'at': round(time.time(), 3),
+            'chat_id': chat_id,
+            'user_id': user_id,
+            'lane': LANES[lane],
+            'start': round(start, 1),
+            'waited_ms': round(waited * 1000, 1),
+            'prompt_tokens': job.prompt_tokens,
+            'window_tokens': self._users[user_id].used,
+            'ready': [len(heap) for heap in self._lanes],
+        }
+        self.decisions.append(decision)
+        decisions.inc(lane=LANES[lane])
+        lane_wait.observe(waited, lane=LANES[lane])
+        if FAIR_TRACE:
+            decision_logger.info(json.dumps(decision))
+
+    def snapshot(self):
+        """The scheduler's state and its latest decisions, for debugging."""
+        # Copied first, /debug may be served from another thread
+        users = sorted(list(self._users.items()), key=lambda item: item[1].used, reverse=True)[:SNAPSHOT_USERS]
+        return {
+            'virtual_time': round(self._virtual, 1),
+            'ready': {name: len(heap) for name, heap in zip(LANES, self._lanes)},
+            'users': {
+                str(user_id): {
+                    'queued': user.queued,
+                    # Virtual time the user is ahead of the others, their next job waits that much longer
+                    'ahead': round(max(user.finish - self._virtual, 0.0), 1),
+                    'window_tokens': user.used,
+                    'weight': self._weight(user_id),
+                }
+                for user_id, user in users
+            },
+            'decisions': list(self.decisions),
+        }
@@ -0,0 +1,139 @@
+"""Shared HTTP clients for outbound calls to Twitter, Google and Telegram.
+
+Every call used to go through the module level ``requests.post``/``requests.get``,
+which opens a new TCP and TLS connection each time. The clients here keep
+connections open per host and reuse them across requests, apply explicit
+connect and read timeouts, and retry a bounded number of times with backoff.
+
+Retries are deliberately narrow: a failed connection is always retried since
+the request never reached the server, but a request that may have been received
+is only retried for GET. An OAuth code can be redeemed once, so repeating a
+token exchange POST would only turn a slow success into an invalid_grant.
+
+Sync code (Flask, Lambda) uses ``get``/``post``. Async code uses
+``async_request`` or its own client from ``new_async_client``.
+"""
+import asyncio
+import logging
+import os
+import threading
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '3.05'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '10'))
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', '2'))
+HTTP_BACKOFF = float(os.getenv('HTTP_BACKOFF', '0.3'))
+# Connections kept open per host
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '20'))
+
+RETRY_STATUSES = (502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def new_session(pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES):
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        allowed_methods=frozenset({'GET', 'HEAD'}),
+        status_forcelist=RETRY_STATUSES,
+        backoff_factor=HTTP_BACKOFF,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def session():
+    """The process wide pooled ``requests.Session``."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = new_session()
+    return _session
+
+
+def request(method, url, **kwargs):
+    kwargs.setdefault('timeout', (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    return session().request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def new_async_client(pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES, **kwargs):
+    """An ``httpx.AsyncClient`` with the same pooling and timeouts as the sync session.
+
+    The transport retries failed connection attempts; ``async_request`` adds the
+    retries for GET.
+    """
+    # httpx is only imported by async users, sync ones like the Lambda don't need it
+    import httpx
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        transport=httpx.AsyncHTTPTransport(retries=retries),
+        **kwargs,
+    )
+
+
+# One client per event loop, an httpx connection pool can't be shared between loops
+_async_clients = weakref.WeakKeyDictionary()
+# Per loop, admits at most as many requests as the pool has connections. Requests waiting inside
+# httpcore's pool are rescanned against every connection whenever one frees up, which costs far more
+# CPU than the requests themselves once a burst queues up there.
+_async_slots = weakref.WeakKeyDictionary()
+
+
+def async_client():
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = new_async_client()
+        _async_slots[loop] = asyncio.Semaphore(HTTP_POOL_SIZE)
+    return client
+
+
+async def async_request(method, url, retries=HTTP_RETRIES, **kwargs):
+    import httpx
+    client = async_client()
+    slots = _async_slots[asyncio.get_running_loop()]
+    attempt = 0
+    while True:
+        try:
+            async with slots:
+                response = await client.request(method, url, **kwargs)
+        except httpx.TransportError:
+            if method != 'GET' or attempt >= retries:
+                raise
+        else:
+            if method != 'GET' or response.status_code not in RETRY_STATUSES or attempt >= retries:
+                return response
+        await asyncio.sleep(HTTP_BACKOFF * 2 ** attempt)
+        attempt += 1
+
+
+async def async_get(url, **kwargs):
+    return await async_request('GET', url, **kwargs)
+
+
+async def async_post(url, **kwargs):
+    return await async_request('POST', url, **kwargs)
@@ -0,0 +1,265 @@
+"""Async inference engine for the Telegram AI chat.
+
+Generations run on the async Ollama client behind a bounded work queue. A fixed
+number of workers caps how many requests reach Ollama at the same time, and each
+chat has at most one job in flight, so messages from one chat are answered in
+the order they arrived while different chats proceed in parallel. Which chat
+goes next is up to the ``FairScheduler``, which shares the workers fairly
+between users.
+"""
+import asyncio
+import collections
+import contextvars
+import logging
+import os
+import time
+
+import ollama
+
+import metrics
+from admission import ADMISSION_INTERVAL
+from fair_scheduler import FairScheduler
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_HOST = os.getenv('OLLAMA_HOST')
+OLLAMA_MODEL = os.getenv('OLLAMA_MODEL', 'deepseek-r1:8b')
+# How long Ollama keeps the model, and with it the KV cache of recent prompts, loaded
+OLLAMA_KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', '30m')
+# Match this to OLLAMA_NUM_PARALLEL on the server, anything above it just waits there
+OLLAMA_MAX_CONCURRENCY = int(os.getenv('OLLAMA_MAX_CONCURRENCY', '4'))
+OLLAMA_QUEUE_SIZE = int(os.getenv('OLLAMA_QUEUE_SIZE', '200'))
+
+
+TOKEN_RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 40, 50, 75, 100, 150, 200)
+
+ollama_seconds = metrics.histogram('ollama_request_seconds', "Duration of an Ollama chat call, to the last token",
+                                   ['model', 'stream'])
+ollama_ttft = metrics.histogram('ollama_time_to_first_token_seconds', "Time until Ollama produced the first token",
+                                ['model'])
+ollama_token_rate = metrics.histogram('ollama_tokens_per_second', "Generation speed of an Ollama answer",
+                                      ['model'], buckets=TOKEN_RATE_BUCKETS)
+ollama_tokens = metrics.counter('ollama_generated_tokens_total', "Tokens generated by Ollama", ['model'])
+ollama_errors = metrics.counter('ollama_errors_total', "Ollama chat calls that failed", ['model'])
+
+
+def _observe_generation(model, final, first_token_at, chunks):
+    """Record speed and size of a finished generation, and count its tokens
+    against the job it ran in.
+
+    Ollama reports token counts and durations with the last response; the chunk
+    count and wall clock are the fallback when they are missing.
+    """
+    count = getattr(final, 'eval_count', None) or chunks
+    job = _current_job.get()
+    if job is not None:
+        job.tokens += (getattr(final, 'prompt_eval_count', None) or 0) + count
+    duration = getattr(final, 'eval_duration', None)
+    if duration:
+        seconds = duration / 1e9
+    elif first_token_at is not None:
+        seconds = time.perf_counter() - first_token_at
+    else:
+        seconds = 0
+    if count:
+        ollama_tokens.inc(count, model=model)
+        if seconds > 0:
+            ollama_token_rate.observe(count / seconds, model=model)
+
+
+class QueueFull(Exception):
+    """Raised when the engine already holds its maximum number of pending jobs."""
+
+
+# The job running in the current task, so ``chat`` can count its tokens
+_current_job = contextvars.ContextVar('inference_job', default=None)
+
+
+class _Job:
+    __slots__ = ('func', 'args', 'kwargs', 'future', 'context', 'queued_at', 'user_id', 'prompt_tokens', 'tokens')
+
+    def __init__(self, func, args, kwargs, future, user_id=None, prompt_tokens=0):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.queued_at = time.monotonic()
+        self.user_id = user_id
+        self.prompt_tokens = prompt_tokens
+        # Prompt and completion tokens Ollama reported for the job's generations
+        self.tokens = 0
+        # Run in the context of the submitter, so its tracing span is the job's parent
+        self.context = contextvars.copy_context()
+
+
+class InferenceEngine:
+    def __init__(self, client=None, concurrency=OLLAMA_MAX_CONCURRENCY, max_queue=OLLAMA_QUEUE_SIZE, admission=None):
+        """``admission`` is an optional ``AdmissionController`` that can refuse
+        jobs and pick a cheaper model or a token cap under load."""
+        self.client = client or ollama.AsyncClient(host=OLLAMA_HOST)
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.admission = admission
+        # chat_id -> jobs waiting for that chat, oldest first
+        self._pending = {}
+        # chats that currently have a job running on a worker
+        self._running = set()
+        # chats with pending work and nothing in flight, handed to the workers in a fair order
+        self._ready = FairScheduler()
+        self._size = 0
+        self._workers = []
+
+    @property
+    def queued(self):
+        """Number of jobs accepted but not yet started."""
+        return self._size
+
+    @property
+    def in_flight(self):
+        """Number of jobs currently running on a worker."""
+        return len(self._running)
+
+    @property
+    def oldest_wait(self):
+        """Seconds the longest waiting job has been queued."""
+        oldest = min((queue[0].queued_at for queue in self._pending.values() if queue), default=None)
+        return 0.0 if oldest is None else time.monotonic() - oldest
+
+    async def start(self):
+        if self._workers:
+            return
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        if self.admission is not None:
+            self._workers.append(asyncio.create_task(self._watch_load()))
+        logger.info("Inference engine started with %d workers, queue size %d", self.concurrency, self.max_queue)
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        for queue in self._pending.values():
+            for job in queue:
+                job.future.cancel()
+        self._pending.clear()
+        self._size = 0
+
+    def busy(self, chat_id):
+        """Whether ``chat_id`` has a job queued or running."""
+        return chat_id in self._pending or chat_id in self._running
+
+    def admit(self):
+        """Raise ``QueueFull`` if a job submitted now would be refused."""
+        if self._size >= self.max_queue:
+            raise QueueFull(f"inference queue is full ({self._size} pending)")
+        if self.admission is not None and not self.admission.admit():
+            raise QueueFull(f"shedding load ({self._size} pending)")
+
+    def submit(self, chat_id, func, *args, user_id=None, prompt_tokens=0, **kwargs):
+        """Queue ``func(*args, **kwargs)`` behind earlier jobs of the same chat.
+
+        ``user_id``, the chat's if not given, is who the job counts against when
+        the scheduler shares the workers, and ``prompt_tokens`` the size of what
+        they asked. Returns a future with the result. Cancelling the future
+        cancels the job, whether it is still queued or already running.
+        """
+        self.admit()
+        future = asyncio.get_running_loop().create_future()
+        queue = self._pending.setdefault(chat_id, collections.deque())
+        queue.append(_Job(func, args, kwargs, future, user_id, prompt_tokens))
+        self._size += 1
+        if len(queue) == 1 and chat_id not in self._running:
+            self._ready.push(chat_id, queue[0])
+        return future
+
+    async def run(self, chat_id, func, *args, **kwargs):
+        return await self.submit(chat_id, func, *args, **kwargs)
+
+    async def chat(self, messages, model=OLLAMA_MODEL, **kwargs):
+        """Call the Ollama chat API. Meant to be used from inside a submitted job."""
+        kwargs.setdefault('keep_alive', OLLAMA_KEEP_ALIVE)
+        if self.admission is not None:
+            model, kwargs = self.admission.shape(model, kwargs)
+        if kwargs.get('stream'):
+            return self._timed_stream(model, messages, kwargs)
+
+        started = time.perf_counter()
+        with metrics.span('ollama.chat', model=model):
+            try:
+                response = await self.client.chat(model=model, messages=messages, **kwargs)
+            except Exception:
+                ollama_errors.inc(model=model)
+                raise
+        ollama_seconds.observe(time.perf_counter() - started, model=model, stream='false')
+        # Without streaming the first token isn't seen, loading and prefill are the closest to it
+        load = getattr(response, 'load_duration', None) or 0
+        prefill = load + (getattr(response, 'prompt_eval_duration', None) or 0)
+        if prefill:
+            ollama_ttft.observe(prefill / 1e9, model=model)
+        _observe_generation(model, response, None, 0)
+        return response
+
+    async def _timed_stream(self, model, messages, kwargs):
+        started = time.perf_counter()
+        first_token_at = None
+        chunks = 0
+        part = None
+        with metrics.span('ollama.chat', model=model, stream=True) as current:
+            try:
+                async for part in await self.client.chat(model=model, messages=messages, **kwargs):
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                        ollama_ttft.observe(first_token_at - started, model=model)
+                        if current is not None:
+                            current.set(ttft_ms=round((first_token_at - started) * 1000, 3))
+                    chunks += 1
+                    yield part
+            except Exception:
+                ollama_errors.inc(model=model)
+                raise
+        ollama_seconds.observe(time.perf_counter() - started, model=model, stream='true')
+        _observe_generation(model, part, first_token_at, chunks)
+
+    async def _watch_load(self):
+        while True:
+            await asyncio.sleep(ADMISSION_INTERVAL)
+            self.admission.update(self._size, self.oldest_wait)
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.pop()
+            queue = self._pending[chat_id]
+            job = queue.popleft()
+            self._size -= 1
+            self._running.add(chat_id)
+            try:
+                if not job.future.cancelled():
+                    await self._execute(job)
+            finally:
+                self._running.discard(chat_id)
+                self._ready.done(chat_id, job)
+                if queue:
+                    self._ready.push(chat_id, queue[0])
+                else:
+                    del self._pending[chat_id]
+
+    async def _execute(self, job):
+        job.context.run(_current_job.set, job)
+        task = job.context.run(asyncio.ensure_future, job.func(*job.args, **job.kwargs))
+        job.future.add_done_callback(lambda future: task.cancel() if future.cancelled() else None)
+        try:
+            result = await task
+        except asyncio.CancelledError:
+            if not job.future.cancelled():
+                # The worker itself is being stopped
+                job.future.cancel()
+                raise
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        if self.admission is not None and not job.future.cancelled():
+            # Failures count too, a backend timing out is load as well
+            self.admission.observe(time.monotonic() - job.queued_at)
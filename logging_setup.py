@@ -0,0 +1,206 @@
+"""Logging for every entry point: JSON lines, redacted, written off the request path.
+
+``configure`` replaces the root handlers with a handler that only puts the
+record on a bounded queue; a writer thread formats and writes it. A Telegram
+handler or an OAuth callback that logs never waits for stderr, and when the
+writer falls LOG_QUEUE_SIZE records behind, new records are dropped and
+counted rather than block the caller.
+
+Each record is one JSON object with the time, level, logger and message, plus
+the fields passed in ``extra``, or a text line with LOG_FORMAT=text. Large
+bodies go in ``extra={'payload': ...}``: they are kept for a LOG_PAYLOAD_SAMPLE
+share of records, the others only note their size, and every message, payload
+and traceback is cut at LOG_MAX_CHARS. Before anything is written, tokens,
+secrets, authorization codes, bearer credentials and Telegram bot tokens are
+replaced by ``[REDACTED]``, in dicts by key and in text by pattern.
+
+Below WARNING, records of the loggers in LOG_SAMPLE are kept at the given
+rate, e.g. ``LOG_SAMPLE=telegram.ext=0.1,scheduler=0.5``.
+
+Lambda freezes the container as soon as a handler returns, so there records are
+written directly by the handler, with the same formatting.
+"""
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# json, or text for reading in a terminal
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+LOG_MAX_CHARS = int(os.getenv('LOG_MAX_CHARS', '2000'))
+LOG_PAYLOAD_SAMPLE = float(os.getenv('LOG_PAYLOAD_SAMPLE', '0.1'))
+# logger=rate pairs, comma separated; a logger's children are sampled with it
+LOG_SAMPLE = {name.strip(): float(rate) for name, rate in
+              (pair.split('=') for pair in os.getenv('LOG_SAMPLE', '').split(',') if pair.strip())}
+LOG_REDACT_KEYS = frozenset(
+    {'access_token', 'refresh_token', 'id_token', 'token', 'code', 'code_verifier', 'client_secret',
+     'secret', 'password', 'authorization', 'api_key', 'secret_key'}
+    | {key.strip().lower() for key in os.getenv('LOG_REDACT_KEYS', '').split(',') if key.strip()}
+)
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+REDACTED = '[REDACTED]'
+
+_key_pattern = '|'.join(re.escape(key) for key in sorted(LOG_REDACT_KEYS, key=len, reverse=True))
+_REDACT_PATTERNS = (
+    (re.compile(r'(?i)\b(bearer|basic)\s+[A-Za-z0-9._~+/=-]+'), rf'\1 {REDACTED}'),
+    # "access_token": "...", access_token=..., code: ..., but Authorization: Bearer keeps its scheme
+    (re.compile(rf'''(?i)(["']?\b(?:{_key_pattern})\b["']?\s*[:=]\s*["']?)(?!(?:bearer|basic)\s)[^"'&,\s}}]+'''),
+     rf'\1{REDACTED}'),
+    # Bot API tokens, also inside URLs like /bot123456:ABC.../sendMessage
+    (re.compile(r'(?<!\d)\d{6,12}:[A-Za-z0-9_-]{30,}'), REDACTED),
+)
+
+# Attributes every LogRecord has; anything else came in through ``extra``
+_RECORD_FIELDS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+_configured = False
+
+
+def redact(value):
+    """``value`` with secrets replaced: by key in dicts and lists, by pattern in strings."""
+    if isinstance(value, str):
+        for pattern, replacement in _REDACT_PATTERNS:
+            value = pattern.sub(replacement, value)
+        return value
+    if isinstance(value, dict):
+        return {key: REDACTED if str(key).lower() in LOG_REDACT_KEYS else redact(item)
+                for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    return value
+
+
+def _cap(value, limit=LOG_MAX_CHARS):
+    if isinstance(value, str) and len(value) > limit:
+        return f"{value[:limit]}…[+{len(value) - limit} chars]"
+    if isinstance(value, dict):
+        return {key: _cap(item, limit) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_cap(item, limit) for item in value]
+    return value
+
+
+def _clean(value):
+    return _cap(redact(value))
+
+
+def _extras(record):
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_FIELDS}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc)
+                                     .isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': _clean(record.getMessage()),
+        }
+        for key, value in _extras(record).items():
+            entry[key] = _clean(value)
+        if record.exc_info:
+            entry['exc'] = _clean(self.formatException(record.exc_info))
+        if record.stack_info:
+            entry['stack'] = _clean(self.formatStack(record.stack_info))
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = super().format(record)
+        extras = _extras(record)
+        if extras:
+            line += ' | ' + ' '.join(f"{key}={value}" for key, value in extras.items())
+        return _clean(line)
+
+
+class _Sampler(logging.Filter):
+    """Drops sampled records and the payload of most records that carry one. Runs on the caller."""
+
+    def __init__(self, rates=LOG_SAMPLE, payload_rate=LOG_PAYLOAD_SAMPLE):
+        super().__init__()
+        self.rates = rates
+        self.payload_rate = payload_rate
+
+    def filter(self, record):
+        if self.rates and record.levelno < logging.WARNING:
+            name = record.name
+            while name:
+                rate = self.rates.get(name)
+                if rate is not None:
+                    if random.random() >= rate:
+                        return False
+                    break
+                name = name.rpartition('.')[0]
+        payload = getattr(record, 'payload', None)
+        if payload is not None and random.random() >= self.payload_rate:
+            record.payload_chars = len(payload) if isinstance(payload, str) else len(str(payload))
+            del record.payload
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Only what can't wait: the message with its arguments, which may change once we return.
+        # Redaction and formatting, including of the traceback, happen on the writer thread.
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': f"Dropped {self.dropped} log records, the writer fell behind",
+                }))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def configure(level=LOG_LEVEL, fmt=LOG_FORMAT, background=None):
+    """Send the records of every logger through the redacting formatter, from a writer
+    thread unless ``background`` is False. Only the first call in a process has an effect."""
+    global _configured
+    if _configured:
+        return
+    _configured = True
+
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter(TEXT_FORMAT))
+    if background is None:
+        background = not os.getenv('AWS_LAMBDA_FUNCTION_NAME')
+    if background:
+        records = queue.Queue(LOG_QUEUE_SIZE)
+        handler = _QueueHandler(records)
+        listener = logging.handlers.QueueListener(records, stream)
+        listener.start()
+        # Write out what is still queued when the process exits
+        atexit.register(listener.stop)
+    else:
+        handler = stream
+    handler.addFilter(_Sampler())
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    # set higher logging level for httpx to avoid all GET and POST requests being logged
+    logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -1,25 +1,76 @@
 from dotenv import load_dotenv
+import asyncio
 import os
 
+# Load .env file before the modules below read their configuration
+load_dotenv()
+
 import logging
 from telegram import ForceReply, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
 
-import ollama
-import torch
+import logging_setup
+import metrics
+from admission import ADMISSION, ADMISSION_FALLBACK_MODEL, AdmissionController
+from coalesce import MODES, ChatCoalescer
+from inference import OLLAMA_MODEL, InferenceEngine
+from memory import ConversationMemory
+from postprocess import send_reply, strip_reasoning, stream_reply
+from response_cache import OLLAMA_EMBED_MODEL, ResponseCache
+from router import BackendPool
+from startup import ModelWarmPool
+from telegram_sender import TELEGRAM_API_URL
+from webhook import BOT_MODE, run_bot
 
-# Enable logging
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
-# set higher logging level for httpx to avoid all GET and POST requests being logged
-logging.getLogger("httpx").setLevel(logging.WARNING)
+# Enable logging, written by a background thread so handlers never wait for it
+logging_setup.configure()
 
 logger = logging.getLogger(__name__)
 
+# Stream replies by editing one message as tokens arrive, instead of waiting for the full answer
+STREAM_REPLIES = os.getenv('STREAM_REPLIES', '1') == '1'
+# Log whether PyTorch can use MPS at startup, which means importing torch
+REPORT_DEVICES = os.getenv('REPORT_DEVICES', '0') == '1'
+
+# Shared by every chat, started and stopped together with the Application
+# Requests go to the least loaded of the OLLAMA_HOSTS
+# Under load it answers with a smaller model, shorter answers, or not at all, see admission.py
+engine = InferenceEngine(client=BackendPool(), admission=AdmissionController() if ADMISSION else None)
+metrics.gauge('inference_queued', "Chat jobs waiting for an inference worker", function=lambda: engine.queued)
+metrics.gauge('inference_in_flight', "Chat jobs running on an inference worker", function=lambda: engine.in_flight)
+
+
+async def summarize_history(summary, messages):
+    """Fold old messages into the running summary of a conversation."""
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    response = await engine.chat([{
+        'role': 'user',
+        'content': (
+            "Update the summary of a conversation with the new messages below. "
+            "Reply with the updated summary only, in a few short sentences.\n\n"
+            f"Current summary:\n{summary or '(empty)'}\n\nNew messages:\n{transcript}"
+        ),
+    }])
+    return strip_reasoning(response.message.content)
+
+
+memory = ConversationMemory(summarize=summarize_history)
+
+# Answers to repeated standalone questions are served without running the model
+cache = ResponseCache(client=engine.client) if os.getenv('RESPONSE_CACHE', '1') == '1' else None
+
+# Keeps the models loaded in Ollama so no user message pays for loading them
+warm_pool = ModelWarmPool(
+    [backend.client for backend in engine.client.backends],
+    # With the fallback model, so degrading under load doesn't start by loading it
+    chat_models=[OLLAMA_MODEL, ADMISSION_FALLBACK_MODEL] if engine.admission else [OLLAMA_MODEL],
+    embed_models=[OLLAMA_EMBED_MODEL] if cache is not None else [],
+)
+
 
 # Define a few command handlers. These usually take the two arguments update and
 # context.
+@metrics.instrument_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
     user = update.effective_user
@@ -29,6 +80,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
 
+@metrics.instrument_handler
 async def goweb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     data = {
         "inline_keyboard": [[{"text": "Open WebApp", "web_app": {"url": 'https://www.google.com'}}]]
@@ -40,16 +92,25 @@ async def goweb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
 
+@metrics.instrument_handler
+async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Forget the conversation of this chat when the command /reset is issued."""
+    await memory.clear(update.effective_chat.id)
+    await update.message.reply_text("🧹 Conversation cleared.")
+
+
+@metrics.instrument_handler
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /help is issued."""
     await update.message.reply_text("Help!")
 
+@metrics.instrument_handler
 async def twitter(update, context):
     chat_id = update.message.chat_id
     user_id = update.effective_user.id
     user_name = update.effective_user.name
 
-    print('telegram user: ', user_id, ':', user_name, '. in chat: ', chat_id)
+    logger.info("Twitter link requested by user %s (%s) in chat %s", user_id, user_name, chat_id)
 
     button = InlineKeyboardButton(
         text="🔗 Connect Twitter Account",
@@ -62,6 +123,7 @@ async def twitter(update, context):
         reply_markup=keyboard
     )
 
+@metrics.instrument_handler
 async def twweb(update, context):
     TWITTER_CLIENT_ID = os.getenv('TWITTER_CLIENT_ID')
     TWITTER_CALLBACK_URL = os.getenv('TWITTER_CALLBACK_URL')
@@ -77,53 +139,150 @@ async def twweb(update, context):
         reply_markup=data
     )
 
+@metrics.instrument_handler
 async def ai_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Chat with AI."""
-    response = ollama.chat(
-        model='deepseek-r1:8b',
-        messages=[{
-            'role': 'user',
-            'content': update.message.text,
-        }]
+    coalescer.add(update)
+
+
+@metrics.instrument_handler
+async def mode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Choose what a new message does to an answer that is still being generated."""
+    chat_id = update.effective_chat.id
+    if context.args and context.args[0] in MODES:
+        coalescer.set_mode(chat_id, context.args[0])
+    current = coalescer.mode(chat_id)
+    await update.message.reply_text(
+        f"Mode: {current}\n"
+        "/mode cancel - a new message stops the current answer and is answered together with it\n"
+        "/mode queue - a new message is answered after the current answer"
     )
-    print(response.message.content)
 
-    left_len = len(response.message.content)
-    cur_idx = 0
-    while left_len > 0:
-        out_len = min(2000, left_len)
-        await update.message.reply_text(response.message.content[cur_idx:(cur_idx + out_len)])
-        cur_idx += out_len
-        left_len -= out_len
 
+async def cached_answer(update: Update, text: str) -> str | None:
+    """Reply to ``text`` from the response cache. Runs instead of queueing a job when the
+    chat has none, so a hit never waits for or takes an inference worker. Returns the
+    answer, None on a miss."""
+    # Called by the coalescer, not by the Application, so a span rather than handler metrics
+    with metrics.span('chat.cached_answer') as current:
+        messages = await memory.messages(update.effective_chat.id, text)
+        # Only questions without earlier context have an answer that can be shared between chats
+        if len(messages) != 1:
+            return None
+        cached, _ = await cache.lookup(text)
+        if current is not None:
+            current.set(hit=cached is not None)
+        if cached is not None:
+            await reply_in_chunks(update, cached)
+        return cached
 
-def main() -> None:
-    # init ollma
-    print(torch.backends.mps.is_available())  # Should return True if MPS is supported
-    print(torch.backends.mps.is_built())  # Check if MPS is built into your PyTorch version
 
-    # Load .env file
-    load_dotenv()
+async def answer(update: Update, text: str) -> str:
+    """Generate the reply to ``text`` as a reply to ``update``. Runs on an inference engine worker."""
+    with metrics.span('chat.answer'):
+        chat_id = update.effective_chat.id
+        messages = await memory.messages(chat_id, text)
+        cacheable = cache is not None and len(messages) == 1
+        if cacheable:
+            # In full if cached_answer was skipped because the chat had a job, otherwise rechecked:
+            # the same question from another chat may have been answered while this one waited
+            cached = await cache.recheck(text)
+            if cached is not None:
+                await reply_in_chunks(update, cached)
+                return cached
+
+        if STREAM_REPLIES:
+            stream = await engine.chat(messages, stream=True)
+            content = await stream_reply(update.message, (part.message.content async for part in stream))
+        else:
+            response = await engine.chat(messages)
+            content = response.message.content
+            await reply_in_chunks(update, content)
+        logger.debug("Answered chat %s", update.effective_chat.id, extra={'payload': content})
+
+        if cacheable:
+            await cache.store(text, content)
+        return content
+
 
+async def remember(update: Update, text: str, content: str) -> None:
+    """Add a delivered answer to the chat's memory."""
+    await memory.record(update.effective_chat.id, text, content)
+
+
+# Joins bursts of messages per chat before they reach the engine
+coalescer = ChatCoalescer(engine, answer, remember, cached=cached_answer if cache is not None else None)
+
+
+async def reply_in_chunks(update: Update, content: str) -> None:
+    # Reasoning handled as THINK_MODE says, messages cut at paragraphs and code blocks
+    await send_reply(update.message, content)
+
+
+def report_devices() -> None:
+    # torch takes seconds to import and is only needed for this report
+    try:
+        import torch
+    except ImportError:
+        return
+    logger.info("MPS available: %s, built into PyTorch: %s",
+                torch.backends.mps.is_available(), torch.backends.mps.is_built())
+
+
+async def post_init(application: Application) -> None:
+    await engine.start()
+    # Updates are only fetched after this returns, so the first message finds the models loaded
+    await warm_pool.start()
+    if REPORT_DEVICES:
+        asyncio.get_running_loop().run_in_executor(None, report_devices)
+
+
+async def post_shutdown(application: Application) -> None:
+    await warm_pool.stop()
+    await engine.stop()
+
+
+def build_application() -> Application:
+    """The bot with all its handlers, run by ``main`` or by a worker of sharding.py."""
     # Your Bot Token
     TOKEN = os.getenv("API_KEY")
 
-    """Start the bot."""
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(TOKEN).build()
+    # Handlers run concurrently, per-chat ordering is kept by the inference engine
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # on different commands - answer in Telegram
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("reset", reset))
+    application.add_handler(CommandHandler("mode", mode))
     application.add_handler(CommandHandler("goweb", goweb))
     application.add_handler(CommandHandler("twitter", twitter))
     application.add_handler(CommandHandler("twweb", twweb))
 
     # on non command i.e message - echo the message on Telegram
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, ai_chat))
+    return application
+
+
+def main() -> None:
+    """Start the bot."""
+    application = build_application()
+
+    # The webhook server has its own /metrics, a polling bot needs a port for it
+    if metrics.METRICS_PORT and BOT_MODE != 'webhook':
+        metrics.serve()
 
-    # Run the bot until the user presses Ctrl-C
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Run the bot until the user presses Ctrl-C, by polling or webhook depending on BOT_MODE
+    run_bot(application, ready=warm_pool.ready.is_set)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,165 @@
+"""Per-chat conversation memory for the AI chat.
+
+Every chat keeps its recent turns verbatim plus a running summary of older
+ones, and the prompt sent to the model is built from both. The history is kept
+under a token budget by folding the oldest turns into the summary.
+
+Trimming is done in large steps on purpose: once the history grows past the
+budget it is cut down to half of it, and until it grows past the budget again
+new turns are only appended. The prompt of the next turn therefore starts with
+exactly the prompt of the previous one, so Ollama can reuse the KV cache it
+already holds for that prefix (with the model kept loaded through
+``keep_alive``) and only has to prefill the newest messages.
+
+History lives in memory and can be persisted to SQLite by setting MEMORY_DB.
+At most MEMORY_MAX_CHATS chats are held in memory; the least recently active
+one is dropped beyond that and loaded from MEMORY_DB again when it is next
+active, or starts over without it.
+"""
+import asyncio
+import collections
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from postprocess import strip_reasoning
+
+logger = logging.getLogger(__name__)
+
+MEMORY_TOKEN_BUDGET = int(os.getenv('MEMORY_TOKEN_BUDGET', '3000'))
+# Most recent messages that are never folded into the summary
+MEMORY_KEEP_MESSAGES = int(os.getenv('MEMORY_KEEP_MESSAGES', '4'))
+MEMORY_DB = os.getenv('MEMORY_DB')
+# Chats held in memory, the least recently active are dropped beyond it
+MEMORY_MAX_CHATS = int(os.getenv('MEMORY_MAX_CHATS', '10000'))
+
+def estimate_tokens(text):
+    """Rough token count, about four characters per token for English text."""
+    return len(text) // 4 + 1
+
+
+def _message_tokens(message):
+    # A few tokens of chat template overhead per message
+    return estimate_tokens(message['content']) + 4
+
+
+class ConversationMemory:
+    def __init__(self, budget=MEMORY_TOKEN_BUDGET, keep_messages=MEMORY_KEEP_MESSAGES,
+                 db_path=MEMORY_DB, summarize=None, max_chats=MEMORY_MAX_CHATS):
+        """``summarize(summary, messages)`` is an optional coroutine returning a new
+        summary that covers the old one plus ``messages``. Without it, folded turns
+        are simply dropped."""
+        self.budget = budget
+        self.keep_messages = keep_messages
+        self.db_path = db_path
+        self.summarize = summarize
+        self.max_chats = max_chats
+        # chat_id -> {"summary": str, "turns": [{"role", "content"}, ...]}, least recently used first
+        self._chats = collections.OrderedDict()
+        if db_path:
+            self._init_db()
+
+    async def messages(self, chat_id, text):
+        """Messages to send to the model for a new user message ``text``."""
+        state = await self._state(chat_id)
+        messages = []
+        if state['summary']:
+            messages.append({
+                'role': 'system',
+                'content': f"Summary of the earlier conversation:\n{state['summary']}",
+            })
+        messages.extend(state['turns'])
+        messages.append({'role': 'user', 'content': text})
+        return messages
+
+    async def record(self, chat_id, text, reply):
+        """Store one exchange and trim the history if it went over budget."""
+        state = await self._state(chat_id)
+        state['turns'].append({'role': 'user', 'content': text})
+        # The reasoning block is not part of the conversation, only the answer is
+        state['turns'].append({'role': 'assistant', 'content': strip_reasoning(reply)})
+        if self._tokens(state) > self.budget:
+            await self._trim(state)
+        if self.db_path:
+            await asyncio.to_thread(self._save, chat_id, state)
+
+    async def clear(self, chat_id):
+        self._chats.pop(chat_id, None)
+        if self.db_path:
+            await asyncio.to_thread(self._delete, chat_id)
+
+    def _tokens(self, state):
+        summary = estimate_tokens(state['summary']) if state['summary'] else 0
+        return summary + sum(_message_tokens(m) for m in state['turns'])
+
+    async def _trim(self, state):
+        turns = state['turns']
+        folded = []
+        # Fold whole user/assistant pairs, oldest first, down to half the budget
+        while len(turns) - 2 >= self.keep_messages and self._tokens(state) > self.budget // 2:
+            folded.extend(turns[:2])
+            del turns[:2]
+        if not folded:
+            return
+        if self.summarize is not None:
+            try:
+                state['summary'] = (await self.summarize(state['summary'], folded)).strip()
+            except Exception:
+                logger.exception("Failed to summarize conversation, dropping %d messages", len(folded))
+        logger.info("Folded %d messages into the summary", len(folded))
+
+    async def _state(self, chat_id):
+        state = self._chats.get(chat_id)
+        if state is not None:
+            self._chats.move_to_end(chat_id)
+            return state
+        if self.db_path:
+            state = await asyncio.to_thread(self._load, chat_id)
+        state = state or {'summary': '', 'turns': []}
+        self._chats[chat_id] = state
+        while len(self._chats) > self.max_chats:
+            # Saved on every record, so with MEMORY_DB nothing is lost
+            self._chats.popitem(last=False)
+        return state
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _init_db(self):
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chat_memory ("
+                "chat_id TEXT PRIMARY KEY, summary TEXT NOT NULL, turns TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+
+    def _load(self, chat_id):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT summary, turns FROM chat_memory WHERE chat_id = ?", (str(chat_id),)
+            ).fetchone()
+        if row is None:
+            return None
+        return {'summary': row[0], 'turns': json.loads(row[1])}
+
+    def _save(self, chat_id, state):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO chat_memory (chat_id, summary, turns, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET summary = excluded.summary, "
+                "turns = excluded.turns, updated_at = excluded.updated_at",
+                (str(chat_id), state['summary'], json.dumps(state['turns']), time.time())
+            )
+
+    def _delete(self, chat_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM chat_memory WHERE chat_id = ?", (str(chat_id),))
@@ -0,0 +1,433 @@
+"""Counters, gauges and latency histograms in the Prometheus text format.
+
+Modules declare what they measure with ``counter``, ``gauge`` and
+``histogram``, which return the already registered metric if the name is
+taken, so a module can be imported twice. ``render`` produces the text a
+Prometheus scrape expects. The Flask apps serve it on ``/metrics`` through
+``instrument_flask``, the ASGI app through ``instrument_starlette``, the bot on ``/metrics`` of the webhook server or, when
+polling, on METRICS_PORT. Components of the bot can add a JSON view of their
+state with ``debug``, served on ``/debug/<name>`` beside it. Those views hold
+user and chat ids, so unlike ``/metrics`` they are only answered to clients on
+the same host, or on the webhook server to requests carrying its secret.
+
+Observing a value takes a lock and a bisect over the buckets, cheap enough for
+every request and every Telegram send.
+
+With TRACE_SPANS=1 every ``span`` is also logged as one JSON line on the
+``trace`` logger with its trace id, parent and duration. Spans nest through a
+context variable, so the spans of a Flask request or of a bot answer share a
+trace id.
+"""
+import bisect
+import contextlib
+import contextvars
+import functools
+import ipaddress
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+trace_logger = logging.getLogger('trace')
+
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+TRACE_SPANS = os.getenv('TRACE_SPANS', '0') == '1'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Seconds, from a cached lookup up to a long generation
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_registry = {}
+# name -> function returning the JSON-able state shown on /debug/<name>
+_debug = {}
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if labels.keys() != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {self.labels}, got {tuple(labels)}")
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            lines.append(f"{self.name}{_labels(self.labels, key)} {_number(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), function=None):
+        super().__init__(name, help, labels)
+        # Called on every scrape instead of keeping a value, for things like queue depth
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self):
+        if self.function is None:
+            return super().render()
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}",
+                f"{self.name} {_number(self.function())}"]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # Per bucket counts, the last one for values above every bucket, then the sum
+                entry = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[index] += 1
+            entry[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the duration of the ``with`` block."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            values = [(key, list(entry)) for key, entry in self._values.items()]
+        for key, entry in values:
+            total = 0
+            for bound, count in zip((*self.buckets, float('inf')), entry):
+                total += count
+                lines.append(f"{self.name}_bucket{_labels(self.labels, key, [('le', _number(bound))])} {total}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {_number(entry[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {total}")
+        return lines
+
+
+def _register(cls, name, *args, **kwargs):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = cls(name, *args, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError(f"{name} is already registered as a {metric.kind}")
+        return metric
+
+
+def counter(name, help, labels=()):
+    return _register(Counter, name, help, labels)
+
+
+def gauge(name, help, labels=(), function=None):
+    metric = _register(Gauge, name, help, labels)
+    if function is not None:
+        metric.function = function
+    return metric
+
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+    return _register(Histogram, name, help, labels, buckets)
+
+
+def debug(name, function):
+    """Serve ``function()`` as JSON on ``/debug/<name>`` next to the bot's ``/metrics``."""
+    _debug[name] = function
+
+
+def is_local(host):
+    """Whether the client address ``host`` is a loopback address; debug views are only served to those."""
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except (TypeError, ValueError):
+        return False
+
+
+def render_debug(name):
+    """The JSON of the debug view ``name``, None if there is no such view."""
+    function = _debug.get(name)
+    if function is None:
+        return None
+    return json.dumps(function(), default=str)
+
+
+def render():
+    """Every registered metric in the Prometheus text format."""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in metrics:
+        try:
+            lines.extend(metric.render())
+        except Exception:
+            logger.exception("Failed to render metric %s", metric.name)
+    return '\n'.join(lines) + '\n'
+
+
+class Span:
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'attributes', 'started', '_token')
+
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = attributes
+        self.started = time.time()
+        self._token = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def finish(self):
+        if self._token is not None:
+            try:
+                _current_span.reset(self._token)
+            except ValueError:
+                # Finished from another context, e.g. a stream closed by the garbage collector
+                pass
+            self._token = None
+        trace_logger.info(json.dumps({
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.started,
+            'duration_ms': round((time.time() - self.started) * 1000, 3),
+            **self.attributes,
+        }, default=str))
+
+
+_current_span = contextvars.ContextVar('span', default=None)
+
+
+def start_span(name, **attributes):
+    """Start a span as a child of the current one. Returns None unless TRACE_SPANS is on."""
+    if not TRACE_SPANS:
+        return None
+    span = Span(name, _current_span.get(), attributes)
+    span._token = _current_span.set(span)
+    return span
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    current = start_span(name, **attributes)
+    try:
+        yield current
+    finally:
+        if current is not None:
+            current.finish()
+
+
+@contextlib.contextmanager
+def timed(span_name, metric, **labels):
+    """Observe the duration of the ``with`` block on the histogram ``metric`` and trace it as a span."""
+    started = time.perf_counter()
+    with span(span_name, **labels) as current:
+        try:
+            yield current
+        finally:
+            metric.observe(time.perf_counter() - started, **labels)
+
+
+oauth_request_seconds = histogram('oauth_request_seconds', "Duration of calls to the OAuth providers",
+                                  ['provider', 'step'])
+
+bot_handler_seconds = histogram('bot_handler_seconds', "Time spent in a bot handler", ['handler'])
+bot_handler_errors = counter('bot_handler_errors_total', "Bot handlers that raised", ['handler'])
+
+
+def instrument_handler(func):
+    """Time a bot handler and trace it as a span."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        with span(f"bot.{name}"):
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                bot_handler_errors.inc(handler=name)
+                raise
+            finally:
+                bot_handler_seconds.observe(time.perf_counter() - started, handler=name)
+    return wrapper
+
+
+http_request_seconds = histogram('http_request_seconds', "Time to handle an HTTP request",
+                                 ['app', 'route', 'method', 'status'])
+
+
+def instrument_flask(app, name=None):
+    """Time every request of the Flask ``app`` by route and serve ``/metrics`` on it."""
+    import flask
+
+    name = name or app.import_name
+
+    @app.before_request
+    def _start_timer():
+        flask.g.metrics_started = time.perf_counter()
+        flask.g.metrics_span = start_span('http.request', app=name, path=flask.request.path)
+
+    @app.after_request
+    def _observe(response):
+        started = flask.g.pop('metrics_started', None)
+        if started is not None:
+            # The rule, not the path, so query strings and ids don't explode the label set
+            rule = flask.request.url_rule.rule if flask.request.url_rule is not None else 'unmatched'
+            http_request_seconds.observe(time.perf_counter() - started, app=name, route=rule,
+                                         method=flask.request.method, status=str(response.status_code))
+        current = flask.g.get('metrics_span')
+        if current is not None:
+            current.set(status=response.status_code)
+        return response
+
+    @app.teardown_request
+    def _finish_span(error):
+        # Runs even when the view raised, so the span never stays current for the next request
+        current = flask.g.pop('metrics_span', None)
+        if current is not None:
+            if error is not None:
+                current.set(error=repr(error))
+            current.finish()
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return flask.Response(render(), content_type=CONTENT_TYPE)
+
+    return app
+
+
+def instrument_starlette(app, name):
+    """Time every request of the Starlette ``app`` by route and serve ``/metrics`` on it."""
+    from starlette.responses import Response
+    from starlette.routing import Match, Route
+
+    async def metrics_endpoint(request):
+        return Response(render(), media_type=CONTENT_TYPE)
+
+    app.router.routes.append(Route('/metrics', metrics_endpoint, methods=['GET']))
+
+    def route_of(scope):
+        # The route's path, so query strings and ids don't explode the label set
+        for route in app.router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return 'unmatched'
+
+    class Middleware:
+        def __init__(self, app):
+            self.app = app
+
+        async def __call__(self, scope, receive, send):
+            if scope['type'] != 'http':
+                return await self.app(scope, receive, send)
+            started = time.perf_counter()
+            status = 500
+
+            async def send_with_status(message):
+                nonlocal status
+                if message['type'] == 'http.response.start':
+                    status = message['status']
+                await send(message)
+
+            with span('http.request', app=name, path=scope['path']) as current:
+                try:
+                    await self.app(scope, receive, send_with_status)
+                finally:
+                    http_request_seconds.observe(time.perf_counter() - started, app=name, route=route_of(scope),
+                                                 method=scope['method'], status=str(status))
+                    if current is not None:
+                        current.set(status=status)
+
+    app.add_middleware(Middleware)
+    return app
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/metrics':
+            data, content_type = render().encode(), CONTENT_TYPE
+        elif (path.startswith('/debug/') and is_local(self.client_address[0])
+              and (view := render_debug(path[len('/debug/'):])) is not None):
+            data, content_type = view.encode(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port=METRICS_PORT, host='0.0.0.0'):
+    """Serve ``/metrics`` on ``port`` from a background thread, for processes without a web server.
+
+    ``/debug/<name>`` is answered too, but only to clients on this host.
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info("Serving metrics on %s:%d/metrics", host, server.server_address[1])
+    return server
@@ -0,0 +1,148 @@
+"""Pending OAuth logins, keyed by the ``state`` parameter of the authorize URL.
+
+A state is issued when the bot sends a login link and consumed by the OAuth
+callback. Most logins are never finished, so entries expire after
+OAUTH_STATE_TTL seconds and at most OAUTH_STATE_CAPACITY are kept, the oldest
+going first. Memory stays flat however many login links are requested.
+
+Every state gets the same TTL, so insertion order is also expiry order: expired
+entries are always at the front and are dropped there on each access, which is
+O(1) per entry and needs no sweeper thread.
+
+States live in memory, which only works while the bot and the callback server
+share a process. Set OAUTH_STATE_DB to keep them in SQLite so they can run as
+separate processes.
+"""
+import abc
+import collections
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+OAUTH_STATE_TTL = float(os.getenv('OAUTH_STATE_TTL', '600'))
+OAUTH_STATE_CAPACITY = int(os.getenv('OAUTH_STATE_CAPACITY', '10000'))
+OAUTH_STATE_DB = os.getenv('OAUTH_STATE_DB')
+
+
+class StateStore(abc.ABC):
+    @abc.abstractmethod
+    def issue(self, data):
+        """Store ``data`` under a new unguessable state and return the state."""
+
+    @abc.abstractmethod
+    def pop(self, state):
+        """Consume ``state``. Returns its data, or None if unknown or expired.
+
+        A state can be consumed only once, so a replayed callback is rejected.
+        """
+
+    def close(self):
+        pass
+
+
+class MemoryStateStore(StateStore):
+    def __init__(self, ttl=OAUTH_STATE_TTL, capacity=OAUTH_STATE_CAPACITY):
+        self.ttl = ttl
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        # state -> (expires_at, data), oldest first
+        self._states = collections.OrderedDict()
+
+    def __len__(self):
+        with self._lock:
+            self._expire(time.monotonic())
+            return len(self._states)
+
+    def issue(self, data):
+        state = str(uuid.uuid4())
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            self._states[state] = (now + self.ttl, data)
+            while len(self._states) > self.capacity:
+                self._states.popitem(last=False)
+        return state
+
+    def pop(self, state):
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._states.pop(state, None)
+        return entry[1] if entry is not None else None
+
+    def _expire(self, now):
+        states = self._states
+        while states:
+            state, (expires_at, _) = next(iter(states.items()))
+            if expires_at > now:
+                break
+            del states[state]
+
+
+class SQLiteStateStore(StateStore):
+    def __init__(self, path=OAUTH_STATE_DB, ttl=OAUTH_STATE_TTL, capacity=OAUTH_STATE_CAPACITY):
+        self.path = path
+        self.ttl = ttl
+        self.capacity = capacity
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        # id grows with every issued state, so the capacity bound is a range delete on it
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS oauth_state ("
+            "id INTEGER PRIMARY KEY, "
+            "state TEXT NOT NULL UNIQUE, "
+            "data TEXT NOT NULL, "
+            "expires_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_oauth_state_expires_at ON oauth_state (expires_at)")
+        conn.commit()
+
+    def _connect(self):
+        # One connection per thread; sqlite3 connections must not be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def issue(self, data):
+        state = str(uuid.uuid4())
+        # Wall clock, unlike the in-memory store, since other processes read the expiry too
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM oauth_state WHERE expires_at <= ?", (now,))
+            cursor = conn.execute(
+                "INSERT INTO oauth_state (state, data, expires_at) VALUES (?, ?, ?)",
+                (state, json.dumps(data), now + self.ttl),
+            )
+            conn.execute("DELETE FROM oauth_state WHERE id <= ?", (cursor.lastrowid - self.capacity,))
+        return state
+
+    def pop(self, state):
+        conn = self._connect()
+        with conn:
+            row = conn.execute(
+                "DELETE FROM oauth_state WHERE state = ? RETURNING data, expires_at", (state,)
+            ).fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+        return json.loads(row[0])
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def create_state_store(path=OAUTH_STATE_DB):
+    return SQLiteStateStore(path) if path else MemoryStateStore()
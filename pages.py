@@ -0,0 +1,71 @@
+"""HTML pages of the OAuth web apps, shared by the Flask and the ASGI versions."""
+import html
+import os
+import string
+
+TELEGRAM_BOT_URL = os.getenv('TELEGRAM_BOT_URL', 'https://t.me/DeepXVBot')
+
+# Rendered once at import, every successful callback serves the same page
+SUCCESS_PAGE = string.Template("""
+        <!DOCTYPE html>
+        <html lang="en">
+        <head>
+            <meta charset="UTF-8">
+            <meta name="viewport" content="width=device-width, initial-scale=1.0">
+            <title>Success! ✅</title>
+            <style>
+                body {
+                    font-family: Arial, sans-serif;
+                    background-color: #f4f8fb;
+                    text-align: center;
+                    padding: 50px;
+                }
+                .container {
+                    max-width: 500px;
+                    margin: auto;
+                    padding: 20px;
+                    background: white;
+                    box-shadow: 0 0 10px rgba(0, 0, 0, 0.1);
+                    border-radius: 10px;
+                }
+                h2 {
+                    color: #1DA1F2;
+                }
+                p {
+                    font-size: 18px;
+                    color: #333;
+                }
+                .icons {
+                    font-size: 50px;
+                    margin: 20px 0;
+                }
+                .icons i {
+                    margin: 0 10px;
+                    color: #1DA1F2;
+                }
+                .back-btn {
+                    display: inline-block;
+                    margin-top: 20px;
+                    padding: 10px 20px;
+                    color: white;
+                    background-color: #1DA1F2;
+                    text-decoration: none;
+                    border-radius: 5px;
+                    font-weight: bold;
+                }
+                .back-btn:hover {
+                    background-color: #0c85d0;
+                }
+            </style>
+        </head>
+        <body>
+            <div class="container">
+                <h2>✅ Success!</h2>
+                <div class="icons">🐦 🔗 💬</div>
+                <p>Your Twitter account has been linked to your Telegram.</p>
+                <p>You will now receive tweets directly in Telegram!</p>
+                <a class="back-btn" href="$bot_url">Go to Telegram</a>
+            </div>
+        </body>
+        </html>
+        """).substitute(bot_url=html.escape(TELEGRAM_BOT_URL))
@@ -0,0 +1,400 @@
+"""Turn raw model output into the Telegram messages that show it.
+
+deepseek-r1 starts every answer with its reasoning in a ``<think>`` block,
+often longer than the answer itself. THINK_MODE decides what users get of it:
+
+* ``hide``: nothing, only the answer is sent
+* ``collapse``: a collapsed quote above the answer that expands on tap
+* ``separate``: the reasoning in messages of its own, before the answer
+* ``show``: the raw output, reasoning tags and all
+
+Text is cut into messages close to Telegram's 4096 character limit, in one pass
+over the text, at paragraph breaks and never inside a code block unless the
+block alone is too long (it is then closed and reopened around the cut). With
+REPLY_HTML=1 the Markdown the model writes is sent as Telegram HTML, falling
+back to plain text if Telegram can't parse it.
+
+Streamed replies follow the same rules as far as text that is still growing
+allows: a message rolls over at a paragraph or line break, a code block open at
+the cut is closed there and reopened in the next message, and with REPLY_HTML=1
+every edit is rendered as HTML, with the open code block closed for the render.
+With ``hide`` and ``collapse`` a placeholder is shown from the first reasoning
+token until the answer, or the collapsed quote, takes its place.
+"""
+import asyncio
+import contextlib
+import html
+import itertools
+import logging
+import os
+import re
+
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+from streaming import MESSAGE_LIMIT, StreamingReply, retry_delay, split_point, throttled
+
+logger = logging.getLogger(__name__)
+
+THINK_MODE = os.getenv('THINK_MODE', 'hide')
+THINK_MODES = ('hide', 'collapse', 'separate', 'show')
+REPLY_HTML = os.getenv('REPLY_HTML', '0') == '1'
+
+# Shown while the model reasons and nothing of the answer can be shown yet
+THINKING = "💭 Thinking…"
+
+THINK_OPEN = '<think>'
+THINK_CLOSE = '</think>'
+REASONING = 'reasoning'
+ANSWER = 'answer'
+
+_THINK_RE = re.compile(r'<think>(.*?)(?:</think>|\Z)\s*', re.DOTALL)
+_FENCE_RE = re.compile(r'^(```|~~~)[^\n]*\n.*?^\1[ \t]*(?:\n|\Z)', re.MULTILINE | re.DOTALL)
+_FENCE_LINE_RE = re.compile(r'^(```|~~~)([^\n]*)$', re.MULTILINE)
+_PARAGRAPH_RE = re.compile(r'.*?(?:\n[ \t]*\n\s*|\Z)', re.DOTALL)
+
+
+def split_reasoning(text):
+    """``(reasoning, answer)`` of a complete model output."""
+    if THINK_CLOSE in text and THINK_OPEN not in text:
+        # Chat templates that open the block themselves only leave the closing tag
+        reasoning, _, answer = text.partition(THINK_CLOSE)
+        return reasoning.strip(), answer.strip()
+    reasoning = '\n\n'.join(match.strip() for match in _THINK_RE.findall(text) if match.strip())
+    return reasoning, _THINK_RE.sub('', text).strip()
+
+
+def strip_reasoning(text):
+    """The answer of a model output, without its reasoning."""
+    return split_reasoning(text)[1]
+
+
+class ReasoningSplitter:
+    """Separate reasoning from answer in streamed output, one chunk at a time.
+
+    ``feed`` returns ``(kind, text)`` pairs with kind ``REASONING`` or
+    ``ANSWER``. A tag split across chunks is held back until it is complete.
+    """
+
+    def __init__(self):
+        self._state = None
+        self._pending = ''
+
+    def feed(self, chunk):
+        self._pending += chunk
+        parts = []
+        while self._pending:
+            if self._state is None:
+                head = self._pending.lstrip()
+                if head.startswith(THINK_OPEN):
+                    self._state = REASONING
+                    self._pending = head[len(THINK_OPEN):]
+                elif head and not THINK_OPEN.startswith(head):
+                    self._state = ANSWER
+                else:
+                    break
+            elif self._state == REASONING:
+                end = self._pending.find(THINK_CLOSE)
+                if end != -1:
+                    parts.append((REASONING, self._pending[:end]))
+                    self._state = ANSWER
+                    self._pending = self._pending[end + len(THINK_CLOSE):].lstrip()
+                    continue
+                keep = _partial_suffix(self._pending, THINK_CLOSE)
+                parts.append((REASONING, self._pending[:len(self._pending) - keep]))
+                self._pending = self._pending[len(self._pending) - keep:]
+                break
+            else:
+                parts.append((ANSWER, self._pending))
+                self._pending = ''
+        return [(kind, text) for kind, text in parts if text]
+
+    def close(self):
+        """Whatever is still held back, at the end of the stream."""
+        rest, self._pending = self._pending, ''
+        return [(self._state or ANSWER, rest)] if rest else []
+
+
+def _partial_suffix(text, tag):
+    """Length of the longest end of ``text`` that could be the start of ``tag``."""
+    for size in range(min(len(tag) - 1, len(text)), 0, -1):
+        if tag.startswith(text[-size:]):
+            return size
+    return 0
+
+
+def _blocks(text):
+    """Paragraphs and fenced code blocks of ``text``, in order, each with its trailing whitespace."""
+    position = 0
+    for fence in _FENCE_RE.finditer(text):
+        yield from _paragraphs(text[position:fence.start()])
+        yield fence.group(0)
+        position = fence.end()
+    yield from _paragraphs(text[position:])
+
+
+def _paragraphs(text):
+    for match in _PARAGRAPH_RE.finditer(text):
+        if match.group(0):
+            yield match.group(0)
+
+
+def _split_text(text, limit):
+    while len(text) > limit:
+        cut = split_point(text, limit)
+        yield text[:cut]
+        text = text[cut:]
+    if text:
+        yield text
+
+
+def _split_block(block, limit):
+    """Pieces of a single block longer than ``limit``."""
+    fence = _FENCE_RE.fullmatch(block)
+    opening, _, body = block.partition('\n')
+    closing = fence.group(1) if fence is not None else ''
+    room = limit - len(opening) - len(closing) - 2
+    if fence is None or room < limit // 2:
+        yield from _split_text(block, limit)
+        return
+    # Close the code block at every cut and reopen it with the same language after
+    body = body.rstrip()[:-len(closing)]
+    for piece in _split_text(body, room):
+        yield f"{opening}\n{piece.rstrip(chr(10))}\n{closing}\n"
+
+
+def _open_fence(text):
+    """The opening line of the code block still open at the end of ``text``, None if there is none."""
+    opening = None
+    for line in _FENCE_LINE_RE.finditer(text):
+        if opening is None:
+            opening = line
+        elif line.group(1) == opening.group(1) and not line.group(2).strip():
+            opening = None
+    return opening.group(0) if opening is not None else None
+
+
+def stream_split(text, limit):
+    """``split`` for a ``StreamingReply``: ``split_point``, but a code block open at the cut
+    is closed in the head and reopened at the start of the rest."""
+    # Room for the closing fence
+    cut = split_point(text, limit - 5)
+    head, rest = text[:cut], text[cut:]
+    opening = _open_fence(head)
+    if opening is None:
+        return head, rest
+    start = head.rfind(opening)
+    if not head[start + len(opening):].strip() and start > 0:
+        # Nothing of the block is in this message yet, it starts the next one instead
+        return head[:start], text[start:]
+    return f"{head.rstrip(chr(10))}\n{opening[:3]}\n", f"{opening}\n{rest}"
+
+
+def chunks(text, limit=MESSAGE_LIMIT):
+    """Messages of at most ``limit`` characters that together show ``text``."""
+    current = ''
+    for block in _blocks(text):
+        if len(current) + len(block.rstrip()) <= limit:
+            current += block
+            continue
+        if current.strip():
+            yield current.strip()
+        current = ''
+        if len(block.rstrip()) <= limit:
+            current = block
+            continue
+        for piece in _split_block(block, limit):
+            if len(current) + len(piece.rstrip()) > limit and current.strip():
+                yield current.strip()
+                current = ''
+            current += piece
+    if current.strip():
+        yield current.strip()
+
+
+_INLINE_CODE_RE = re.compile(r'`([^`\n]+)`')
+_BOLD_RE = re.compile(r'\*\*(?=\S)(.+?)(?<=\S)\*\*|__(?=\S)(.+?)(?<=\S)__')
+_ITALIC_RE = re.compile(r'(?<![\w*])\*(?=\S)([^*\n]+?)(?<=\S)\*(?![\w*])|(?<![\w_])_(?=\S)([^_\n]+?)(?<=\S)_(?![\w_])')
+_STRIKE_RE = re.compile(r'~~(?=\S)(.+?)(?<=\S)~~')
+_LINK_RE = re.compile(r'\[([^\]\n]+)\]\((https?://[^)\s"]+)\)')
+_HEADING_RE = re.compile(r'^#{1,6}[ \t]+(.+?)[ \t]*#*[ \t]*$', re.MULTILINE)
+
+
+def _inline_html(text):
+    # Code spans first, their content is not formatted
+    codes = []
+
+    def stash(match):
+        codes.append(f"<code>{html.escape(match.group(1), quote=False)}</code>")
+        return f"\x00{len(codes) - 1}\x00"
+
+    text = html.escape(_INLINE_CODE_RE.sub(stash, text), quote=False)
+    text = _HEADING_RE.sub(r'<b>\1</b>', text)
+    text = _BOLD_RE.sub(lambda m: f"<b>{m.group(1) or m.group(2)}</b>", text)
+    text = _ITALIC_RE.sub(lambda m: f"<i>{m.group(1) or m.group(2)}</i>", text)
+    text = _STRIKE_RE.sub(r'<s>\1</s>', text)
+    text = _LINK_RE.sub(lambda m: f'<a href="{m.group(2)}">{m.group(1)}</a>', text)
+    return re.sub('\x00(\\d+)\x00', lambda m: codes[int(m.group(1))], text)
+
+
+def to_html(text):
+    """Telegram HTML for the Markdown subset models write: code, bold, italics, links and headings."""
+    parts = []
+    position = 0
+    for fence in _FENCE_RE.finditer(text):
+        parts.append(_inline_html(text[position:fence.start()]))
+        opening, body = fence.group(0).split('\n', 1)
+        body = body.rstrip()[:-len(fence.group(1))].rstrip('\n')
+        language = opening[len(fence.group(1)):].strip()
+        attribute = f' class="language-{html.escape(language)}"' if language else ''
+        parts.append(f"<pre><code{attribute}>{html.escape(body, quote=False)}</code></pre>\n")
+        position = fence.end()
+    parts.append(_inline_html(text[position:]))
+    return ''.join(parts).strip()
+
+
+def stream_html(text):
+    """``render`` for a ``StreamingReply``: Telegram HTML of text that may end inside a code block."""
+    opening = _open_fence(text)
+    if opening is not None:
+        text = f"{text.rstrip(chr(10))}\n{opening[:3]}"
+    return to_html(text), ParseMode.HTML
+
+
+def collapsed(reasoning, limit=MESSAGE_LIMIT):
+    """The reasoning as one collapsed HTML quote, cut short to fit in ``limit`` characters."""
+    # The emoji is two characters to Telegram, which counts UTF-16 code units
+    room = limit - 5
+    if len(reasoning) > room:
+        reasoning = reasoning[:room].rstrip() + '…'
+    return f"<blockquote expandable>💭 {html.escape(reasoning, quote=False)}</blockquote>"
+
+
+def format_reply(content, think_mode=THINK_MODE, as_html=REPLY_HTML, limit=MESSAGE_LIMIT):
+    """``(text, parse_mode, plain)`` for every message that shows ``content``.
+
+    ``plain`` is the same message without formatting, to send instead if
+    Telegram rejects the formatted one.
+    """
+    if think_mode == 'show':
+        reasoning, answer = '', content
+    else:
+        reasoning, answer = split_reasoning(content)
+        if not answer:
+            # Nothing but reasoning, that is still better than no reply at all
+            reasoning, answer = '', reasoning
+
+    if reasoning and think_mode == 'separate':
+        for chunk in chunks(reasoning, limit):
+            yield chunk, None, chunk
+
+    answer_chunks = chunks(answer, limit)
+    if reasoning and think_mode == 'collapse':
+        first = next(answer_chunks, '')
+        if len(first) <= limit // 2:
+            # A short answer shares the message with the quote, that saves a round trip
+            text = to_html(first) if as_html else html.escape(first, quote=False)
+            yield f"{collapsed(reasoning, limit - len(first) - 1)}\n{text}", ParseMode.HTML, first
+        else:
+            yield collapsed(reasoning, limit), ParseMode.HTML, reasoning[:limit]
+            answer_chunks = itertools.chain([first], answer_chunks)
+
+    for chunk in answer_chunks:
+        if as_html:
+            yield to_html(chunk), ParseMode.HTML, chunk
+        else:
+            yield chunk, None, chunk
+
+
+async def send_reply(message, content, think_mode=THINK_MODE, as_html=REPLY_HTML):
+    """Reply to ``message`` with the complete model output ``content``."""
+    for text, parse_mode, plain in format_reply(content, think_mode, as_html):
+        await _send(message, text, parse_mode, plain)
+
+
+async def _send(message, text, parse_mode, plain, edit=False):
+    """Reply to ``message``, or with ``edit`` replace its text. Falls back to ``plain``
+    if Telegram can't parse ``text``, and is sent again once after a 429, as streamed
+    edits are."""
+    try:
+        return await _call(message, text, parse_mode, plain, edit)
+    except RetryAfter as e:
+        throttled.inc(method='editMessageText' if edit else 'sendMessage')
+        logger.warning("Telegram asked to slow down replies for %.1fs", retry_delay(e))
+        await asyncio.sleep(retry_delay(e))
+        return await _call(message, text, parse_mode, plain, edit)
+
+
+async def _call(message, text, parse_mode, plain, edit):
+    send = message.edit_text if edit else message.reply_text
+    try:
+        return await send(text, parse_mode=parse_mode)
+    except BadRequest as e:
+        if parse_mode is None or "parse entities" not in str(e).lower():
+            raise
+        logger.warning("Telegram could not parse the formatted reply, sending it as plain text: %s", e)
+        return await send(plain)
+
+
+async def stream_reply(message, parts, think_mode=THINK_MODE, as_html=REPLY_HTML):
+    """Reply to ``message`` with streamed model output, ``parts`` being an async iterator of text.
+
+    The answer streams into its own messages through ``StreamingReply``, as HTML
+    if ``as_html``. With ``separate`` the reasoning streams the same way before
+    it, as plain text, with ``collapse`` it is sent as a collapsed quote once the
+    answer starts. With ``hide`` and ``collapse`` a THINKING placeholder is sent
+    as soon as the reasoning starts; the answer replaces it, or with ``collapse``
+    the quote does. Returns the complete raw output.
+    """
+    splitter = ReasoningSplitter()
+    raw = []
+    reasoning = []
+    thinking = answer = placeholder = None
+
+    async def drop_placeholder():
+        # No answer came, or it was cancelled before it did
+        if placeholder is not None:
+            with contextlib.suppress(TelegramError):
+                await placeholder.delete()
+
+    async with contextlib.AsyncExitStack() as stack:
+        stack.push_async_callback(drop_placeholder)
+        # Closed on its own when the answer starts, so the reasoning messages come first
+        thinking_stack = await stack.enter_async_context(contextlib.AsyncExitStack())
+        async for part in parts:
+            raw.append(part)
+            pieces = [(ANSWER, part)] if think_mode == 'show' else splitter.feed(part)
+            for kind, text in pieces:
+                if kind == REASONING:
+                    reasoning.append(text)
+                    if think_mode == 'separate':
+                        if thinking is None:
+                            thinking = await thinking_stack.enter_async_context(StreamingReply(message, split=stream_split))
+                        thinking.write(text)
+                    elif placeholder is None and answer is None:
+                        # The reasoning can take longer than the answer, show that one is coming
+                        placeholder = await _send(message, THINKING, None, THINKING)
+                    continue
+                if answer is None:
+                    await thinking_stack.aclose()
+                    thought = ''.join(reasoning).strip()
+                    if think_mode == 'collapse' and thought:
+                        quote = collapsed(thought)
+                        if placeholder is not None:
+                            await _send(placeholder, quote, ParseMode.HTML, thought[:MESSAGE_LIMIT], edit=True)
+                            placeholder = None
+                        else:
+                            await _send(message, quote, ParseMode.HTML, thought[:MESSAGE_LIMIT])
+                    answer = await stack.enter_async_context(
+                        StreamingReply(message, split=stream_split, render=stream_html if as_html else None,
+                                       placeholder=placeholder))
+                    placeholder = None
+                answer.write(text)
+        for kind, text in splitter.close():
+            if kind == ANSWER and answer is not None:
+                answer.write(text)
+    content = ''.join(raw)
+    if answer is None and thinking is None:
+        # Only reasoning, or so little output that the splitter held it all back
+        await send_reply(message, content, think_mode, as_html)
+    return content
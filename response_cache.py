@@ -0,0 +1,198 @@
+"""Response cache for the AI chat.
+
+Two layers are checked before a prompt goes to the model:
+
+* an exact layer keyed on the normalized prompt text
+* a semantic layer that embeds the prompt with an Ollama embedding model and
+  looks for a cached prompt whose cosine similarity is at least
+  RESPONSE_CACHE_THRESHOLD
+
+Embeddings are kept unit-length in one preallocated NumPy matrix, so a semantic
+lookup is a single matrix-vector product over all cached prompts. Entries
+expire after RESPONSE_CACHE_TTL seconds and the least recently used one is
+evicted when the cache is full.
+"""
+import asyncio
+import collections
+import logging
+import os
+import re
+import time
+
+import ollama
+
+from inference import OLLAMA_HOST, OLLAMA_KEEP_ALIVE
+from startup import lazy_import
+
+# NumPy is only needed once the first prompt is embedded
+np = lazy_import('numpy')
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '1000'))
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+RESPONSE_CACHE_THRESHOLD = float(os.getenv('RESPONSE_CACHE_THRESHOLD', '0.95'))
+# Leave empty to use only the exact layer
+OLLAMA_EMBED_MODEL = os.getenv('OLLAMA_EMBED_MODEL', 'nomic-embed-text')
+# Embedding requests at the same time, lookups run beside the inference workers rather than on them
+RESPONSE_CACHE_CONCURRENCY = int(os.getenv('RESPONSE_CACHE_CONCURRENCY', '2'))
+
+# Embeddings of missed prompts kept for ``store``, the answer comes a generation later
+MISSED_EMBEDDINGS = 256
+
+_PUNCTUATION_RE = re.compile(r'[^\w\s]')
+_SPACE_RE = re.compile(r'\s+')
+
+
+def normalize(text):
+    """Lowercase, drop punctuation and collapse whitespace."""
+    return _SPACE_RE.sub(' ', _PUNCTUATION_RE.sub(' ', text.lower())).strip()
+
+
+class _Entry:
+    __slots__ = ('response', 'expires_at', 'slot')
+
+    def __init__(self, response, expires_at, slot=None):
+        self.response = response
+        self.expires_at = expires_at
+        # Row of the embedding matrix, None when the prompt has no embedding
+        self.slot = slot
+
+
+class ResponseCache:
+    def __init__(self, client=None, size=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL,
+                 threshold=RESPONSE_CACHE_THRESHOLD, embed_model=OLLAMA_EMBED_MODEL,
+                 concurrency=RESPONSE_CACHE_CONCURRENCY):
+        self.client = client or ollama.AsyncClient(host=OLLAMA_HOST)
+        self.size = size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.embed_model = embed_model
+        self._embedding = asyncio.Semaphore(concurrency)
+        # normalized prompt -> _Entry, least recently used first
+        self._entries = collections.OrderedDict()
+        # Rows 0..len(_keys)-1 of the matrix are in use, _keys[i] is the prompt owning row i
+        self._matrix = None
+        self._keys = []
+        # normalized prompt -> embedding of recent misses, oldest first
+        self._missed = collections.OrderedDict()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def stats(self):
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        hits = self.exact_hits + self.semantic_hits
+        return {
+            'entries': len(self._entries),
+            'exact_hits': self.exact_hits,
+            'semantic_hits': self.semantic_hits,
+            'misses': self.misses,
+            'hit_rate': hits / lookups if lookups else 0.0,
+        }
+
+    async def lookup(self, prompt):
+        """Return ``(response, embedding)``.
+
+        ``response`` is None on a miss. ``store`` reuses the embedding of a recent
+        miss, so the prompt does not have to be embedded twice.
+        """
+        key = normalize(prompt)
+        entry = self._get(key)
+        if entry is not None:
+            self.exact_hits += 1
+            return entry.response, None
+
+        embedding = await self._embed(prompt)
+        if embedding is not None and self._keys:
+            scores = self._matrix[:len(self._keys)] @ embedding
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                entry = self._get(self._keys[best])
+                if entry is not None:
+                    self.semantic_hits += 1
+                    logger.debug("Semantic cache hit with similarity %.3f", scores[best])
+                    return entry.response, embedding
+        self.misses += 1
+        # None without an embedding model, the miss is remembered all the same
+        self._missed[key] = embedding
+        if len(self._missed) > MISSED_EMBEDDINGS:
+            self._missed.popitem(last=False)
+        return None, embedding
+
+    async def recheck(self, prompt):
+        """The response to ``prompt`` right before generating it, or None.
+
+        A prompt that missed recently is only checked in the exact layer again,
+        cheap enough for a concurrent miss that may have stored it since; any
+        other prompt gets a full ``lookup``.
+        """
+        key = normalize(prompt)
+        if key not in self._missed:
+            response, _ = await self.lookup(prompt)
+            return response
+        entry = self._get(key)
+        if entry is None:
+            return None
+        # The miss turned out to be a hit
+        self.misses -= 1
+        self.exact_hits += 1
+        return entry.response
+
+    async def store(self, prompt, response, embedding=None):
+        key = normalize(prompt)
+        missed = self._missed.pop(key, None)
+        if embedding is None:
+            embedding = missed
+        if not key or not response:
+            return
+        if key in self._entries:
+            self._remove(key)
+        while len(self._entries) >= self.size:
+            self._remove(next(iter(self._entries)))
+
+        slot = None
+        if embedding is not None:
+            slot = len(self._keys)
+            if self._matrix is None:
+                self._matrix = np.zeros((self.size, embedding.shape[0]), dtype=np.float32)
+            self._matrix[slot] = embedding
+            self._keys.append(key)
+        self._entries[key] = _Entry(response, time.monotonic() + self.ttl, slot)
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        if entry.slot is None:
+            return
+        # Move the last row into the freed one so used rows stay contiguous
+        last = len(self._keys) - 1
+        if entry.slot != last:
+            moved_key = self._keys[last]
+            self._matrix[entry.slot] = self._matrix[last]
+            self._keys[entry.slot] = moved_key
+            self._entries[moved_key].slot = entry.slot
+        self._keys.pop()
+
+    async def _embed(self, prompt):
+        if not self.embed_model or self.threshold >= 1:
+            return None
+        try:
+            async with self._embedding:
+                response = await self.client.embed(model=self.embed_model, input=prompt,
+                                                   keep_alive=OLLAMA_KEEP_ALIVE)
+        except Exception:
+            logger.warning("Embedding failed, using the exact cache only", exc_info=True)
+            return None
+        vector = np.asarray(response.embeddings[0], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
@@ -0,0 +1,165 @@
+"""Spread Ollama requests over several hosts.
+
+``BackendPool`` offers the ``chat``, ``generate`` and ``embed`` calls of
+``ollama.AsyncClient`` and forwards each request to the healthy host with the
+fewest requests in flight, using the rolling latency of each host to break
+ties. A host that fails is skipped for a cooldown that grows with repeated
+failures, and the request is retried on another host. Streamed requests are
+only retried while nothing has been yielded yet.
+
+A host that hangs fails too: connecting may take OLLAMA_CONNECT_TIMEOUT
+seconds, and the host may go OLLAMA_READ_TIMEOUT seconds without sending
+anything, which for a request that isn't streamed includes generating the
+whole answer.
+
+Hosts are configured as a comma separated list in OLLAMA_HOSTS.
+"""
+import logging
+import os
+import time
+
+import httpx
+import ollama
+
+from inference import OLLAMA_HOST
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_HOSTS = [host.strip() for host in os.getenv('OLLAMA_HOSTS', '').split(',') if host.strip()] or [OLLAMA_HOST]
+OLLAMA_BACKEND_COOLDOWN = float(os.getenv('OLLAMA_BACKEND_COOLDOWN', '10'))
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv('OLLAMA_CONNECT_TIMEOUT', '5'))
+OLLAMA_READ_TIMEOUT = float(os.getenv('OLLAMA_READ_TIMEOUT', '120'))
+# Weight of the newest request in the rolling latency of a host
+LATENCY_ALPHA = 0.2
+
+
+def _retryable(error):
+    # A 4xx says the request is bad, another host would reject it too; 404 usually
+    # means the model is missing on this host only
+    if isinstance(error, ollama.ResponseError):
+        return not (400 <= error.status_code < 500) or error.status_code == 404
+    return True
+
+
+class Backend:
+    def __init__(self, host, cooldown=OLLAMA_BACKEND_COOLDOWN, connect_timeout=OLLAMA_CONNECT_TIMEOUT,
+                 read_timeout=OLLAMA_READ_TIMEOUT):
+        self.host = host
+        # Without a timeout a host that hangs never fails, and its requests never move to another host
+        self.client = ollama.AsyncClient(host=host,
+                                         timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+        self.cooldown = cooldown
+        self.in_flight = 0
+        # Rolling average of request duration in seconds, None until the first success
+        self.latency = None
+        self.failures = 0
+        self.down_until = 0.0
+
+    @property
+    def healthy(self):
+        return time.monotonic() >= self.down_until
+
+    def succeeded(self, duration):
+        self.failures = 0
+        if self.latency is None:
+            self.latency = duration
+        else:
+            self.latency += LATENCY_ALPHA * (duration - self.latency)
+
+    def failed(self):
+        self.failures += 1
+        self.down_until = time.monotonic() + self.cooldown * min(2 ** (self.failures - 1), 8)
+
+    def stats(self):
+        return {
+            'host': self.host or 'default',
+            'healthy': self.healthy,
+            'in_flight': self.in_flight,
+            'latency': self.latency,
+            'failures': self.failures,
+        }
+
+
+class BackendPool:
+    def __init__(self, hosts=None, cooldown=OLLAMA_BACKEND_COOLDOWN):
+        self.backends = [Backend(host, cooldown) for host in (hosts or OLLAMA_HOSTS)]
+
+    def stats(self):
+        return [backend.stats() for backend in self.backends]
+
+    def pick(self, exclude=()):
+        """Least loaded healthy backend not in ``exclude``.
+
+        When every candidate is cooling down, the one that comes back first is used
+        rather than failing without trying.
+        """
+        candidates = [b for b in self.backends if b not in exclude]
+        if not candidates:
+            return None
+        healthy = [b for b in candidates if b.healthy]
+        if not healthy:
+            return min(candidates, key=lambda b: b.down_until)
+        return min(healthy, key=lambda b: (b.in_flight, b.latency or 0.0))
+
+    async def chat(self, **kwargs):
+        if kwargs.get('stream'):
+            return self._stream('chat', kwargs)
+        return await self._call('chat', kwargs)
+
+    async def generate(self, **kwargs):
+        if kwargs.get('stream'):
+            return self._stream('generate', kwargs)
+        return await self._call('generate', kwargs)
+
+    async def embed(self, **kwargs):
+        return await self._call('embed', kwargs)
+
+    async def _call(self, method, kwargs):
+        tried = []
+        while True:
+            backend = self.pick(tried)
+            tried.append(backend)
+            backend.in_flight += 1
+            started = time.monotonic()
+            try:
+                result = await getattr(backend.client, method)(**kwargs)
+            except Exception as e:
+                if not _retryable(e):
+                    raise
+                backend.failed()
+                if len(tried) == len(self.backends):
+                    raise
+                logger.warning("Ollama host %s failed (%s), retrying on another host",
+                               backend.host, str(e) or type(e).__name__)
+                continue
+            finally:
+                backend.in_flight -= 1
+            backend.succeeded(time.monotonic() - started)
+            return result
+
+    async def _stream(self, method, kwargs):
+        tried = []
+        while True:
+            backend = self.pick(tried)
+            tried.append(backend)
+            backend.in_flight += 1
+            started = time.monotonic()
+            streamed = False
+            try:
+                async for part in await getattr(backend.client, method)(**kwargs):
+                    streamed = True
+                    yield part
+            except Exception as e:
+                if not _retryable(e):
+                    raise
+                backend.failed()
+                # Once the caller has seen part of the answer, retrying would repeat it
+                if streamed or len(tried) == len(self.backends):
+                    raise
+                logger.warning("Ollama host %s failed (%s), retrying on another host",
+                               backend.host, str(e) or type(e).__name__)
+                continue
+            finally:
+                backend.in_flight -= 1
+            backend.succeeded(time.monotonic() - started)
+            return
@@ -0,0 +1,371 @@
+"""Runs the chat bot as one supervisor and SHARD_WORKERS worker processes.
+
+In main.py every handler runs in one process, so post-processing, chunking and
+the JSON of every update compete for one GIL. Here a supervisor process takes
+the updates from Telegram, by polling or webhook as BOT_MODE says, and hands
+each one to a worker process running the Application of main.py. The worker is
+picked by consistent hashing on the chat id, so the updates of a chat reach
+their handlers in order on one worker and find that chat's in-memory state
+there: the coalescer, the /mode setting and, without MEMORY_DB, the
+conversation.
+
+    SHARD_WORKERS=4 python sharding.py
+
+A worker that exits is started again after SHARD_RESTART_DELAY seconds,
+doubled while it keeps failing soon after starting. Until it is ready its
+chats go to the next worker on the ring; no other chat moves. A chat stays
+with the worker that last served it until it has been quiet for SHARD_STICKY
+seconds, so a restarted worker takes its chats back as they go idle and never
+in the middle of an answer. Updates a worker had already received when it
+died are lost, as they are when the single process bot dies.
+
+OLLAMA_MAX_CONCURRENCY stays the total over the bot: each worker's inference
+engine gets an equal share of it, at least one generation.
+
+Workers send their replies to Telegram themselves. The supervisor serves
+/metrics where the single process bot would; worker i serves its own on
+METRICS_PORT + 1 + i.
+"""
+from dotenv import load_dotenv
+
+# Load .env file before the modules below read their configuration
+load_dotenv()
+
+import asyncio
+import bisect
+import collections
+import hashlib
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+
+import logging_setup
+import metrics
+from telegram_sender import TELEGRAM_API_URL
+from webhook import BOT_MODE, run_bot
+
+logger = logging.getLogger(__name__)
+
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', str(os.cpu_count() or 1)))
+# Points of each worker on the hash ring, more spread the chats more evenly
+SHARD_VNODES = int(os.getenv('SHARD_VNODES', '64'))
+SHARD_STICKY = float(os.getenv('SHARD_STICKY', '300'))
+SHARD_RESTART_DELAY = float(os.getenv('SHARD_RESTART_DELAY', '1'))
+# Updates held while no worker is ready, the oldest are dropped beyond this
+SHARD_BACKLOG = int(os.getenv('SHARD_BACKLOG', '10000'))
+# A worker that ran this long before exiting is restarted without backoff
+SHARD_STABLE_AFTER = 60.0
+# Generations in flight over all workers, each worker's InferenceEngine gets its share
+OLLAMA_MAX_CONCURRENCY = int(os.getenv('OLLAMA_MAX_CONCURRENCY', '4'))
+
+routed = metrics.counter('shard_updates_total', "Updates handed to a worker", ['worker'])
+restarts = metrics.counter('shard_worker_restarts_total', "Worker processes started again after exiting", ['worker'])
+dropped = metrics.counter('shard_updates_dropped_total', "Updates dropped while no worker was ready")
+
+
+class HashRing:
+    """Consistent hashing of keys onto nodes, each node at ``vnodes`` points of the ring.
+
+    Adding or removing a node only moves the keys between it and its neighbours.
+    """
+
+    def __init__(self, vnodes=SHARD_VNODES):
+        self.vnodes = vnodes
+        self._points = []
+        # The node at each of the sorted points
+        self._nodes = []
+
+    @staticmethod
+    def _hash(value):
+        # Stable across processes and runs, unlike hash()
+        return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+
+    def __len__(self):
+        return len(set(self._nodes))
+
+    def __contains__(self, node):
+        return node in self._nodes
+
+    def add(self, node):
+        if node in self:
+            return
+        for i in range(self.vnodes):
+            point = self._hash(f"{node}#{i}")
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._nodes.insert(index, node)
+
+    def remove(self, node):
+        kept = [(point, other) for point, other in zip(self._points, self._nodes) if other != node]
+        self._points = [point for point, _ in kept]
+        self._nodes = [other for _, other in kept]
+
+    def lookup(self, key):
+        """The node owning ``key``, None while the ring is empty."""
+        if not self._points:
+            return None
+        return self._nodes[bisect.bisect(self._points, self._hash(key)) % len(self._points)]
+
+
+def concurrency_share(total, workers, index):
+    """Worker ``index``'s part of ``total`` inference slots, at least one."""
+    return max(1, total // workers + (index < total % workers))
+
+
+def _worker_main(index, workers, conn):
+    # Ctrl-C reaches the whole process group, the supervisor decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Read by inference.py when main imports it
+    os.environ['OLLAMA_MAX_CONCURRENCY'] = str(concurrency_share(OLLAMA_MAX_CONCURRENCY, workers, index))
+    import main
+    if metrics.METRICS_PORT:
+        metrics.serve(metrics.METRICS_PORT + 1 + index)
+    asyncio.run(_serve_worker(main.build_application(), conn))
+
+
+async def _serve_worker(application, conn):
+    """Run ``application`` on the updates the supervisor sends through ``conn`` until it sends None."""
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+
+    def receive():
+        try:
+            batch = conn.recv()
+        except EOFError:
+            # The supervisor is gone
+            batch = None
+        if batch is None:
+            loop.remove_reader(conn.fileno())
+            stopped.set()
+            return
+        for data in batch:
+            application.update_queue.put_nowait(Update.de_json(data, application.bot))
+
+    # run_polling normally takes care of the hooks, here we have to call them ourselves
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        loop.add_reader(conn.fileno(), receive)
+        conn.send('ready')
+        try:
+            await stopped.wait()
+        finally:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+class _Worker:
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.started_at = 0.0
+        # Exits in a row soon after starting
+        self.failures = 0
+        self.alive = False
+        self.ready = False
+        self.closing = False
+        # (key, update data) waiting to be written to the pipe
+        self.outbox = []
+        self.wakeup = asyncio.Event()
+        self.writer = None
+
+
+class ShardSupervisor:
+    def __init__(self, workers=SHARD_WORKERS, vnodes=SHARD_VNODES, sticky=SHARD_STICKY,
+                 restart_delay=SHARD_RESTART_DELAY, backlog=SHARD_BACKLOG):
+        self.workers = [_Worker(index) for index in range(workers)]
+        if OLLAMA_MAX_CONCURRENCY < workers:
+            logger.warning("OLLAMA_MAX_CONCURRENCY=%d is less than the %d workers, each still runs one generation",
+                           OLLAMA_MAX_CONCURRENCY, workers)
+        self.ring = HashRing(vnodes)
+        self.sticky = sticky
+        self.restart_delay = restart_delay
+        # key -> (worker, monotonic time of its last update), least recent first
+        self._affinity = collections.OrderedDict()
+        self._backlog = collections.deque(maxlen=backlog)
+        # Spawned, not forked: a worker builds its own Application and event loop
+        self._context = multiprocessing.get_context('spawn')
+        self._all_ready = asyncio.Event()
+        self._stopping = False
+        self._tasks = set()
+        metrics.gauge('shard_workers_ready', "Worker processes taking updates", function=lambda: len(self.ring))
+        metrics.gauge('shard_chats_pinned', "Chats held on their last worker until they go quiet",
+                      function=lambda: len(self._affinity))
+
+    def ready(self):
+        return len(self.ring) > 0
+
+    async def start(self):
+        """Start the workers and wait until every one is ready."""
+        for worker in self.workers:
+            self._spawn(worker)
+        await self._all_ready.wait()
+        logger.info("%d shard workers ready", len(self.workers))
+
+    async def stop(self, timeout=30):
+        """Let every worker handle what it was sent and exit, killing those that take longer than ``timeout``."""
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        for worker in self.workers:
+            worker.closing = True
+            worker.wakeup.set()
+        await asyncio.gather(*(self._join(worker, timeout) for worker in self.workers if worker.process))
+
+    async def _join(self, worker, timeout):
+        await asyncio.to_thread(worker.process.join, timeout)
+        if worker.process.is_alive():
+            logger.warning("Shard worker %d did not stop in %.0fs, killing it", worker.index, timeout)
+            worker.process.kill()
+            await asyncio.to_thread(worker.process.join)
+
+    def route(self, update):
+        """Hand ``update`` to the worker of its chat."""
+        if update.effective_chat is not None:
+            key = update.effective_chat.id
+        elif update.effective_user is not None:
+            key = update.effective_user.id
+        else:
+            key = update.update_id
+        self.dispatch(key, update.to_dict())
+
+    def dispatch(self, key, data):
+        now = time.monotonic()
+        self._expire(now)
+        entry = self._affinity.pop(key, None)
+        if entry is not None and entry[0].ready:
+            worker = entry[0]
+        else:
+            index = self.ring.lookup(key)
+            if index is None:
+                if len(self._backlog) == self._backlog.maxlen:
+                    dropped.inc()
+                self._backlog.append((key, data))
+                return
+            worker = self.workers[index]
+        self._affinity[key] = (worker, now)
+        worker.outbox.append((key, data))
+        worker.wakeup.set()
+        routed.inc(worker=str(worker.index))
+
+    def _expire(self, now):
+        while self._affinity:
+            key, (_, seen) = next(iter(self._affinity.items()))
+            if now - seen < self.sticky:
+                return
+            del self._affinity[key]
+
+    def _spawn(self, worker):
+        worker.conn, child = self._context.Pipe()
+        worker.process = self._context.Process(target=_worker_main, args=(worker.index, len(self.workers), child),
+                                               name=f"shard-{worker.index}", daemon=True)
+        worker.process.start()
+        # Only the worker holds the other end now, so its exit shows as EOF here
+        child.close()
+        worker.started_at = time.monotonic()
+        worker.alive = True
+        worker.wakeup.clear()
+        worker.writer = asyncio.create_task(self._write(worker))
+        asyncio.get_running_loop().add_reader(worker.conn.fileno(), self._receive, worker)
+
+    async def _write(self, worker):
+        # Everything dispatched while the previous batch was being written goes out as one message
+        while True:
+            await worker.wakeup.wait()
+            worker.wakeup.clear()
+            if not worker.alive:
+                return
+            batch, worker.outbox = worker.outbox, []
+            try:
+                if batch:
+                    await asyncio.to_thread(worker.conn.send, [data for _, data in batch])
+                if worker.closing:
+                    worker.conn.send(None)
+                    return
+            except OSError:
+                # Exited, the batch goes to the other workers
+                worker.outbox[:0] = batch
+                return
+
+    def _receive(self, worker):
+        try:
+            message = worker.conn.recv()
+        except (EOFError, OSError):
+            self._exited(worker)
+            return
+        if message == 'ready':
+            worker.ready = True
+            self.ring.add(worker.index)
+            if all(other.ready for other in self.workers):
+                self._all_ready.set()
+            while self._backlog:
+                self.dispatch(*self._backlog.popleft())
+
+    def _exited(self, worker):
+        asyncio.get_running_loop().remove_reader(worker.conn.fileno())
+        worker.alive = False
+        worker.ready = False
+        self.ring.remove(worker.index)
+        worker.wakeup.set()
+        task = asyncio.create_task(self._restart(worker))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _restart(self, worker):
+        await worker.writer
+        worker.conn.close()
+        pending, worker.outbox = worker.outbox, []
+        for key, data in pending:
+            self.dispatch(key, data)
+        await asyncio.to_thread(worker.process.join)
+        if self._stopping:
+            return
+
+        lived = time.monotonic() - worker.started_at
+        worker.failures = worker.failures + 1 if lived < SHARD_STABLE_AFTER else 1
+        delay = min(self.restart_delay * 2 ** (worker.failures - 1), SHARD_STABLE_AFTER)
+        logger.warning("Shard worker %d exited with code %s after %.0fs, restarting it in %.1fs",
+                       worker.index, worker.process.exitcode, lived, delay)
+        await asyncio.sleep(delay)
+        restarts.inc(worker=str(worker.index))
+        self._spawn(worker)
+
+
+def main():
+    logging_setup.configure()
+
+    supervisor = ShardSupervisor()
+
+    async def route(update, context):
+        supervisor.route(update)
+
+    # Updates are handed out in the order they arrive, the workers run the handlers concurrently
+    application = (
+        Application.builder()
+        .token(os.getenv("API_KEY"))
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .post_init(lambda application: supervisor.start())
+        .post_shutdown(lambda application: supervisor.stop())
+        .build()
+    )
+    application.add_handler(TypeHandler(Update, route))
+
+    # The webhook server has its own /metrics, a polling bot needs a port for it
+    if metrics.METRICS_PORT and BOT_MODE != 'webhook':
+        metrics.serve()
+
+    run_bot(application, ready=supervisor.ready)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Startup helpers for the bot: lazy imports and a warm pool of Ollama models.
+
+Loading a model into Ollama takes far longer than answering with it, so the
+configured models are loaded before the bot starts taking updates and pinged
+again every OLLAMA_WARM_INTERVAL seconds, well inside OLLAMA_KEEP_ALIVE, so
+they are never unloaded while the bot is idle.
+"""
+import asyncio
+import importlib.util
+import logging
+import os
+import sys
+import time
+
+from inference import OLLAMA_KEEP_ALIVE
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_WARM_INTERVAL = float(os.getenv('OLLAMA_WARM_INTERVAL', '300'))
+# Give up waiting for the initial load after this long and start anyway
+OLLAMA_WARM_TIMEOUT = float(os.getenv('OLLAMA_WARM_TIMEOUT', '600'))
+
+
+def lazy_import(name):
+    """Import ``name`` but only execute the module on first attribute access."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named {name!r}")
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+class ModelWarmPool:
+    def __init__(self, clients, chat_models, embed_models=(), interval=OLLAMA_WARM_INTERVAL,
+                 keep_alive=OLLAMA_KEEP_ALIVE):
+        """``clients`` are the Ollama clients of every host the models should be warm on."""
+        self.clients = list(clients)
+        self.chat_models = list(dict.fromkeys(m for m in chat_models if m))
+        self.embed_models = list(dict.fromkeys(m for m in embed_models if m))
+        self.interval = interval
+        self.keep_alive = keep_alive
+        # Set once every model has been loaded at least once
+        self.ready = asyncio.Event()
+        self._refresher = None
+
+    async def start(self, timeout=OLLAMA_WARM_TIMEOUT):
+        """Load all models, then keep them warm in the background.
+
+        Returns once the models are loaded or ``timeout`` has passed, whichever
+        comes first.
+        """
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self._warm_all(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Models are still loading after %.0fs, starting anyway", timeout)
+        except Exception:
+            logger.warning("Failed to warm models, starting anyway", exc_info=True)
+        else:
+            self.ready.set()
+            logger.info("Models %s are warm after %.1fs",
+                        ', '.join(self.chat_models + self.embed_models), time.monotonic() - started)
+        self._refresher = asyncio.create_task(self._refresh())
+
+    async def stop(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            await asyncio.gather(self._refresher, return_exceptions=True)
+            self._refresher = None
+
+    async def _refresh(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self._warm_all()
+            except Exception:
+                logger.warning("Failed to refresh warm models", exc_info=True)
+                continue
+            self.ready.set()
+
+    async def _warm_all(self):
+        await asyncio.gather(
+            *(self._warm_chat(client, model) for client in self.clients for model in self.chat_models),
+            *(self._warm_embed(client, model) for client in self.clients for model in self.embed_models),
+        )
+
+    async def _warm_chat(self, client, model):
+        # A generate request without a prompt only loads the model
+        await client.generate(model=model, keep_alive=self.keep_alive)
+
+    async def _warm_embed(self, client, model):
+        await client.embed(model=model, input='warmup', keep_alive=self.keep_alive)
@@ -0,0 +1,164 @@
+"""Progressive delivery of a streamed model reply to Telegram.
+
+The first tokens are sent as a new reply right away, or replace a placeholder
+that was, later tokens are shown by editing that message. Edits are coalesced so a chat gets at most one edit per
+``STREAM_EDIT_INTERVAL`` seconds, which keeps us inside Telegram's edit rate
+limits no matter how fast the model produces tokens. Once the text outgrows a
+single message the stream rolls over to a new one, cut where ``split`` says;
+``render`` turns the text into what is sent, e.g. Telegram HTML.
+"""
+import asyncio
+import logging
+import os
+import time
+
+from telegram.error import BadRequest, RetryAfter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))
+# Telegram's hard limit for the text of one message
+MESSAGE_LIMIT = 4096
+
+# Same metrics as the background sender, so both kinds of sends show up together
+send_seconds = metrics.histogram('telegram_send_seconds', "Duration of a successful Bot API call", ['method'])
+throttled = metrics.counter('telegram_throttled_total', "Bot API calls answered with 429", ['method'])
+
+
+def split_point(text, limit):
+    """Index to cut ``text`` at so the head fits in ``limit`` characters.
+
+    Prefers a paragraph break, then a line break, then a space, as long as the
+    cut keeps at least half of the allowed length.
+    """
+    if len(text) <= limit:
+        return len(text)
+    for sep in ('\n\n', '\n', ' '):
+        idx = text.rfind(sep, limit // 2, limit)
+        if idx != -1:
+            return idx + len(sep)
+    return limit
+
+
+def split_at_point(text, limit):
+    """Default ``split`` of ``StreamingReply``: the text up to ``split_point`` and the rest."""
+    cut = split_point(text, limit)
+    return text[:cut], text[cut:]
+
+
+def retry_delay(error):
+    """Seconds to wait after a RetryAfter, whichever type the library reports it in."""
+    delay = error.retry_after
+    return delay.total_seconds() if hasattr(delay, 'total_seconds') else float(delay)
+
+
+class StreamingReply:
+    """Reply to ``message`` with text that keeps growing.
+
+    Use as an async context manager and call ``write`` for every chunk; leaving
+    the block flushes whatever is still pending::
+
+        async with StreamingReply(update.message) as reply:
+            async for part in stream:
+                reply.write(part.message.content)
+    """
+
+    def __init__(self, message, interval=STREAM_EDIT_INTERVAL, limit=MESSAGE_LIMIT, split=split_at_point,
+                 render=None, placeholder=None):
+        """``split(text, limit)`` returns the head of ``text`` that ends the current
+        message, at most ``limit`` characters, and the rest that starts the next one.
+        ``render(text)`` returns the text to send and its parse mode; the text is
+        sent as is if Telegram can't parse it. ``placeholder`` is a message already
+        sent, e.g. while the model was thinking, that the first text replaces."""
+        self._message = message
+        self._interval = interval
+        self._limit = limit
+        self._split = split
+        self._render = render
+        # Everything written, as written; the messages may add to it at the cuts
+        self._written = ''
+        # Text of the message currently being edited, and what it shows right now
+        self._text = ''
+        self._shown = ''
+        self._current = placeholder
+        self._changed = asyncio.Event()
+        self._closed = asyncio.Event()
+        self._flusher = None
+
+    @property
+    def text(self):
+        """Everything written so far."""
+        return self._written
+
+    async def __aenter__(self):
+        self._flusher = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            return
+        self._closed.set()
+        self._changed.set()
+        await self._flusher
+
+    def write(self, chunk):
+        if chunk:
+            self._written += chunk
+            self._text += chunk
+            self._changed.set()
+
+    async def _run(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            await self._flush()
+            if self._closed.is_set():
+                if self._changed.is_set():
+                    continue
+                return
+            # Let tokens pile up until the next edit is allowed; a close ends the wait early
+            try:
+                await asyncio.wait_for(self._closed.wait(), self._interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _flush(self):
+        while len(self._text) > self._limit:
+            head, self._text = self._split(self._text, self._limit)
+            if head.strip():
+                await self._show(head)
+            self._current = None
+            self._shown = ''
+        if self._text.strip() and self._text != self._shown:
+            await self._show(self._text)
+
+    async def _show(self, text):
+        body, parse_mode = self._render(text) if self._render is not None else (text, None)
+        while True:
+            method = 'sendMessage' if self._current is None else 'editMessageText'
+            started = time.perf_counter()
+            try:
+                if self._current is None:
+                    self._current = await self._message.reply_text(body, parse_mode=parse_mode)
+                else:
+                    await self._current.edit_text(body, parse_mode=parse_mode)
+                send_seconds.observe(time.perf_counter() - started, method=method)
+                self._shown = text
+                return
+            except RetryAfter as e:
+                throttled.inc(method=method)
+                logger.warning("Telegram asked to slow down edits for %.1fs", retry_delay(e))
+                await asyncio.sleep(retry_delay(e))
+            except BadRequest as e:
+                if parse_mode is not None and 'parse entities' in str(e).lower():
+                    logger.warning("Telegram could not parse the streamed reply, sending it as plain text: %s", e)
+                    body, parse_mode = text, None
+                    continue
+                if 'not modified' not in str(e).lower():
+                    raise
+                self._shown = text
+                return
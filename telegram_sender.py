@@ -0,0 +1,333 @@
+"""Outbound Telegram messages for every entry point.
+
+Messages are queued and sent as fast as Telegram allows, and no faster:
+
+* a global token bucket keeps the bot under TELEGRAM_GLOBAL_RATE messages per second
+* a chat gets at most one message per TELEGRAM_CHAT_INTERVAL seconds, in order
+* a 429 is retried after the retry_after Telegram asks for, network errors and
+  5xx after an exponential backoff, up to TELEGRAM_SEND_ATTEMPTS attempts
+
+Every send that is allowed to go out is dispatched right away, so a burst for
+many chats goes out in parallel over one pooled keep-alive HTTP client.
+
+Async code uses ``TelegramSender`` directly. Flask and other sync code call
+``send_message_to_telegram``, which hands the message to a sender running on a
+background event loop thread. The Lambda sends its one confirmation itself,
+since nothing may run on after its handler returns.
+"""
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+import httpx
+
+import metrics
+from http_client import new_async_client
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))
+TELEGRAM_CHAT_INTERVAL = float(os.getenv('TELEGRAM_CHAT_INTERVAL', '1.0'))
+TELEGRAM_SEND_ATTEMPTS = int(os.getenv('TELEGRAM_SEND_ATTEMPTS', '5'))
+# Upper bound on requests in flight, and on pooled connections to api.telegram.org
+TELEGRAM_MAX_CONNECTIONS = int(os.getenv('TELEGRAM_MAX_CONNECTIONS', '20'))
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org')
+
+
+send_seconds = metrics.histogram('telegram_send_seconds', "Duration of a successful Bot API call", ['method'])
+sends = metrics.counter('telegram_sends_total', "Bot API call attempts by outcome", ['method', 'result'])
+throttled = metrics.counter('telegram_throttled_total', "Bot API calls answered with 429", ['method'])
+
+
+class TelegramSendError(Exception):
+    """Raised when Telegram rejects a message or it could not be sent after all attempts."""
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """Seconds until a token is available."""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+
+class _Send:
+    __slots__ = ('method', 'payload', 'future', 'attempts')
+
+    def __init__(self, method, payload, future):
+        self.method = method
+        self.payload = payload
+        self.future = future
+        self.attempts = 0
+
+
+class TelegramSender:
+    def __init__(self, token, rate=TELEGRAM_GLOBAL_RATE, chat_interval=TELEGRAM_CHAT_INTERVAL,
+                 max_attempts=TELEGRAM_SEND_ATTEMPTS, max_connections=TELEGRAM_MAX_CONNECTIONS, client=None):
+        self.base_url = f"{TELEGRAM_API_URL}/bot{token}"
+        self.chat_interval = chat_interval
+        self.max_attempts = max_attempts
+        self.client = client or new_async_client(pool_size=max_connections)
+        self._bucket = TokenBucket(rate)
+        self._slots = asyncio.Semaphore(max_connections)
+        # chat_id -> sends waiting for that chat, oldest first
+        self._chats = {}
+        # (ready_at, seq, chat_id) for chats with waiting sends and nothing in flight
+        self._ready = []
+        self._seq = itertools.count()
+        # Chats that are in _ready or have a send in flight
+        self._active = set()
+        # chat_id -> earliest time the next send to it may start
+        self._next_allowed = {}
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._dispatcher = None
+        self._size = 0
+        self._in_flight = 0
+        # Metrics
+        self.sent = 0
+        self.failed = 0
+        self.throttled = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    @property
+    def queue_depth(self):
+        return self._size
+
+    def stats(self):
+        return {
+            'queue_depth': self._size,
+            'in_flight': self._in_flight,
+            'sent': self.sent,
+            'failed': self.failed,
+            'throttled': self.throttled,
+            'latency_avg': self.latency_total / self.sent if self.sent else 0.0,
+            'latency_max': self.latency_max,
+        }
+
+    async def start(self):
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def stop(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+        await self.client.aclose()
+
+    async def join(self):
+        """Wait until every queued message has been sent or has failed."""
+        await self._idle.wait()
+
+    def send_message(self, chat_id, text, **params):
+        """Queue a sendMessage call. Returns a future with the sent Message as a dict."""
+        return self.call('sendMessage', chat_id, {'chat_id': chat_id, 'text': text, **params})
+
+    def call(self, method, chat_id, payload):
+        """Queue any Bot API ``method`` addressed to ``chat_id``."""
+        item = _Send(method, payload, asyncio.get_running_loop().create_future())
+        queue = self._chats.setdefault(chat_id, collections.deque())
+        queue.append(item)
+        self._size += 1
+        self._idle.clear()
+        if chat_id not in self._active:
+            self._active.add(chat_id)
+            self._schedule(chat_id)
+        return item.future
+
+    def _schedule(self, chat_id):
+        ready_at = self._next_allowed.get(chat_id, 0.0)
+        heapq.heappush(self._ready, (ready_at, next(self._seq), chat_id))
+        self._wakeup.set()
+
+    async def _dispatch(self):
+        while True:
+            if not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            ready_at, _, chat_id = self._ready[0]
+            wait = max(ready_at - time.monotonic(), self._bucket.delay())
+            if wait > 0:
+                # A send for another chat may become ready sooner
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._slots.acquire()
+            # Waiting for a slot may have let an even earlier chat in front
+            _, _, chat_id = heapq.heappop(self._ready)
+            self._bucket.take()
+            item = self._chats[chat_id].popleft()
+            self._in_flight += 1
+            asyncio.create_task(self._deliver(chat_id, item))
+
+    async def _deliver(self, chat_id, item):
+        retry_in = None
+        item.attempts += 1
+        started = time.monotonic()
+        try:
+            response = await self.client.post(f"{self.base_url}/{item.method}", json=item.payload)
+            data = response.json()
+            if response.status_code == 429:
+                self.throttled += 1
+                throttled.inc(method=item.method)
+                sends.inc(method=item.method, result='throttled')
+                retry_in = float(data.get('parameters', {}).get('retry_after', 1))
+                logger.warning("Telegram rate limited chat %s, retrying in %.0fs", chat_id, retry_in)
+            elif response.status_code >= 500:
+                sends.inc(method=item.method, result='error')
+                retry_in = 2 ** (item.attempts - 1)
+            elif not data.get('ok'):
+                sends.inc(method=item.method, result='rejected')
+                self._fail(item, TelegramSendError(data.get('description', f"HTTP {response.status_code}")))
+            else:
+                latency = time.monotonic() - started
+                send_seconds.observe(latency, method=item.method)
+                sends.inc(method=item.method, result='sent')
+                self.sent += 1
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+                if not item.future.done():
+                    item.future.set_result(data['result'])
+        except (httpx.HTTPError, ValueError) as e:
+            logger.warning("Failed to reach Telegram: %s", e)
+            sends.inc(method=item.method, result='error')
+            retry_in = 2 ** (item.attempts - 1)
+        finally:
+            self._slots.release()
+            self._in_flight -= 1
+
+        now = time.monotonic()
+        self._next_allowed[chat_id] = now + self.chat_interval
+        queue = self._chats[chat_id]
+        if retry_in is not None and item.attempts < self.max_attempts:
+            queue.appendleft(item)
+            self._next_allowed[chat_id] = now + retry_in
+        else:
+            if retry_in is not None:
+                self._fail(item, TelegramSendError(f"giving up after {item.attempts} attempts"))
+            self._size -= 1
+
+        if queue:
+            self._schedule(chat_id)
+        else:
+            del self._chats[chat_id]
+            self._active.discard(chat_id)
+            if len(self._next_allowed) > 10000:
+                self._next_allowed = {c: t for c, t in self._next_allowed.items() if t > now}
+        if self._size == 0 and self._in_flight == 0:
+            self._idle.set()
+
+    def _fail(self, item, error):
+        self.failed += 1
+        if not item.future.done():
+            item.future.set_exception(error)
+
+
+class ThreadedSender:
+    """A ``TelegramSender`` on its own event loop thread, for sync code."""
+
+    def __init__(self, token, **kwargs):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='telegram-sender', daemon=True)
+        self._thread.start()
+        self.sender = self._run(self._create(token, kwargs))
+
+    async def _create(self, token, kwargs):
+        sender = TelegramSender(token, **kwargs)
+        await sender.start()
+        return sender
+
+    def _run(self, coro, timeout=None):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout)
+
+    def send_message(self, chat_id, text, **params):
+        """Queue a message. Returns a concurrent.futures.Future that resolves once it is sent."""
+        async def send():
+            return await self.sender.send_message(chat_id, text, **params)
+        return asyncio.run_coroutine_threadsafe(send(), self._loop)
+
+    def flush(self, timeout=None):
+        """Block until everything queued so far has been sent or has failed."""
+        self._run(self.sender.join(), timeout)
+
+    def stats(self):
+        return self._run(self._stats())
+
+    async def _stats(self):
+        return self.sender.stats()
+
+    def close(self, timeout=None):
+        """Send what is queued, then stop the sender and its thread."""
+        self.flush(timeout)
+        self._run(self.sender.stop(), timeout)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
+        self._loop.close()
+
+
+_senders = {}
+_senders_lock = threading.Lock()
+
+metrics.gauge('telegram_send_queue_depth', "Messages waiting in the background senders",
+              function=lambda: sum(sender.sender.queue_depth for sender in list(_senders.values())))
+
+
+def get_sender(token):
+    """The process wide ``ThreadedSender`` for ``token``, started on first use."""
+    with _senders_lock:
+        sender = _senders.get(token)
+        if sender is None:
+            sender = _senders[token] = ThreadedSender(token)
+        return sender
+
+
+def shutdown(timeout=None):
+    """Close every sender started by ``get_sender``."""
+    with _senders_lock:
+        senders = list(_senders.values())
+        _senders.clear()
+    for sender in senders:
+        sender.close(timeout)
+
+
+def log_failure(future):
+    """Done callback for a send nobody awaits, logs it if it failed after all its attempts."""
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning("Failed to send Telegram message: %s", future.exception())
+
+
+def send_message_to_telegram(token, chat_id, text):
+    """Queue ``text`` for ``chat_id`` from sync code and return right away.
+
+    The sender retries the message itself and logs it if it gives up. Callers
+    don't wait for it or retry it: a retried call would queue the message again,
+    and the first one may still be sent.
+    """
+    get_sender(token).send_message(chat_id, text).add_done_callback(log_failure)
@@ -2,28 +2,41 @@ from dotenv import load_dotenv
 import os
 
 from flask import Flask, request, redirect, session
-import requests
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ApplicationBuilder, CommandHandler, CallbackContext, CallbackQueryHandler
 import json
-import uuid
 import threading  # Add this import at the top
 
 # Load .env file
 load_dotenv()
 
+# Local modules read their configuration on import, so only after .env is loaded
+import background
+import http_client
+import logging_setup
+import metrics
+from oauth_state import create_state_store
+from telegram_sender import send_message_to_telegram
+from webhook import run_bot
+
 # Configuration
 TELEGRAM_TOKEN = os.getenv("API_KEY")
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
 GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
-REDIRECT_URI = "http://127.0.0.1:5000/oauth/callback"
+REDIRECT_URI = os.getenv("GOOGLE_REDIRECT_URI", "http://127.0.0.1:5000/oauth/callback")
+# "flask" serves /oauth/callback from a thread of the bot process, "none" leaves it to asgi_app.py
+OAUTH_SERVER = os.getenv("OAUTH_SERVER", "flask")
+GOOGLE_TOKEN_URL = os.getenv("GOOGLE_TOKEN_URL", "https://oauth2.googleapis.com/token")
+GOOGLE_USERINFO_URL = os.getenv("GOOGLE_USERINFO_URL", "https://www.googleapis.com/oauth2/v1/userinfo")
 
 # Initialize Flask app
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
+# Request latency by route, served on /metrics together with the bot's metrics
+metrics.instrument_flask(app, 'google_oauth')
 
-# User sessions to track authentication state
-user_sessions = {}
+# Pending logins by OAuth state, to map a callback back to its Telegram user
+user_sessions = create_state_store()
 
 
 application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
@@ -31,12 +44,12 @@ application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
 dispatcher = application
 
 # Command handler for /start
+@metrics.instrument_handler
 async def start(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
     
     # Generate a unique state token for this user
-    state = str(uuid.uuid4())
-    user_sessions[state] = {"telegram_id": user_id}
+    state = user_sessions.issue({"telegram_id": user_id})
     
     # Create login URL
     auth_url = (
@@ -59,12 +72,12 @@ async def start(update: Update, context: CallbackContext) -> None:
     )
 
 
+@metrics.instrument_handler
 async def goweb(update, context):
     user_id = update.effective_user.id
     
     # Generate a unique state token for this user
-    state = str(uuid.uuid4())
-    user_sessions[state] = {"telegram_id": user_id}
+    state = user_sessions.issue({"telegram_id": user_id})
     url = (
         f"https://accounts.google.com/o/oauth2/auth"
         f"?client_id={GOOGLE_CLIENT_ID}"
@@ -91,14 +104,15 @@ def oauth_callback():
     code = request.args.get('code')
     state = request.args.get('state')
     
-    # Verify state to prevent CSRF
-    if state not in user_sessions:
+    # Verify state to prevent CSRF, each state can be used once
+    login = user_sessions.pop(state)
+    if login is None:
         return "Invalid state parameter", 400
     
-    telegram_id = user_sessions[state]["telegram_id"]
+    telegram_id = login["telegram_id"]
     
     # Exchange code for tokens
-    token_url = "https://oauth2.googleapis.com/token"
+    token_url = GOOGLE_TOKEN_URL
     token_data = {
         "code": code,
         "client_id": GOOGLE_CLIENT_ID,
@@ -107,50 +121,45 @@ def oauth_callback():
         "grant_type": "authorization_code"
     }
     
-    token_response = requests.post(token_url, data=token_data)
+    with metrics.timed('google.token', metrics.oauth_request_seconds, provider='google', step='token'):
+        token_response = http_client.post(token_url, data=token_data)
     token_json = token_response.json()
     
     if "access_token" not in token_json:
         return "Failed to get access token", 400
     
-    # Get user info with the access token
-    user_info_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    headers = {"Authorization": f"Bearer {token_json['access_token']}"}
-    user_info_response = requests.get(user_info_url, headers=headers)
-    user_info = user_info_response.json()
-    
-    # Store user info in session
-    user_sessions[state]["google_user"] = user_info
-    
-    # Send message to user via Telegram
-    send_message_to_telegram(telegram_id, f"Successfully logged in as {user_info.get('name', 'User')} ({user_info.get('email', 'No email')})")
-    
-    # Clean up session
-    del user_sessions[state]
+    # The profile and the Telegram message don't change the answer, finish them after responding
+    background.submit(confirm_login, telegram_id, token_json['access_token'])
     
     return "Authentication successful! You can close this window and return to Telegram."
 
 
-# ✅ Send Telegram Message After Binding
-def send_message_to_telegram(chat_id, text):
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-    payload = {
-        "chat_id": chat_id,
-        "text": text
-    }
-    requests.post(url, json=payload)
+def confirm_login(telegram_id, access_token):
+    """Tell the user in Telegram who they logged in as. Runs on the background pool, retried if
+    the profile lookup fails; the message is only queued, the sender retries it on its own."""
+    headers = {"Authorization": f"Bearer {access_token}"}
+    with metrics.timed('google.profile', metrics.oauth_request_seconds, provider='google', step='profile'):
+        user_info_response = http_client.get(GOOGLE_USERINFO_URL, headers=headers)
+    user_info_response.raise_for_status()
+    user_info = user_info_response.json()
+    
+    # Send message to user via Telegram
+    send_message_to_telegram(TELEGRAM_TOKEN, telegram_id, f"Successfully logged in as {user_info.get('name', 'User')} ({user_info.get('email', 'No email')})")
 
 
 # Start the bot and Flask server
 # Update the start section:
 if __name__ == '__main__':
+    logging_setup.configure()
+
     # Register command handlers
     dispatcher.add_handler(CommandHandler("start", start))
     dispatcher.add_handler(CommandHandler("goweb", goweb))
     
     # Start Flask server in the main thread
-    bot_thread = threading.Thread(target=app.run, args=('0.0.0.0', 5000), kwargs={'debug': False})
-    bot_thread.daemon = True  # This makes the thread exit when the main program exits
-    bot_thread.start()
+    if OAUTH_SERVER == "flask":
+        bot_thread = threading.Thread(target=app.run, args=('0.0.0.0', 5000), kwargs={'debug': False})
+        bot_thread.daemon = True  # This makes the thread exit when the main program exits
+        bot_thread.start()
     
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    run_bot(application)
@@ -0,0 +1,231 @@
+"""Refreshes the Twitter access tokens of stored bindings before they expire.
+
+Twitter access tokens live for two hours. The OAuth callbacks store the refresh
+token and the expiry with the binding, and this scheduler trades the refresh
+token for a new pair TOKEN_REFRESH_LEAD seconds before the access token
+expires. Readers like the tweet pipeline just read the binding and find a token
+that is still valid; nothing refreshes inline on their path.
+
+Bindings wait in a heap ordered by when they are due, so finding the next one
+is O(log n) however many there are. Refreshes that are due together go out as
+one batch of concurrent requests, at most TOKEN_REFRESH_BATCH at a time and
+TOKEN_REFRESH_RATE per second. A failed refresh is retried with a backoff; one
+Twitter rejects (the refresh token was revoked or already used) is dropped
+until the binding changes. The heap is filled from a scan of the store at start
+and every TOKEN_REFRESH_RESCAN seconds, which picks up bindings stored by the
+web apps in other processes.
+
+Twitter rotates the refresh token on every use, so run exactly one refresher
+per store: two would race and invalidate each other's tokens. The tweet
+pipeline starts one; ``python token_refresh.py`` runs it alone.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+
+import httpx
+
+import logging_setup
+import metrics
+from binding_store import create_store
+from http_client import new_async_client
+from telegram_sender import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+TWITTER_API_URL = os.getenv('TWITTER_API_URL', 'https://api.twitter.com')
+TWITTER_CLIENT_ID = os.getenv('TWITTER_CLIENT_ID')
+TWITTER_CLIENT_SECRET = os.getenv('TWITTER_CLIENT_SECRET')
+# Seconds before expiry a token is refreshed; longer than the rescan so new bindings are seen in time
+TOKEN_REFRESH_LEAD = float(os.getenv('TOKEN_REFRESH_LEAD', '600'))
+TOKEN_REFRESH_RESCAN = float(os.getenv('TOKEN_REFRESH_RESCAN', '300'))
+TOKEN_REFRESH_BATCH = int(os.getenv('TOKEN_REFRESH_BATCH', '20'))
+TOKEN_REFRESH_RATE = float(os.getenv('TOKEN_REFRESH_RATE', '10'))
+TOKEN_REFRESH_ATTEMPTS = int(os.getenv('TOKEN_REFRESH_ATTEMPTS', '5'))
+
+refreshes = metrics.counter('twitter_token_refreshes_total', "Access token refreshes by outcome", ['result'])
+refresh_seconds = metrics.histogram('twitter_token_refresh_seconds', "Duration of a token refresh request")
+
+
+class TokenRefresher:
+    def __init__(self, store, client=None, lead=TOKEN_REFRESH_LEAD, rescan=TOKEN_REFRESH_RESCAN,
+                 batch_size=TOKEN_REFRESH_BATCH, rate=TOKEN_REFRESH_RATE, max_attempts=TOKEN_REFRESH_ATTEMPTS):
+        self.store = store
+        self.client = client or new_async_client(pool_size=batch_size)
+        self.lead = lead
+        self.rescan_interval = rescan
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self._bucket = TokenBucket(rate)
+        self._bucket_lock = asyncio.Lock()
+        # (due_at, seq, chat_id, expires_at), due_at in epoch seconds
+        self._heap = []
+        self._seq = itertools.count()
+        # chat_id -> expires_at of the token it is scheduled for; heap entries for another expiry are stale
+        self._scheduled = {}
+        # chat_id -> expires_at of a token Twitter refused to refresh
+        self._rejected = {}
+        self._attempts = {}
+        self._wakeup = asyncio.Event()
+        metrics.gauge('twitter_tokens_scheduled', "Bindings waiting for their next token refresh",
+                      function=lambda: len(self._scheduled))
+
+    async def close(self):
+        await self.client.aclose()
+
+    def track(self, binding):
+        """Schedule the refresh of ``binding``'s token, replacing any earlier schedule for its chat."""
+        expires_at = binding.get('expires_at')
+        if not binding.get('refresh_token') or expires_at is None:
+            return
+        chat_id = str(binding['chat_id'])
+        expires_at = int(expires_at)
+        if self._scheduled.get(chat_id) == expires_at or self._rejected.get(chat_id) == expires_at:
+            return
+        self._rejected.pop(chat_id, None)
+        self._schedule(chat_id, expires_at, expires_at - self.lead)
+
+    def _schedule(self, chat_id, expires_at, due_at):
+        self._scheduled[chat_id] = expires_at
+        heapq.heappush(self._heap, (due_at, next(self._seq), chat_id, expires_at))
+        self._wakeup.set()
+
+    async def rescan(self):
+        pages = self.store.pages()
+        while True:
+            page = await asyncio.to_thread(next, pages, None)
+            if page is None:
+                return
+            for binding in page:
+                self.track(binding)
+
+    async def run(self):
+        next_rescan = 0.0
+        while True:
+            if time.monotonic() >= next_rescan:
+                try:
+                    await self.rescan()
+                except Exception:
+                    logger.exception("Failed to scan the bindings for token refreshes")
+                next_rescan = time.monotonic() + self.rescan_interval
+
+            batch = self._due(time.time())
+            if batch:
+                results = await asyncio.gather(*(self._refresh(chat_id, expires_at) for chat_id, expires_at in batch),
+                                               return_exceptions=True)
+                for (chat_id, expires_at), result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        logger.error("Failed to refresh the token of chat %s", chat_id, exc_info=result)
+                        refreshes.inc(result='error')
+                        self._retry(chat_id, expires_at)
+                continue
+
+            wait = next_rescan - time.monotonic()
+            if self._heap:
+                wait = min(wait, self._heap[0][0] - time.time())
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(wait, 0.0))
+            except asyncio.TimeoutError:
+                pass
+
+    def _due(self, now):
+        batch = []
+        while self._heap and self._heap[0][0] <= now and len(batch) < self.batch_size:
+            _, _, chat_id, expires_at = heapq.heappop(self._heap)
+            if self._scheduled.get(chat_id) == expires_at:
+                batch.append((chat_id, expires_at))
+        return batch
+
+    async def _take_budget(self):
+        async with self._bucket_lock:
+            while (delay := self._bucket.delay()) > 0:
+                await asyncio.sleep(delay)
+            self._bucket.take()
+
+    async def _refresh(self, chat_id, expires_at):
+        # Read it again, the user may have logged in anew since it was scheduled
+        binding = await asyncio.to_thread(self.store.get, chat_id)
+        if binding is None:
+            self._forget(chat_id)
+            return
+        if int(binding.get('expires_at') or 0) != expires_at:
+            self._forget(chat_id)
+            self.track(binding)
+            return
+
+        await self._take_budget()
+        started = time.monotonic()
+        try:
+            response = await self.client.post(
+                f"{TWITTER_API_URL}/2/oauth2/token",
+                data={'grant_type': 'refresh_token', 'refresh_token': binding['refresh_token'],
+                      'client_id': TWITTER_CLIENT_ID},
+                auth=(TWITTER_CLIENT_ID, TWITTER_CLIENT_SECRET),
+            )
+        except httpx.HTTPError as e:
+            logger.warning("Failed to refresh the token of chat %s: %s", chat_id, e)
+            refreshes.inc(result='error')
+            self._retry(chat_id, expires_at)
+            return
+        refresh_seconds.observe(time.monotonic() - started)
+
+        if response.status_code == 429 or response.status_code >= 500:
+            refreshes.inc(result='error')
+            self._retry(chat_id, expires_at)
+            return
+        if response.status_code != 200:
+            # invalid_grant: revoked, or the refresh token was already used
+            logger.warning("Twitter refused to refresh the token of chat %s: %s", chat_id, response.text)
+            refreshes.inc(result='rejected')
+            self._forget(chat_id)
+            self._rejected[chat_id] = expires_at
+            return
+
+        tokens = response.json()
+        refreshed = {
+            **binding,
+            'access_token': tokens['access_token'],
+            # Twitter sends a new refresh token each time, the old one is now spent
+            'refresh_token': tokens.get('refresh_token', binding['refresh_token']),
+            'expires_at': int(time.time()) + int(tokens.get('expires_in', 7200)),
+        }
+        await asyncio.to_thread(self.store.upsert, refreshed)
+        refreshes.inc(result='refreshed')
+        self._forget(chat_id)
+        self.track(refreshed)
+
+    def _retry(self, chat_id, expires_at):
+        attempts = self._attempts[chat_id] = self._attempts.get(chat_id, 0) + 1
+        if attempts >= self.max_attempts:
+            logger.error("Giving up refreshing the token of chat %s after %d attempts", chat_id, attempts)
+            self._forget(chat_id)
+            self._rejected[chat_id] = expires_at
+            return
+        self._schedule(chat_id, expires_at, time.time() + min(5 * 2 ** attempts, self.lead / 2))
+
+    def _forget(self, chat_id):
+        self._scheduled.pop(chat_id, None)
+        self._attempts.pop(chat_id, None)
+
+
+async def run():
+    refresher = TokenRefresher(create_store())
+    try:
+        await refresher.run()
+    finally:
+        await refresher.close()
+
+
+def main():
+    logging_setup.configure()
+    if metrics.METRICS_PORT:
+        metrics.serve()
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
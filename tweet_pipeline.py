@@ -0,0 +1,416 @@
+"""Delivers new tweets from the home timelines of bound Twitter accounts to their chats.
+
+Every TWEET_POLL_INTERVAL seconds a cycle walks the binding store a page at a
+time. For each page:
+
+* bindings are grouped by Twitter account, so an account linked to several
+  chats is fetched once per page; bindings of it on later pages fetch it again
+  from the same since_id up to the same newest tweet, so every chat gets the
+  same tweets without the cycle holding on to them
+* the home timelines of the page's accounts are fetched concurrently, at most
+  TWEET_FETCH_CONCURRENCY at a time and at most TWITTER_REQUEST_RATE requests
+  per second over all of them, each only for tweets after the account's
+  since_id checkpoint
+* a tweet that shows up in several timelines, because their owners follow the
+  same account, is formatted once and fanned out to every chat through the
+  ``TelegramSender`` queue, which paces Telegram for us
+* the page's checkpoints are saved in one transaction once its messages have
+  been sent or have failed for good, so a crash redelivers rather than loses;
+  when more than TWEET_MAX_PAGES timeline pages are new, the checkpoint still
+  moves to the newest tweet, and the skipped older ones are logged and counted
+
+Fetching a page overlaps with delivering the one before it, and no more than
+that, so memory stays flat however many bindings there are.
+
+An account seen for the first time starts at its newest tweet and gets only the
+TWEET_BACKFILL most recent ones, so linking an account doesn't flood the chat.
+A 429 sets the account aside until the x-rate-limit-reset Twitter sends; a 401
+means the token was revoked and the account is skipped. Tokens are kept fresh
+by the ``token_refresh`` scheduler running next to the pipeline; a binding
+whose token has expired anyway is skipped without a request.
+
+    python tweet_pipeline.py          # poll forever
+    python tweet_pipeline.py --once   # one cycle, e.g. from cron
+"""
+import argparse
+import asyncio
+import collections
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import httpx
+
+import logging_setup
+import metrics
+from binding_store import create_store
+from http_client import new_async_client
+from telegram_sender import TelegramSender, TokenBucket
+from token_refresh import TokenRefresher
+
+logger = logging.getLogger(__name__)
+
+TWITTER_API_URL = os.getenv('TWITTER_API_URL', 'https://api.twitter.com')
+TWEET_POLL_INTERVAL = float(os.getenv('TWEET_POLL_INTERVAL', '60'))
+TWEET_PAGE_SIZE = int(os.getenv('TWEET_PAGE_SIZE', '500'))
+TWEET_FETCH_CONCURRENCY = int(os.getenv('TWEET_FETCH_CONCURRENCY', '32'))
+# Budget for every Twitter request of the pipeline together, per second
+TWITTER_REQUEST_RATE = float(os.getenv('TWITTER_REQUEST_RATE', '50'))
+# Timeline pages to follow per account and cycle when more than one page of tweets is new
+TWEET_MAX_PAGES = int(os.getenv('TWEET_MAX_PAGES', '3'))
+TWEET_BACKFILL = int(os.getenv('TWEET_BACKFILL', '0'))
+# Formatted tweets kept for accounts whose timelines overlap
+TWEET_CACHE_SIZE = int(os.getenv('TWEET_CACHE_SIZE', '10000'))
+TWEET_CHECKPOINT_DB = (os.getenv('TWEET_CHECKPOINT_DB')
+                       or os.path.join(os.path.abspath(os.path.dirname(__file__)), 'tweets.db'))
+
+# Telegram takes 4096 characters, leave room for the header and the link
+MAX_TWEET_TEXT = 3900
+
+cycle_seconds = metrics.histogram('tweet_cycle_seconds', "Duration of a full pass over the bindings")
+timeline_requests = metrics.counter('twitter_timeline_requests_total', "Home timeline requests by outcome",
+                                    ['result'])
+timelines_truncated = metrics.counter('twitter_timelines_truncated_total',
+                                      "Timelines with more new tweets than TWEET_MAX_PAGES pages, the rest skipped")
+tweets_delivered = metrics.counter('tweets_delivered_total', "Tweets sent to a chat by outcome", ['result'])
+
+
+class CheckpointStore:
+    """The newest tweet id delivered per Twitter account, in SQLite."""
+
+    def __init__(self, path=TWEET_CHECKPOINT_DB):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS tweet_checkpoint ("
+            "twitter_id TEXT PRIMARY KEY, "
+            "since_id TEXT NOT NULL, "
+            "updated_at REAL NOT NULL)"
+        )
+        conn.commit()
+
+    def _connect(self):
+        # One connection per thread; sqlite3 connections must not be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, twitter_ids):
+        """``{twitter_id: since_id}`` for the accounts that have a checkpoint."""
+        twitter_ids = list(twitter_ids)
+        if not twitter_ids:
+            return {}
+        rows = self._connect().execute(
+            f"SELECT twitter_id, since_id FROM tweet_checkpoint WHERE twitter_id IN ({', '.join('?' * len(twitter_ids))})",
+            twitter_ids,
+        ).fetchall()
+        return dict(rows)
+
+    def save(self, checkpoints):
+        if not checkpoints:
+            return
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT INTO tweet_checkpoint (twitter_id, since_id, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(twitter_id) DO UPDATE SET since_id = excluded.since_id, updated_at = excluded.updated_at",
+                [(twitter_id, since_id, now) for twitter_id, since_id in checkpoints.items()],
+            )
+
+
+class _Account:
+    __slots__ = ('twitter_id', 'access_token', 'chat_ids', 'since_id', 'until_id')
+
+    def __init__(self, twitter_id, access_token):
+        self.twitter_id = twitter_id
+        self.access_token = access_token
+        self.chat_ids = []
+        self.since_id = None
+        # Newest tweet to deliver, when an earlier page of the cycle fetched the account already
+        self.until_id = None
+
+
+def format_tweet(tweet, username=None):
+    text = tweet['text']
+    if len(text) > MAX_TWEET_TEXT:
+        text = text[:MAX_TWEET_TEXT] + '…'
+    if username:
+        return f"🐦 @{username}\n\n{text}\n\nhttps://twitter.com/{username}/status/{tweet['id']}"
+    return f"🐦 {text}\n\nhttps://twitter.com/i/status/{tweet['id']}"
+
+
+class TweetPipeline:
+    def __init__(self, store, sender, checkpoints, client=None, rate=TWITTER_REQUEST_RATE,
+                 concurrency=TWEET_FETCH_CONCURRENCY, page_size=TWEET_PAGE_SIZE, backfill=TWEET_BACKFILL):
+        self.store = store
+        self.sender = sender
+        self.checkpoints = checkpoints
+        self.client = client or new_async_client(pool_size=concurrency)
+        self.page_size = page_size
+        self.backfill = backfill
+        self._bucket = TokenBucket(rate)
+        self._bucket_lock = asyncio.Lock()
+        self._fetches = asyncio.Semaphore(concurrency)
+        # twitter_id -> monotonic time before which Twitter asked us not to ask again
+        self._retry_at = {}
+        # tweet id -> formatted message, least recently used first
+        self._formatted = collections.OrderedDict()
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def run(self, interval=TWEET_POLL_INTERVAL):
+        while True:
+            started = time.monotonic()
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Tweet cycle failed")
+            await asyncio.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+    async def run_once(self):
+        """One pass over every binding. Returns the counts of the cycle."""
+        stats = collections.Counter()
+        started = time.monotonic()
+        delivery = None
+        # twitter_id -> (since_id, newest_id) of its fetch this cycle, None if that failed,
+        # so bindings on later pages get the same tweets
+        fetched = {}
+        pages = self.store.pages(self.page_size)
+        while True:
+            # The store may be DynamoDB, keep its round trips off the event loop
+            page = await asyncio.to_thread(next, pages, None)
+            if page is None:
+                break
+            stats['bindings'] += len(page)
+            messages, checkpoints = await self._fetch_page(page, fetched, stats)
+            if delivery is not None:
+                await delivery
+            delivery = asyncio.create_task(self._deliver(messages, checkpoints, stats))
+        if delivery is not None:
+            await delivery
+        stats['seconds'] = time.monotonic() - started
+        cycle_seconds.observe(stats['seconds'])
+        logger.info("Tweet cycle: %s", dict(stats))
+        return stats
+
+    async def _fetch_page(self, page, fetched, stats):
+        """Fetch the page's timelines. Returns the messages to send and the checkpoints to save after."""
+        # Bound before the id was stored, or the profile lookup after linking hasn't finished
+        unresolved = [binding for binding in page if not binding.get('twitter_id')]
+        resolved = await asyncio.gather(*(self._resolve_id(binding, stats) for binding in unresolved))
+        for binding, twitter_id in zip(unresolved, resolved):
+            binding['twitter_id'] = twitter_id
+
+        accounts = {}
+        now = time.time()
+        for binding in page:
+            twitter_id = binding['twitter_id']
+            if not twitter_id:
+                continue
+            if binding.get('expires_at') and int(binding['expires_at']) <= now:
+                stats['expired'] += 1
+                continue
+            account = accounts.get(twitter_id)
+            if account is None:
+                account = accounts[twitter_id] = _Account(twitter_id, binding['access_token'])
+            account.chat_ids.append(binding['chat_id'])
+        stats['accounts'] += len(accounts)
+
+        now = time.monotonic()
+        due = []
+        again = []
+        for account in accounts.values():
+            if account.twitter_id in fetched:
+                window = fetched[account.twitter_id]
+                # Nothing to do if the first fetch failed or found nothing new
+                if window is not None and window[1] is not None:
+                    account.since_id, account.until_id = window
+                    again.append(account)
+            elif self._retry_at.get(account.twitter_id, 0) > now:
+                stats['deferred'] += 1
+            else:
+                due.append(account)
+        since_ids = await asyncio.to_thread(self.checkpoints.get_many, [account.twitter_id for account in due])
+        for account in due:
+            account.since_id = since_ids.get(account.twitter_id)
+
+        messages = []
+        checkpoints = {}
+        results = await asyncio.gather(*(self._fetch(account, stats) for account in due + again))
+        for account, result in zip(due + again, results):
+            first = account.until_id is None
+            if result is None:
+                if first:
+                    fetched[account.twitter_id] = None
+                continue
+            tweets, users, newest_id = result
+            if first:
+                fetched[account.twitter_id] = (account.since_id, newest_id)
+                if newest_id is not None:
+                    checkpoints[account.twitter_id] = newest_id
+            # Oldest first, the sender keeps the order per chat
+            texts = [self._format(tweet, users, stats) for tweet in reversed(tweets)]
+            messages.extend((chat_id, text) for text in texts for chat_id in account.chat_ids)
+        return messages, checkpoints
+
+    async def _take_budget(self):
+        # The lock makes waiters take their turn in order instead of all waking at once
+        async with self._bucket_lock:
+            while (delay := self._bucket.delay()) > 0:
+                await asyncio.sleep(delay)
+            self._bucket.take()
+
+    async def _get(self, path, access_token, params=None):
+        await self._take_budget()
+        return await self.client.get(f"{TWITTER_API_URL}{path}", params=params,
+                                     headers={'Authorization': f"Bearer {access_token}"})
+
+    async def _resolve_id(self, binding, stats):
+        try:
+            async with self._fetches:
+                response = await self._get('/2/users/me', binding['access_token'])
+        except httpx.HTTPError as e:
+            logger.warning("Failed to look up the Twitter account of chat %s: %s", binding['chat_id'], e)
+            return None
+        if response.status_code != 200:
+            stats['unresolved'] += 1
+            return None
+        profile = response.json()['data']
+        if not await asyncio.to_thread(self._store_profile, binding, profile):
+            # Refreshed or linked again since the page was read, the next cycle looks it up with the new token
+            return None
+        return profile['id']
+
+    def _store_profile(self, binding, profile):
+        # The page may be older than the binding: the token refresh shares the store, and writing
+        # the page's copy back would restore a spent refresh token
+        current = self.store.get(binding['chat_id'])
+        if current is None or current['access_token'] != binding['access_token']:
+            return False
+        self.store.upsert({**current, 'twitter_id': profile['id'], 'twitter_handle': profile['username']})
+        return True
+
+    async def _fetch(self, account, stats):
+        """New tweets of ``account``'s home timeline, newest first and none after its
+        ``until_id``, with the authors' usernames and the id to continue from. None if
+        the timeline couldn't be fetched."""
+        params = {
+            'max_results': 100 if account.since_id else max(self.backfill, 1),
+            'tweet.fields': 'created_at,author_id',
+            'expansions': 'author_id',
+            'user.fields': 'username',
+        }
+        if account.since_id:
+            params['since_id'] = account.since_id
+        tweets = []
+        users = {}
+        newest_id = None
+        async with self._fetches:
+            for _ in range(TWEET_MAX_PAGES):
+                stats['requests'] += 1
+                try:
+                    response = await self._get(f"/2/users/{account.twitter_id}/timelines/reverse_chronological",
+                                               account.access_token, params)
+                except httpx.HTTPError as e:
+                    timeline_requests.inc(result='error')
+                    logger.warning("Failed to fetch the timeline of %s: %s", account.twitter_id, e)
+                    return None
+                if response.status_code == 429:
+                    timeline_requests.inc(result='throttled')
+                    stats['throttled'] += 1
+                    reset = float(response.headers.get('x-rate-limit-reset', time.time() + 60))
+                    self._retry_at[account.twitter_id] = time.monotonic() + max(reset - time.time(), 1.0)
+                    if len(self._retry_at) > 10000:
+                        now = time.monotonic()
+                        self._retry_at = {key: at for key, at in self._retry_at.items() if at > now}
+                    return None
+                if response.status_code != 200:
+                    timeline_requests.inc(result='rejected' if response.status_code < 500 else 'error')
+                    stats['failed_accounts'] += 1
+                    logger.warning("Timeline of %s: HTTP %d", account.twitter_id, response.status_code)
+                    return None
+                timeline_requests.inc(result='ok')
+                data = response.json()
+                page = data.get('data', [])
+                tweets.extend(page)
+                users.update((user['id'], user['username']) for user in data.get('includes', {}).get('users', []))
+                newest_id = newest_id or data.get('meta', {}).get('newest_id')
+                next_token = data.get('meta', {}).get('next_token')
+                # The first fetch of an account only wants the most recent tweets
+                if not account.since_id or not next_token:
+                    break
+                params['pagination_token'] = next_token
+            else:
+                # The checkpoint moves to the newest tweet all the same, or the account would never catch up
+                timelines_truncated.inc()
+                stats['truncated'] += 1
+                logger.warning("Timeline of %s has more than %d pages of new tweets, skipping the older ones",
+                               account.twitter_id, TWEET_MAX_PAGES)
+        if account.until_id is not None:
+            # Tweet ids grow with time
+            tweets = [tweet for tweet in tweets if int(tweet['id']) <= int(account.until_id)]
+        if not account.since_id:
+            tweets = tweets[:self.backfill]
+        stats['tweets'] += len(tweets)
+        return tweets, users, newest_id
+
+    def _format(self, tweet, users, stats):
+        text = self._formatted.get(tweet['id'])
+        if text is not None:
+            self._formatted.move_to_end(tweet['id'])
+            return text
+        stats['unique_tweets'] += 1
+        text = self._formatted[tweet['id']] = format_tweet(tweet, users.get(tweet.get('author_id')))
+        while len(self._formatted) > TWEET_CACHE_SIZE:
+            self._formatted.popitem(last=False)
+        return text
+
+    async def _deliver(self, messages, checkpoints, stats):
+        futures = [self.sender.send_message(chat_id, text) for chat_id, text in messages]
+        for result in await asyncio.gather(*futures, return_exceptions=True):
+            if isinstance(result, Exception):
+                tweets_delivered.inc(result='failed')
+                stats['failed'] += 1
+            else:
+                tweets_delivered.inc(result='sent')
+                stats['sent'] += 1
+        await asyncio.to_thread(self.checkpoints.save, checkpoints)
+
+
+async def run(once=False):
+    sender = TelegramSender(os.getenv('API_KEY'))
+    await sender.start()
+    store = create_store()
+    pipeline = TweetPipeline(store, sender, CheckpointStore())
+    refresher = TokenRefresher(store)
+    try:
+        if once:
+            return await pipeline.run_once()
+        await asyncio.gather(pipeline.run(), refresher.run())
+    finally:
+        await refresher.close()
+        await pipeline.close()
+        await sender.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--once', action='store_true', help="run one cycle and exit")
+    args = parser.parse_args()
+    logging_setup.configure()
+    if metrics.METRICS_PORT and not args.once:
+        metrics.serve()
+    asyncio.run(run(args.once))
+
+
+if __name__ == '__main__':
+    main()
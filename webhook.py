@@ -0,0 +1,150 @@
+"""Webhook ingestion for the bots, as an alternative to long polling.
+
+With BOT_MODE=webhook, Telegram pushes updates to WEBHOOK_URL + WEBHOOK_PATH
+and an async HTTP server puts them on the Application's update queue. Each
+request is acknowledged as soon as the update is queued, so a slow handler
+never holds up delivery. The secret token header is checked on every request
+and update_ids seen recently are dropped, so a delivery Telegram retries is not
+handled twice.
+
+That dedupe, like the coalescing, per-chat ordering and conversation memory of
+main.py, is kept in the process. Replicas behind a round-robin load balancer
+would answer a retried update twice and the messages of a chat out of order,
+so either run one webhook server or have the balancer keep every chat on the
+same replica; sharding.py does the latter for worker processes on one host.
+
+``/metrics`` is public, the ``/debug/<name>`` views beside it need the same
+secret token header, or without WEBHOOK_SECRET a client on the same host.
+"""
+import asyncio
+import collections
+import hmac
+import logging
+import os
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response
+from starlette.routing import Route
+from telegram import Update
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+# How many recent update_ids to remember for deduplication
+WEBHOOK_DEDUPE_SIZE = int(os.getenv('WEBHOOK_DEDUPE_SIZE', '10000'))
+
+
+class RecentIds:
+    """Bounded set of the most recently seen ids, of this process only."""
+
+    def __init__(self, size=WEBHOOK_DEDUPE_SIZE):
+        self.size = size
+        self._ids = collections.OrderedDict()
+
+    def add(self, item):
+        """Remember ``item``. Returns False if it was already known."""
+        if item in self._ids:
+            return False
+        self._ids[item] = None
+        if len(self._ids) > self.size:
+            self._ids.popitem(last=False)
+        return True
+
+
+def create_webhook_app(application, secret=WEBHOOK_SECRET, path=WEBHOOK_PATH, ready=None):
+    """ASGI app that feeds ``application`` from Telegram webhook requests.
+
+    ``ready`` is an optional callable used by ``/healthz`` so a load balancer only
+    sends traffic to a server that can answer.
+    """
+    seen = RecentIds()
+
+    async def telegram_webhook(request: Request) -> Response:
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if secret and not hmac.compare_digest(token, secret):
+            return Response(status_code=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return Response(status_code=400)
+
+        update_id = data.get('update_id')
+        if update_id is not None and not seen.add(update_id):
+            logger.info("Dropping duplicate update %s", update_id)
+            return Response()
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        return Response()
+
+    async def healthz(request: Request) -> Response:
+        if ready is not None and not ready():
+            return PlainTextResponse("warming up", status_code=503)
+        return PlainTextResponse("ok")
+
+    async def metrics_endpoint(request: Request) -> Response:
+        return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+    async def debug_endpoint(request: Request) -> Response:
+        # The views hold user and chat ids: with a secret set, only requests carrying it, like
+        # curl -H 'X-Telegram-Bot-Api-Secret-Token: ...', otherwise only clients on this host
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if secret:
+            if not hmac.compare_digest(token, secret):
+                return Response(status_code=404)
+        elif request.client is None or not metrics.is_local(request.client.host):
+            return Response(status_code=404)
+        view = metrics.render_debug(request.path_params['name'])
+        if view is None:
+            return Response(status_code=404)
+        return Response(view, media_type='application/json')
+
+    return Starlette(routes=[
+        Route(path, telegram_webhook, methods=['POST']),
+        Route('/healthz', healthz, methods=['GET']),
+        Route('/metrics', metrics_endpoint, methods=['GET']),
+        Route('/debug/{name}', debug_endpoint, methods=['GET']),
+    ])
+
+
+async def serve_webhook(application, ready=None):
+    server = uvicorn.Server(uvicorn.Config(
+        create_webhook_app(application, ready=ready),
+        host=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        log_level='warning',
+    ))
+    # run_polling normally takes care of the hooks, here we have to call them ourselves
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            allowed_updates=Update.ALL_TYPES,
+            secret_token=WEBHOOK_SECRET or None,
+        )
+        await application.start()
+        logger.info("Serving webhook on %s:%d%s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+        try:
+            await server.serve()
+        finally:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+def run_bot(application, ready=None):
+    """Run ``application`` until interrupted, by polling or webhook depending on BOT_MODE."""
+    if BOT_MODE == 'webhook':
+        asyncio.run(serve_webhook(application, ready=ready))
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)